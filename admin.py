@@ -1,7 +1,10 @@
 import socket
 import argparse
-import time
+import threading
 from foundations import Connection
+from foundations.codecs import availableCodecs, availableCompressions
+from foundations.tasks.statistics import AGGREGATES, SECTIONS, MAX_PAGE
+from foundations.tracing import ENGINES, DUMP_LIMIT
 import getpass
 
 parser = argparse.ArgumentParser(description='Cloud-Autotest Admin.')
@@ -23,7 +26,40 @@ parser.add_argument('--purge-all', action='store_true',
                     help="Purges all data.")
 parser.add_argument('--server-statistics', action='store_true',
                     default=False,
-                    help="Purges all data.")
+                    help="Prints aggregate statistics for the task.")
+parser.add_argument('--aggregates', type=str, nargs=1, required=False,
+                    help="Comma-separated aggregates to print with \
+--server-statistics, out of " + ', '.join(AGGREGATES) + ". All by default.")
+parser.add_argument('--list', type=str, nargs=1, required=False,
+                    choices=SECTIONS,
+                    help="Lists every input, worker, or output of the input \
+given in --inputId, a page at a time.")
+parser.add_argument('--inputId', type=str, nargs=1, required=False,
+                    help="The input whose outputs --list outputs shows.")
+parser.add_argument('--page-size', type=int, nargs=1, default=[MAX_PAGE],
+                    help="Items to fetch per page with --list.")
+parser.add_argument('--profile-start', action='store_true',
+                    default=False,
+                    help="Starts profiling the event listeners of the server, \
+or only those of --workerId.")
+parser.add_argument('--profile-events', type=str, nargs=1, required=False,
+                    help="Comma-separated event types to profile. All by \
+default.")
+parser.add_argument('--profile-rate', type=float, nargs=1, default=[1.0],
+                    help="Fraction of dispatches to profile.")
+parser.add_argument('--profile-engine', type=str, nargs=1,
+                    default=['cprofile'], choices=ENGINES,
+                    help="cprofile, or yappi if the server has it.")
+parser.add_argument('--profile-stop', action='store_true',
+                    default=False,
+                    help="Stops profiling.")
+parser.add_argument('--profile-dump', action='store_true',
+                    default=False,
+                    help="Prints what profiling collected, per event type.")
+parser.add_argument('--profile-limit', type=int, nargs=1,
+                    default=[DUMP_LIMIT],
+                    help="Functions to print per event type with \
+--profile-dump.")
 
 
 args = parser.parse_args()
@@ -34,17 +70,27 @@ workerId = args.workerId[0] if args.workerId else None
 setProgress = args.set_progress[0] if args.set_progress else None
 purgeData = args.purge_data
 purgeAll = args.purge_all
-serverStatistics = args.server_statistics
+aggregates = args.aggregates[0].split(',') if args.aggregates else None
+serverStatistics = args.server_statistics or aggregates is not None
+listSection = args.list[0] if args.list else None
+inputId = args.inputId[0] if args.inputId else None
+pageSize = args.page_size[0]
+profileStart = args.profile_start
+profileEvents = args.profile_events[0].split(',') \
+    if args.profile_events else None
+profileStop = args.profile_stop
+profileDump = args.profile_dump
 
 if setProgress is None and not purgeData and not purgeAll and \
-        not serverStatistics:
+        not serverStatistics and listSection is None and \
+        not profileStart and not profileStop and not profileDump:
     raise Exception("No flag was set.")
 
 s = socket.socket()
 s.connect((host, port))
 
 connection = Connection(s)
-completed = False
+completed = threading.Event()
 
 
 class AdminContext():
@@ -56,16 +102,22 @@ class AdminContext():
         connection.registerEventListener('completed', self.completed)
         connection.registerEventListener('drop', self.onDrop)
         connection.registerEventListener('statistics', self.onStatistics)
+        connection.registerEventListener('profiles', self.onProfiles)
+        connection.registerEventListener('disconnect', self.completed)
         connection.start()
 
         connection.fire('hello', {
             'taskId': taskId,
             'workerId': 'admin-control-worker',
-            "zId": getpass.getuser()
+            "zId": getpass.getuser(),
+            'codecs': availableCodecs(),
+            'compression': availableCompressions()
         })
 
     def handleACK(self, data):
         print('The server has acknowledged the connection.')
+        connection.setCodec(data.get('codec'))
+        connection.setCompression(data.get('compression'))
         # Now handle the events.
         if purgeData:
             connection.fire('admin-control', {
@@ -85,7 +137,36 @@ class AdminContext():
         if serverStatistics:
             connection.fire('admin-control', {
                 'command': 'server-statistics',
+                'aggregates': aggregates or AGGREGATES,
+            })
+        if listSection is not None:
+            self.requestPage(None)
+        if profileStart:
+            connection.fire('admin-control', {
+                'command': 'profile-start',
+                'events': profileEvents,
+                'rate': args.profile_rate[0],
+                'engine': args.profile_engine[0],
+                'workerId': workerId,
             })
+        if profileStop:
+            connection.fire('admin-control', {
+                'command': 'profile-stop',
+            })
+        if profileDump:
+            connection.fire('admin-control', {
+                'command': 'profile-dump',
+                'limit': args.profile_limit[0],
+            })
+
+    def requestPage(self, cursor):
+        connection.fire('admin-control', {
+            'command': 'server-statistics',
+            'section': listSection,
+            'inputId': inputId,
+            'cursor': cursor,
+            'limit': pageSize,
+        })
 
     def handleError(self, data):
         print("ERROR:", data['message'])
@@ -94,18 +175,31 @@ class AdminContext():
         print(data['message'])
 
     def onDrop(self, data):
-        global completed
         print('Connection was dropped:', data['reason'])
-        completed = True
+        completed.set()
 
     def onStatistics(self, data):
-        print(data)
+        if 'aggregates' in data:
+            for name, value in data['aggregates'].items():
+                print(f'{name}: {value}')
+        elif 'items' in data:
+            for item in data['items']:
+                print(item)
+            if data['nextCursor'] is not None:
+                self.requestPage(data['nextCursor'])
+        else:
+            print(data)
+
+    def onProfiles(self, data):
+        if not data['profiles']:
+            print('Nothing was profiled.')
+        for event, profile in data['profiles'].items():
+            print(f'== {event} ({profile["samples"]} dispatches)')
+            print(profile['profile'])
 
     def completed(self, data):
-        global completed
-        completed = True
+        completed.set()
 
 
 AdminContext(connection)
-while not completed:
-    time.sleep(0.1)
+completed.wait()
@@ -0,0 +1,197 @@
+'''
+Hammers one SimpleTask with many simulated workers at once, the way the
+threaded server does, while readers poll statistics and summaries. Reports
+tests per second for each number of lock stripes and checks that the state
+is consistent afterwards.
+
+Usage: python3 benchmarks/concurrency.py [--workers N] [--tests N]
+                                         [--readers N] [--purges N]
+                                         [--stripes N,N] [--journal]
+'''
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from foundations import SimpleTask, SimpleTaskRunner  # noqa: E402
+
+
+class BenchmarkTask(SimpleTask):
+    def __init__(self, stripes):
+        self.inputLockStripes = stripes
+        super().__init__(SimpleTaskRunner)
+
+    def _generateNewInput(self):
+        return ' '.join(str(random.randint(0, 10))
+                        for _ in range(random.randint(5, 15)))
+
+
+def runWorker(task, workerId, tests, variants, errors):
+    'What a runner does for each test, minus the connection.'
+    try:
+        for _ in range(tests):
+            progress = task.allocateProgress(workerId)
+            task.awaitInput(progress)
+            inputId = task.inputIdAt(progress)
+            task.getInput(inputId)
+            output = f'output {random.randrange(variants)}\n'
+            task.completeTest(workerId, inputId, output, 1)
+    except Exception as e:
+        errors.append(e)
+
+
+def runReader(task, stop, errors):
+    try:
+        while not stop.is_set():
+            task.statisticsAggregate(['summary', 'agreement',
+                                      'distinctOutputs', 'progress'])
+            task.statisticsPage('workers', limit=100)
+            if task.inputCount() > 0:
+                inputId = task.inputIdAt(
+                    random.randrange(task.inputCount()))
+                task.getSummary(inputId)
+                task.outputCluster(inputId)
+            time.sleep(0.001)
+    except Exception as e:
+        errors.append(e)
+
+
+def runPurger(task, workers, purges, stop, errors):
+    try:
+        for _ in range(purges):
+            if stop.is_set():
+                return
+            time.sleep(0.05)
+            task.purgeWorker(f'worker{random.randrange(workers)}')
+    except Exception as e:
+        errors.append(e)
+
+
+def checkConsistency(task):
+    'Returns a list of problems with the state of task.'
+    problems = []
+    memberships = 0
+    clusterRefs = {}
+    for inputId in task.inputIdInOrder:
+        outputIdToWorkerIds = task.inputIdToOutputIdToWorkerIds[inputId]
+        total = sum(len(w) for w in outputIdToWorkerIds.values())
+        memberships += total
+        if task.inputIdToTotal[inputId] != total:
+            problems.append(f'{inputId}: total is off')
+        ranked = task.inputIdToRankedOutputIds[inputId]
+        counts = [len(outputIdToWorkerIds[o]) for o in ranked]
+        if sorted(ranked) != sorted(outputIdToWorkerIds) or \
+                counts != sorted(counts, reverse=True):
+            problems.append(f'{inputId}: ranking is off')
+        if task.inputIdToSummary[inputId] != \
+                (total, len(ranked), counts[0] if counts else 0):
+            problems.append(f'{inputId}: summary is off')
+        for clusterId in outputIdToWorkerIds:
+            clusterRefs[clusterId] = clusterRefs.get(clusterId, 0) + 1
+    results = 0
+    refs = dict(clusterRefs)
+    for workerId, outputIds in task.workerIdToInputIdToOutputId.items():
+        for inputId, outputId in outputIds.items():
+            results += 1
+            refs[outputId] = refs.get(outputId, 0) + 1
+            clusterId = task.inputIdToOutputIdToClusterId[inputId][outputId]
+            if workerId not in \
+                    task.inputIdToOutputIdToWorkerIds[inputId][clusterId]:
+                problems.append(f'{workerId} is missing from {inputId}')
+    if results != memberships:
+        problems.append(f'{results} results but {memberships} memberships')
+    if refs != task.outputIdRefs:
+        problems.append('output reference counts are off')
+    return problems
+
+
+def run(args, stripes, directory):
+    random.seed(0)
+    task = BenchmarkTask(stripes)
+    if directory is not None:
+        task.enablePersistence(directory, fsyncInterval=0)
+    errors = []
+    stop = threading.Event()
+    workers = [threading.Thread(target=runWorker,
+                                args=(task, f'worker{w}', args.tests,
+                                      args.variants, errors))
+               for w in range(args.workers)]
+    others = [threading.Thread(target=runReader, args=(task, stop, errors))
+              for _ in range(args.readers)]
+    if args.purges:
+        others.append(threading.Thread(
+            target=runPurger,
+            args=(task, args.workers, args.purges, stop, errors)))
+    for thread in others:
+        thread.start()
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    stop.set()
+    for thread in others:
+        thread.join()
+
+    tests = args.workers * args.tests
+    problems = [repr(e) for e in errors] + checkConsistency(task)
+    if not args.purges:
+        if sum(task.workerProgress.values()) != tests:
+            problems.append('progress was handed out twice or lost')
+        if task.testsCompleted != tests:
+            problems.append('tests completed is off')
+    if directory is not None:
+        task.journal.close()
+        recovered = BenchmarkTask(stripes)
+        recovered.enablePersistence(directory)
+        if recovered.snapshotState() != task.snapshotState():
+            problems.append('the journal does not replay to the same state')
+        recovered.journal.close()
+    print(f'{stripes:>7} stripes: {tests / elapsed:9.0f} tests/s, '
+          f'{"consistent" if not problems else "INCONSISTENT"}')
+    for problem in problems[:10]:
+        print(f'    {problem}')
+    return not problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SimpleTask concurrency.')
+    parser.add_argument('--workers', type=int, default=500,
+                        help="Simulated workers, one thread each.")
+    parser.add_argument('--tests', type=int, default=40,
+                        help="Tests each worker runs.")
+    parser.add_argument('--variants', type=int, default=3,
+                        help="Distinct outputs per input.")
+    parser.add_argument('--readers', type=int, default=4,
+                        help="Threads polling statistics meanwhile.")
+    parser.add_argument('--purges', type=int, default=0,
+                        help="Workers to purge while the test runs.")
+    parser.add_argument('--stripes', type=str, default='1,64',
+                        help="Comma-separated lock stripe counts to compare.")
+    parser.add_argument('--journal', action='store_true',
+                        help="Journal every change, syncing each record.")
+    args = parser.parse_args()
+
+    print(f'{args.workers} workers x {args.tests} tests, '
+          f'{args.readers} readers, {args.purges} purges'
+          f'{", journaled" if args.journal else ""}')
+    consistent = True
+    for stripes in [int(s) for s in args.stripes.split(',')]:
+        directory = tempfile.mkdtemp() if args.journal else None
+        try:
+            consistent = run(args, stripes, directory) and consistent
+        finally:
+            if directory is not None:
+                shutil.rmtree(directory)
+    sys.exit(0 if consistent else 1)
+
+
+if __name__ == '__main__':
+    main()
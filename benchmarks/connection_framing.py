@@ -0,0 +1,77 @@
+'''
+Measures how fast Connection turns a burst of queued frames into events.
+
+Usage: python3 benchmarks/connection_framing.py [--recv-size BYTES]
+                                                [--codec NAME]
+'''
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from foundations import Connection  # noqa: E402
+from foundations.codecs import availableCodecs  # noqa: E402
+
+
+class QueuedSocket():
+    'A socket stand-in that hands out a pre-built byte stream.'
+
+    def __init__(self, payload):
+        self.payload = memoryview(payload)
+        self.offset = 0
+
+    def recv_into(self, buffer, size):
+        size = min(size, len(buffer), len(self.payload) - self.offset)
+        buffer[:size] = self.payload[self.offset:self.offset + size]
+        self.offset += size
+        return size
+
+    def close(self):
+        pass
+
+
+def buildPayload(frames, codec):
+    encoder = Connection(None)
+    encoder.setCodec(codec)
+    frame = encoder.encodeFrame('stdout', {
+        'message': 'Line of output from the program under test.\n'
+    })
+    return frame * frames
+
+
+def run(frames, recvSize, codec):
+    received = 0
+
+    def onStdout(data):
+        nonlocal received
+        received += 1
+
+    connection = Connection(QueuedSocket(buildPayload(frames, codec)),
+                            recvSize=recvSize)
+    connection.registerEventListener('stdout', onStdout)
+    connection.registerEventListener('disconnect', lambda _: None)
+    started = time.perf_counter()
+    connection.recvLoop()
+    elapsed = time.perf_counter() - started
+    assert received == frames, (received, frames)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Connection framing.')
+    parser.add_argument('--recv-size', type=int, default=65536,
+                        help="Bytes requested per recv_into call.")
+    parser.add_argument('--codec', type=str, default=None,
+                        choices=availableCodecs(),
+                        help="Binary frame codec. Newline-JSON if omitted.")
+    args = parser.parse_args()
+    for frames in (1000, 10000, 100000):
+        elapsed = run(frames, args.recv_size, args.codec)
+        print(f'{frames:>7} frames: {elapsed * 1000:8.1f} ms, '
+              f'{frames / elapsed:12.0f} messages/sec')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+'''
+Measures how many inputs per second each task generates, with NumPy and
+with the pure-Python path it falls back to when NumPy is not installed.
+
+GoingElectric generates a batch at a time, which only pays off with NumPy
+from about GoingElectric.numpyMinBatch inputs up; smaller batches take the
+pure-Python path either way. Try --batch 1, 8 and 64 to see the difference.
+
+Usage: python3 benchmarks/input_generation.py [--inputs N] [--batch N]
+'''
+import argparse
+import importlib.util
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, ROOT)
+
+from foundations import SimpleTask  # noqa: E402
+from foundations.tasks.vectorised import numpyAvailable  # noqa: E402
+
+# (module in tasks/, class) of the tasks with a NumPy path.
+TASKS = [('cs2521_lab1_1', 'CS2521_Lab1_1'),
+         ('cs2521_lab1_2', 'CS2521_Lab1_2'),
+         ('cs2521_lab2_1', 'CS2521_Lab2_1'),
+         ('cs2521_lab2_2', 'CS2521_Lab2_2'),
+         ('going_electric', 'GoingElectric')]
+
+
+def loadTask(module, name):
+    '''
+    Loads a task class from its file, without importing the tasks package,
+    which imports every task and so needs all of them checked out.
+    '''
+    spec = importlib.util.spec_from_file_location(
+        module, os.path.join(ROOT, 'tasks', module + '.py'))
+    loaded = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(loaded)
+    return getattr(loaded, name)
+
+
+def pythonInputs(task, n):
+    'Generates n inputs the way a tree without NumPy would.'
+    if task.seededInputs:
+        return [task._generateNewInput(random.Random(random.getrandbits(63)))
+                for _ in range(n)]
+    return SimpleTask._generateNewInputs(task, n)
+
+
+def numpyInputs(task, n):
+    if task.seededInputs:
+        return [text for _, text in task.makeInputs(n)]
+    return task._generateNewInputs(n)
+
+
+def rate(generate, task, inputs, batch):
+    started = time.perf_counter()
+    done = 0
+    while done < inputs:
+        done += len(generate(task, min(batch, inputs - done)))
+    return done / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Input generation.')
+    parser.add_argument('--inputs', type=int, default=2000,
+                        help="Inputs to generate per task and path.")
+    parser.add_argument('--batch', type=int, default=16,
+                        help="Inputs asked for at once, as the input pool "
+                             "does.")
+    args = parser.parse_args()
+
+    if not numpyAvailable():
+        print('NumPy is not installed; only the pure-Python path is timed.')
+    print(f'{"task":>15} {"python/s":>10} {"numpy/s":>10} {"speedup":>8}')
+    for module, name in TASKS:
+        cls = loadTask(module, name)
+        task = cls()
+        python = rate(pythonInputs, task, args.inputs, args.batch)
+        if numpyAvailable():
+            vectorised = rate(numpyInputs, task, args.inputs, args.batch)
+            print(f'{cls.__name__:>15} {python:10.0f} {vectorised:10.0f} '
+                  f'{vectorised / python:7.1f}x')
+        else:
+            print(f'{cls.__name__:>15} {python:10.0f}')
+
+
+if __name__ == '__main__':
+    main()
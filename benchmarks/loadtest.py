@@ -0,0 +1,370 @@
+'''
+Simulates many client.py workers against a server, answering each test with
+canned or deliberately divergent stdout rather than running a program.
+Reports connections and tests per second, the latency from hello to report
+and the RSS of the server, so runs can be compared to catch regressions.
+
+Every simulated worker is a thread with its own Connection, which runs its
+tests back to back as sessions and reconnects every --tests-per-connection
+tests. The server must whitelist --zid, which defaults to the current user,
+and needs a --backlog large enough for the workers connecting at once.
+
+Usage: python3 benchmarks/loadtest.py TASKID [--host HOST] [--port PORT]
+                                      [--workers N] [--duration SECONDS]
+                                      [--ramp SECONDS]
+                                      [--tests-per-connection N]
+                                      [--divergence FRACTION]
+                                      [--output-bytes N]
+                                      [--server-pid PID | --start]
+'''
+import argparse
+import getpass
+import os
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import threading
+import time
+import zlib
+
+# Only used to raise the limit on open files, where there is one.
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from foundations import Connection  # noqa: E402
+from foundations.codecs import (  # noqa: E402
+    availableCodecs, availableCompressions)
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+# Sent in frames of at most this many characters, like client.py batches
+# stdout.
+FRAME_SIZE = 65536
+
+
+class LoadStats():
+    'What the simulated workers measured, shared between their threads.'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connectLatencies = []
+        self.reportLatencies = []
+        self.divergent = 0
+        self.failures = {}
+
+    def connected(self, latency):
+        with self.lock:
+            self.connectLatencies.append(latency)
+
+    def reported(self, latency, divergent):
+        with self.lock:
+            self.reportLatencies.append(latency)
+            self.divergent += divergent
+
+    def failed(self, reason):
+        with self.lock:
+            self.failures[reason] = self.failures.get(reason, 0) + 1
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[round(fraction * (len(values) - 1))]
+
+
+def fakeOutput(stdin, args, rng):
+    '''
+    Returns what the program would print for stdin, and whether it diverges.
+    Canned output depends only on stdin, so workers given the same input
+    agree.
+    '''
+    lines = [f'{len(stdin.split())} {zlib.crc32(stdin.encode()):08x}\n']
+    divergent = rng.random() < args.divergence
+    if divergent:
+        lines.append(f'divergent {rng.getrandbits(32):08x}\n')
+    size = len(lines[0])
+    while size < args.output_bytes:
+        line = f'{size:>12} line of padding to reach --output-bytes\n'
+        lines.append(line)
+        size += len(line)
+    return ''.join(lines), divergent
+
+
+def runTest(connection, args, workerId, stats, rng):
+    '''
+    Runs one test as a session of connection, the way TaskContext does.
+    Returns whether the connection can run another.
+    '''
+    session = connection.openSession()
+    stdin = []
+    result = {}
+    done = threading.Event()
+
+    def onAck(data):
+        session.setCodec(data.get('codec'))
+        session.setCompression(data.get('compression'))
+
+    def onEOF(_):
+        output, result['divergent'] = fakeOutput(''.join(stdin), args, rng)
+        for offset in range(0, len(output), FRAME_SIZE):
+            session.fire('stdout', {
+                'message': output[offset:offset + FRAME_SIZE]
+            })
+        session.fire('appterm', {
+            'workerId': workerId,
+            'reason': 'Terminated.'
+        })
+
+    def onReport(_):
+        result['latency'] = time.perf_counter() - startedAt
+
+    def onFailure(reason):
+        def listener(_):
+            result.setdefault('failure', reason)
+            done.set()
+        return listener
+
+    session.registerEventListener('ack', onAck)
+    session.registerEventListener(
+        'stdin', lambda data: stdin.append(data['message']))
+    session.registerEventListener('eof', onEOF)
+    session.registerEventListener('report', onReport)
+    session.registerEventListener('completed', lambda _: done.set())
+    session.registerEventListener('drop', onFailure('dropped'))
+    session.registerEventListener('error', onFailure('error'))
+
+    startedAt = time.perf_counter()
+    session.fire('hello', {
+        'taskId': args.taskId,
+        'workerId': workerId,
+        'zId': args.zid,
+        'codecs': availableCodecs(),
+        'compression': availableCompressions(),
+        'summaries': True
+    })
+    alive = True
+    while not done.is_set():
+        if not connection.pump():
+            result.setdefault('failure', 'disconnected')
+            alive = False
+            break
+    session.close()
+
+    if 'failure' in result:
+        stats.failed(result['failure'])
+        return False
+    if 'latency' not in result:
+        stats.failed('no report')
+        return alive
+    stats.reported(result['latency'], result.get('divergent', False))
+    return alive
+
+
+def runWorker(args, index, stats, startAt, deadline):
+    time.sleep(max(0, startAt - time.monotonic()))
+    rng = random.Random(args.seed + index)
+    workerId = f'loadtest{index}'
+    while time.monotonic() < deadline:
+        startedAt = time.perf_counter()
+        try:
+            s = socket.create_connection((args.host, args.port),
+                                         timeout=args.timeout)
+        except OSError:
+            stats.failed('could not connect')
+            time.sleep(0.1)
+            continue
+        stats.connected(time.perf_counter() - startedAt)
+        connection = Connection(s)
+        try:
+            for _ in range(args.tests_per_connection):
+                if time.monotonic() >= deadline or \
+                        not runTest(connection, args, workerId, stats, rng):
+                    break
+        finally:
+            connection.close()
+
+
+def readRss(pid):
+    '''
+    Returns the resident memory of pid and its child processes, in bytes,
+    or None where /proc is not available.
+    '''
+    total = 0
+    pending = [pid]
+    while pending:
+        pid = pending.pop()
+        try:
+            with open(f'/proc/{pid}/status') as file:
+                for line in file:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+            with open(f'/proc/{pid}/task/{pid}/children') as file:
+                pending.extend(int(child) for child in file.read().split())
+        except (OSError, ValueError):
+            if total == 0:
+                return None
+    return total
+
+
+class RssSampler():
+    'Samples the RSS of the server in the background.'
+
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.first = readRss(pid)
+        self.peak = self.first
+        self.last = self.first
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            self.record()
+
+    def record(self):
+        rss = readRss(self.pid)
+        if rss is not None:
+            self.last = rss
+            self.peak = max(self.peak or 0, rss)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.record()
+
+
+def startServer(args):
+    'Starts server.py on --port and waits until it accepts connections.'
+    command = [sys.executable, os.path.join(ROOT, 'server.py'),
+               '--port', str(args.port)] + shlex.split(args.server_args)
+    server = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            sys.exit(f'server.py exited with {server.returncode}.')
+        try:
+            socket.create_connection((args.host, args.port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    sys.exit('server.py did not start listening in 30s.')
+
+
+def raiseFileLimit(workers):
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = workers + 64
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        if hard != resource.RLIM_INFINITY:
+            wanted = min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+
+def formatBytes(size):
+    return 'n/a' if size is None else f'{size / (1 << 20):.1f} MB'
+
+
+def report(args, stats, elapsed, rss):
+    connects = stats.connectLatencies
+    latencies = stats.reportLatencies
+    failed = sum(stats.failures.values())
+    print(f'{args.workers} workers for {elapsed:.1f}s against '
+          f'{args.host}:{args.port} ({args.taskId}), '
+          f'{args.divergence:.0%} divergent')
+    print(f'connections:   {len(connects) / elapsed:9.1f}/s '
+          f'({len(connects)} total, p50 {percentile(connects, 0.5) * 1e3:.1f}'
+          f' ms, p99 {percentile(connects, 0.99) * 1e3:.1f} ms to connect)')
+    print(f'tests:         {len(latencies) / elapsed:9.1f}/s '
+          f'({len(latencies)} total, {stats.divergent} divergent, '
+          f'{failed} failed)')
+    print(f'hello->report: p50 {percentile(latencies, 0.5) * 1e3:.1f} ms, '
+          f'p99 {percentile(latencies, 0.99) * 1e3:.1f} ms')
+    if rss is not None:
+        print(f'server RSS:    {formatBytes(rss.first)} at the start, '
+              f'{formatBytes(rss.peak)} at peak, '
+              f'{formatBytes(rss.last)} at the end')
+    for reason, count in sorted(stats.failures.items()):
+        print(f'    {count} {reason}')
+    return failed == 0 and len(latencies) > 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Server load test.')
+    parser.add_argument('taskId', type=str,
+                        help="The task to run tests of.")
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help="The server to connect to.")
+    parser.add_argument('--port', type=int, default=15000,
+                        help="The port of the server.")
+    parser.add_argument('--zid', type=str, default=getpass.getuser(),
+                        help="The zID to say hello with.")
+    parser.add_argument('--workers', type=int, default=1000,
+                        help="Simulated workers, one thread each.")
+    parser.add_argument('--duration', type=float, default=30,
+                        help="Seconds to run for, including the ramp.")
+    parser.add_argument('--ramp', type=float, default=5,
+                        help="Seconds over which to start the workers.")
+    parser.add_argument('--tests-per-connection', type=int, default=10,
+                        help="Tests each worker runs before reconnecting.")
+    parser.add_argument('--divergence', type=float, default=0.1,
+                        help="Fraction of tests answered with divergent "
+                             "stdout.")
+    parser.add_argument('--output-bytes', type=int, default=64,
+                        help="Pad the stdout of each test to this size.")
+    parser.add_argument('--timeout', type=float, default=30,
+                        help="Seconds to wait on the server before failing.")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Seed of the divergent outputs.")
+    parser.add_argument('--server-pid', type=int, default=None,
+                        help="Report the RSS of this process (Linux only).")
+    parser.add_argument('--start', action='store_true',
+                        help="Start server.py on --port for the run.")
+    parser.add_argument('--server-args', type=str, default='',
+                        help="Extra arguments for server.py with --start.")
+    args = parser.parse_args()
+    if args.start and args.server_pid is not None:
+        parser.error('--start reports the RSS of the server it starts.')
+
+    raiseFileLimit(args.workers)
+    # Thousands of threads, each of which only pumps one socket.
+    threading.stack_size(256 * 1024)
+    server = startServer(args) if args.start else None
+    pid = server.pid if server is not None else args.server_pid
+    rss = RssSampler(pid) if pid is not None else None
+
+    stats = LoadStats()
+    started = time.monotonic()
+    deadline = started + args.duration
+    workers = [threading.Thread(
+        target=runWorker,
+        args=(args, i, stats, started + args.ramp * i / args.workers,
+              deadline),
+        daemon=True) for i in range(args.workers)]
+    try:
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+    finally:
+        elapsed = time.monotonic() - started
+        if rss is not None:
+            rss.stop()
+        if server is not None:
+            server.terminate()
+            server.wait()
+    sys.exit(0 if report(args, stats, elapsed, rss) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+'''
+Compares the memory SimpleTask needs to hold every worker's output when
+outputs are stored per result (the old layout) and when they are interned.
+
+Each layout is built in a child process and measured by its peak RSS.
+
+Usage: python3 benchmarks/output_interning.py [--workers N] [--inputs N]
+                                              [--output-size BYTES]
+                                              [--variants N]
+'''
+import argparse
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from foundations import SimpleTask, SimpleTaskRunner  # noqa: E402
+
+
+def corpus(inputs, outputSize, variants):
+    'inputId -> the distinct outputs seen for it.'
+    random.seed(0)
+    return {
+        f'input{i}': [
+            ''.join(random.choice('0123456789 \n') for _ in range(outputSize))
+            for _ in range(variants)
+        ] for i in range(inputs)
+    }
+
+
+def results(outputs, workers):
+    'Every output is decoded afresh, as it would be off the wire.'
+    for w in range(workers):
+        workerId = f'worker{w}'
+        for i, (inputId, variants) in enumerate(outputs.items()):
+            output = variants[(w + i) % len(variants)]
+            yield workerId, inputId, output.encode('utf-8').decode('utf-8')
+
+
+def buildOld(outputs, workers):
+    inputIdToOutputToWorkerIds = {inputId: {} for inputId in outputs}
+    workerIdToInputIdToOutput = {}
+    for workerId, inputId, output in results(outputs, workers):
+        if output not in inputIdToOutputToWorkerIds[inputId]:
+            inputIdToOutputToWorkerIds[inputId][output] = []
+        inputIdToOutputToWorkerIds[inputId][output].append(workerId)
+        if workerId not in workerIdToInputIdToOutput:
+            workerIdToInputIdToOutput[workerId] = {}
+        workerIdToInputIdToOutput[workerId][inputId] = output
+    return inputIdToOutputToWorkerIds, workerIdToInputIdToOutput
+
+
+def buildInterned(outputs, workers):
+    task = SimpleTask(SimpleTaskRunner)
+    for inputId in outputs:
+        task.addInput(inputId, '')
+    for workerId, inputId, output in results(outputs, workers):
+        task.recordResult(workerId, inputId, output)
+    return task
+
+
+def measure(layout, args, queue):
+    outputs = corpus(args.inputs, args.output_size, args.variants)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    state = layout(outputs, args.workers)
+    elapsed = time.perf_counter() - started
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put(((after - before) / 1024, elapsed))
+    del state
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Output interning.')
+    parser.add_argument('--workers', type=int, default=500)
+    parser.add_argument('--inputs', type=int, default=2000)
+    parser.add_argument('--output-size', type=int, default=256,
+                        help="Characters per output.")
+    parser.add_argument('--variants', type=int, default=4,
+                        help="Distinct outputs per input.")
+    args = parser.parse_args()
+
+    print(f'{args.workers} workers x {args.inputs} inputs, '
+          f'{args.output_size} byte outputs, {args.variants} per input')
+    for name, layout in (('per result', buildOld),
+                         ('interned', buildInterned)):
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=measure,
+                                          args=(layout, args, queue))
+        process.start()
+        memory, elapsed = queue.get()
+        process.join()
+        print(f'{name:>10}: {memory:8.1f} MiB, built in {elapsed:6.2f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+'''
+Measures what journaling SimpleTask state costs per recorded result, how
+long a snapshot takes and how long a restart takes to recover.
+
+Usage: python3 benchmarks/persistence.py [--results N] [--workers N]
+                                         [--fsync-interval SECONDS]
+'''
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from foundations import SimpleTask, SimpleTaskRunner  # noqa: E402
+
+
+class BenchmarkTask(SimpleTask):
+    def __init__(self):
+        super().__init__(SimpleTaskRunner)
+
+    def _generateNewInput(self):
+        return ' '.join(str(random.randint(0, 10))
+                        for _ in range(random.randint(5, 15)))
+
+
+def record(task, results, workers):
+    'Records results the way runners do, spread over workers.'
+    started = time.perf_counter()
+    for i in range(results):
+        workerId = f'worker{i % workers}'
+        progress = task.allocateProgress(workerId)
+        while progress >= len(task.inputIdInOrder):
+            task.generateNewInput()
+        inputId = task.inputIdInOrder[progress]
+        task.recordResult(workerId, inputId, f'output {random.randint(0, 3)}')
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Task persistence.')
+    parser.add_argument('--results', type=int, default=100000,
+                        help="Results to record.")
+    parser.add_argument('--workers', type=int, default=100,
+                        help="Workers the results are spread over.")
+    parser.add_argument('--fsync-interval', type=float, default=1.0,
+                        help="Seconds between journal fsyncs.")
+    args = parser.parse_args()
+
+    random.seed(0)
+    elapsed = record(BenchmarkTask(), args.results, args.workers)
+    print(f'in memory:      {elapsed * 1e6 / args.results:8.2f} us/result')
+
+    directory = tempfile.mkdtemp()
+    try:
+        random.seed(0)
+        task = BenchmarkTask()
+        # Keep snapshots out of the per-result numbers.
+        task.enablePersistence(directory, snapshotEvery=args.results * 10,
+                               fsyncInterval=args.fsync_interval)
+        elapsed = record(task, args.results, args.workers)
+        print(f'journaled:      {elapsed * 1e6 / args.results:8.2f} us/result')
+
+        started = time.perf_counter()
+        with task.writeLock:
+            task.journal.snapshot(task)
+        locked = time.perf_counter() - started
+        task.journal.close()
+        total = time.perf_counter() - started
+        print(f'snapshot:       {locked * 1000:8.1f} ms under the lock, '
+              f'{total * 1000:8.1f} ms in total')
+
+        # Recover from the journal alone, then from the snapshot the first
+        # recovery leaves behind.
+        shutil.rmtree(directory)
+        random.seed(0)
+        task = BenchmarkTask()
+        task.enablePersistence(directory, snapshotEvery=args.results * 10,
+                               fsyncInterval=args.fsync_interval)
+        record(task, args.results, args.workers)
+        task.journal.close()
+        for source in ('journal', 'snapshot'):
+            started = time.perf_counter()
+            recovered = BenchmarkTask()
+            recovered.enablePersistence(directory)
+            elapsed = time.perf_counter() - started
+            recovered.journal.close()
+            assert recovered.workerProgress == task.workerProgress
+            print(f'recover ({source}): {elapsed * 1000:8.1f} ms')
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
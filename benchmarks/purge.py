@@ -0,0 +1,87 @@
+'''
+Measures how long purge-data holds the task lock, comparing the old scan
+over every input and worker list with the reverse index in SimpleTask.
+
+Usage: python3 benchmarks/purge.py [--workers N] [--inputs N]
+                                   [--variants N] [--purges N]
+'''
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from foundations import SimpleTask, SimpleTaskRunner  # noqa: E402
+
+
+def results(workers, inputs, variants):
+    for w in range(workers):
+        for i in range(inputs):
+            yield f'worker{w}', f'input{i}', f'output {(w + i) % variants}\n'
+
+
+def buildOld(workers, inputs, variants):
+    inputIdToOutputToWorkerIds = {f'input{i}': {} for i in range(inputs)}
+    workerIdToInputIdToOutput = {}
+    for workerId, inputId, output in results(workers, inputs, variants):
+        inputIdToOutputToWorkerIds[inputId].setdefault(output, []).append(
+            workerId)
+        workerIdToInputIdToOutput.setdefault(workerId, {})[inputId] = output
+    return inputIdToOutputToWorkerIds, workerIdToInputIdToOutput
+
+
+def purgeOld(state, workerId):
+    'purge-data as it used to be.'
+    inputIdToOutputToWorkerIds, workerIdToInputIdToOutput = state
+    for inputId, outputToWorkerIds in inputIdToOutputToWorkerIds.items():
+        for output in list(outputToWorkerIds.keys()):
+            workerIds = outputToWorkerIds[output]
+            if workerId in workerIds:
+                workerIds.remove(workerId)
+            if len(workerIds) == 0:
+                del outputToWorkerIds[output]
+    if workerId in workerIdToInputIdToOutput:
+        workerIdToInputIdToOutput[workerId] = {}
+
+
+def buildNew(workers, inputs, variants):
+    task = SimpleTask(SimpleTaskRunner)
+    for i in range(inputs):
+        task.addInput(f'input{i}', '')
+    for workerId, inputId, output in results(workers, inputs, variants):
+        task.recordResult(workerId, inputId, output)
+    return task
+
+
+def main():
+    parser = argparse.ArgumentParser(description='purge-data.')
+    parser.add_argument('--workers', type=int, default=500)
+    parser.add_argument('--inputs', type=int, default=2000)
+    parser.add_argument('--variants', type=int, default=4,
+                        help="Distinct outputs per input.")
+    parser.add_argument('--purges', type=int, default=20,
+                        help="Workers to purge.")
+    args = parser.parse_args()
+
+    random.seed(0)
+    victims = [f'worker{w}' for w in
+               random.sample(range(args.workers), args.purges)]
+    print(f'{args.workers} workers x {args.inputs} inputs, purging '
+          f'{args.purges} workers')
+    for name, build, purge in (
+            ('full scan', buildOld, purgeOld),
+            ('reverse index', buildNew,
+             lambda task, workerId: task.purgeWorker(workerId))):
+        state = build(args.workers, args.inputs, args.variants)
+        started = time.perf_counter()
+        for workerId in victims:
+            purge(state, workerId)
+        elapsed = time.perf_counter() - started
+        print(f'{name:>13}: {elapsed * 1000 / args.purges:9.2f} ms/purge')
+        del state
+
+
+if __name__ == '__main__':
+    main()
@@ -3,8 +3,13 @@ import subprocess
 import socket
 import argparse
 import threading
+import codecs
+import heapq
+import os
+import selectors
 import colorama
 from foundations import Connection
+from foundations.codecs import availableCodecs, availableCompressions
 from sys import exit
 import getpass
 
@@ -18,7 +23,7 @@ class AdminContext():
     def __init__(self, socketConn, taskId: str) -> None:
         self.connection = Connection(socketConn)
         self.connected = False
-        self.completed = False
+        self.completed = threading.Event()
 
         self.connection.registerEventListener('ack', self.handleACK)
         self.connection.registerEventListener('error', self.handleError)
@@ -26,17 +31,22 @@ class AdminContext():
         self.connection.registerEventListener('completed', self.onCompleted)
         self.connection.registerEventListener('drop', self.onDrop)
         self.connection.registerEventListener('statistics', self.onStatistics)
+        self.connection.registerEventListener('disconnect', self.onCompleted)
         self.connection.start()
 
         self.connection.fire('hello', {
             'taskId': taskId,
             'workerId': 'admin-control-worker',
-            'zId': getpass.getuser()
+            'zId': getpass.getuser(),
+            'codecs': availableCodecs(),
+            'compression': availableCompressions()
         })
         print('Logging in to the server...')
 
     def handleACK(self, data):
         self.connected = True
+        self.connection.setCodec(data.get('codec'))
+        self.connection.setCompression(data.get('compression'))
 
     def handleError(self, data):
         print("Error:", data['message'])
@@ -46,13 +56,13 @@ class AdminContext():
 
     def onDrop(self, data):
         print('Error:', data['reason'])
-        self.completed = True
+        self.completed.set()
 
     def onStatistics(self, data):
         print(data)
 
     def onCompleted(self, data):
-        self.completed = True
+        self.completed.set()
 
     def purgeData(self, workerId):
         self.connection.fire('admin-control', {
@@ -79,10 +89,125 @@ class AdminContext():
         })
 
 
+class OutputBatcher():
+    '''
+    Coalesces raw program output into as few stdout events as possible.
+    A batch is flushed once it holds maxBytes or its oldest byte has waited
+    for maxDelay seconds.
+    '''
+
+    def __init__(self, send, maxBytes=65536, maxDelay=0.02):
+        self.send = send
+        self.maxBytes = maxBytes
+        self.maxDelay = maxDelay
+        # Chunk boundaries may split multi-byte characters.
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.pending = []
+        self.pendingBytes = 0
+        self.pendingSince = None
+
+    def add(self, chunk):
+        if self.pendingSince is None:
+            self.pendingSince = time.monotonic()
+        self.pending.append(chunk)
+        self.pendingBytes += len(chunk)
+        if self.pendingBytes >= self.maxBytes:
+            self.flush()
+
+    def timeout(self):
+        'Seconds until the pending batch is due, or None if there is none.'
+        if self.pendingSince is None:
+            return None
+        return max(0, self.pendingSince + self.maxDelay - time.monotonic())
+
+    def flushIfDue(self):
+        if self.pendingSince is not None and self.timeout() == 0:
+            self.flush()
+
+    def flush(self, final=False):
+        message = self.decoder.decode(b''.join(self.pending), final)
+        self.pending = []
+        self.pendingBytes = 0
+        self.pendingSince = None
+        if message:
+            self.send(message)
+
+
+class TestRun():
+    '''
+    Book-keeping for the tests started by one call to main, which may run on
+    several connections at once. Results are printed as they complete, but
+    the log file is always written in test order.
+    '''
+
+    def __init__(self, maxTests=0):
+        self.maxTests = maxTests
+        self.lock = threading.Lock()
+        self.claimed = 0
+        self.conducted = 0
+        self.stopped = False
+        # TaskContext -> testNumber, None until the server acknowledges it.
+        self.running = {}
+        self.pendingLogs = []  # heap of (testNumber, sequence, message)
+        self.sequence = 0
+
+    def claim(self, ctx, count=1):
+        'Returns how many more tests (up to count) ctx may run.'
+        with self.lock:
+            if self.stopped or self.reachedMax():
+                return 0
+            if self.maxTests > 0:
+                count = min(count, self.maxTests - self.claimed)
+            self.claimed += count
+            self.running[ctx] = None
+            return count
+
+    def reachedMax(self):
+        return self.maxTests > 0 and self.claimed >= self.maxTests
+
+    def started(self, ctx, testNumber):
+        with self.lock:
+            if ctx in self.running:
+                # Old servers do not tell us; log those in completion order.
+                self.running[ctx] = testNumber if testNumber is not None \
+                    else float('inf')
+
+    def finished(self, ctx, passed):
+        with self.lock:
+            self.running.pop(ctx, None)
+            if passed:
+                self.conducted += 1
+            else:
+                self.stopped = True
+            self.flushLogs()
+
+    def output(self, message):
+        with self.lock:
+            print(message)
+
+    def log(self, testNumber, message):
+        with self.lock:
+            heapq.heappush(self.pendingLogs,
+                           (testNumber, self.sequence, message))
+            self.sequence += 1
+            self.flushLogs()
+
+    def flushLogs(self):
+        'Writes every log line that no running test can precede.'
+        if None in self.running.values():
+            return
+        watermark = min(self.running.values(), default=float('inf'))
+        while self.pendingLogs and self.pendingLogs[0][0] < watermark:
+            writeLogs(heapq.heappop(self.pendingLogs)[2])
+
+
 class TaskContext():
-    def __init__(self, socketConn, taskId, workerId, file,
-                 host=None, port=None):
-        self.connection = Connection(socketConn)
+    def __init__(self, connection, taskId, workerId, file,
+                 host=None, port=None, run=None):
+        # Each test is a session on the shared connection, so its listeners
+        # go away with it when the test ends.
+        self.connection = connection.openSession()
+        self.run = run if run is not None else TestRun()
         self.taskId = taskId
         self.workerId = workerId
         self.file = file
@@ -93,6 +218,13 @@ class TaskContext():
         self.host = host
         self.port = port
         self.started = 0
+        self.selector = None
+        # The program's stdin is written without blocking from the select
+        # loop, so that a full pipe cannot stall reading its stdout.
+        self.stdinPending = bytearray()
+        self.stdinEOF = False
+        # Number of tests to ask for at once, see BatchContext.
+        self.prefetch = None
 
         self.connection.registerEventListener('ack', self.handleACK)
         self.connection.registerEventListener('stdin', self.onStdin)
@@ -111,43 +243,89 @@ class TaskContext():
                                         stdout=subprocess.PIPE,
                                         stderr=subprocess.STDOUT,
                                         stdin=subprocess.PIPE)
-        self.connection.start()
         self.onConnection()
-        self.started = time.time()
-        # Timeout guard
-        timeoutGuardThread = threading.Thread(target=self.appTimeoutGuard)
-        timeoutGuardThread.daemon = True
-        timeoutGuardThread.start()
-        # Send stdout to server
-        stdoutThread = threading.Thread(target=self.stdoutMonitor)
-        stdoutThread.daemon = True
-        stdoutThread.start()
-        while not self.completed:
-            time.sleep(0.1)
+        self.started = time.monotonic()
+        self.supervise()
+        self.reap()
+        self.connection.close()
         # We drop the connection on error - so if it's not dropped, then it's
         # successful.
         return not self.dropped
 
-    def stdoutMonitor(self):
-        while self.process.poll() is None:
-            try:
-                self.process.stdin.flush()
-                self.process.stdout.flush()
-            except Exception:
-                break
-            self.sendStdout(self.process.stdout.readline().decode('utf-8'))
-        self.sendStdout(self.process.stdout.read().decode('utf-8'))
-        self.appTerm()
+    def supervise(self):
+        '''
+        Waits on the socket, the program's stdout and stdin, and the timeout
+        in a single loop until the test is finished.
+        '''
+        batcher = OutputBatcher(self.sendStdout)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.connection.connection.conn,
+                               selectors.EVENT_READ, 'socket')
+        self.selector.register(self.process.stdout, selectors.EVENT_READ,
+                               'stdout')
+        os.set_blocking(self.process.stdin.fileno(), False)
+        self.onSupervise()
+        killed = False
+        while not self.testFinished():
+            timeouts = [batcher.timeout()]
+            if not killed:
+                timeouts.append(max(
+                    0, self.started + APP_TIMEOUT - time.monotonic()))
+            timeouts = [t for t in timeouts if t is not None]
+            events = self.selector.select(min(timeouts) if timeouts else None)
+            for key, mask in events:
+                if key.data == 'socket':
+                    self.connection.connection.pump()
+                elif key.data == 'stdout':
+                    try:
+                        chunk = os.read(key.fd, batcher.maxBytes)
+                    except OSError:
+                        chunk = b''
+                    if chunk:
+                        batcher.add(chunk)
+                        continue
+                    self.selector.unregister(key.fileobj)
+                    batcher.flush(final=True)
+                    self.appTerm()
+                elif key.data == 'stdin':
+                    self.writeStdin()
+                if self.testFinished():
+                    break
+            batcher.flushIfDue()
+            if not killed and self.process.poll() is None and \
+                    time.monotonic() - self.started >= APP_TIMEOUT:
+                print(
+                    f"{colorama.Fore.RED}Program was killed due to timeout.\
+{colorama.Fore.RESET}")
+                killed = True
+                self.process.kill()
+                self.appKill()
+        self.selector.close()
+
+    def onSupervise(self):
+        'Called once the program is being watched.'
+
+    def testFinished(self):
+        return self.completed
+
+    def reap(self):
         try:
-            self.process.stdin.close()
-            self.process.stdout.close()
-            self.process.stderr.close()
+            self.process.kill()
         except Exception:
             pass
+        self.process.wait()
+        for pipe in (self.process.stdin, self.process.stdout):
+            try:
+                pipe.close()
+            except Exception:
+                pass
 
     def handleACK(self, data):
         workerId = data['workerId']
         self.workerId = workerId
+        self.run.started(self, data.get('progress'))
+        self.connection.setCodec(data.get('codec'))
+        self.connection.setCompression(data.get('compression'))
 
     def dropConnection(self, withReason='Dropped.'):
         self.connection.fire("drop", {
@@ -157,17 +335,40 @@ class TaskContext():
 
     def onStdin(self, data):
         message = data['message']
-        try:
-            self.process.stdin.write(message.encode('utf-8'))
-            self.process.stdin.flush()
-        except Exception:
-            self.appTerm('Failed to write to stdin.')
+        self.stdinPending += message.encode('utf-8')
+        self.writeStdin()
 
     def onEOF(self, data):
+        self.stdinEOF = True
+        self.writeStdin()
+
+    def writeStdin(self):
+        stdin = self.process.stdin
+        if stdin.closed:
+            return
         try:
-            self.process.stdin.close()
+            while self.stdinPending:
+                written = os.write(stdin.fileno(), self.stdinPending)
+                del self.stdinPending[:written]
+        except BlockingIOError:
+            pass
         except Exception:
-            print('Failed to close stdin.')
+            self.stdinPending.clear()
+            self.appTerm('Failed to write to stdin.')
+        try:
+            self.selector.get_key(stdin)
+            registered = True
+        except KeyError:
+            registered = False
+        if self.stdinPending and not registered:
+            self.selector.register(stdin, selectors.EVENT_WRITE, 'stdin')
+        elif not self.stdinPending and registered:
+            self.selector.unregister(stdin)
+        if self.stdinEOF and not self.stdinPending:
+            try:
+                stdin.close()
+            except Exception:
+                print('Failed to close stdin.')
 
     def sendStdout(self, message):
         self.connection.fire('stdout', {
@@ -176,16 +377,24 @@ class TaskContext():
 
     def onConnection(self):
         # Send the taskId
-        self.connection.fire('hello', {
+        hello = {
             'taskId': self.taskId,
             'workerId': self.workerId,
-            'zId': getpass.getuser()
-        })
+            'zId': getpass.getuser(),
+            'codecs': availableCodecs(),
+            'compression': availableCompressions(),
+            # Reports may carry topOutputs instead of every output.
+            'summaries': True,
+            # We reconnect when asked to, see main.
+            'reconnect': True
+        }
+        if self.prefetch:
+            hello['prefetch'] = self.prefetch
+        self.connection.fire('hello', hello)
 
     def onDisconnect(self, _):
         self.dropped = True
         self.completed = True
-        self.process.kill()
 
     def appTerm(self, reason='Terminated.'):
         self.connection.fire('appterm', {
@@ -196,17 +405,12 @@ class TaskContext():
     def onDrop(self, data):
         self.dropped = True
         self.completed = True
-        self.process.kill()
         print(data['reason'])
-        exit(1)
 
     def onError(self, data):
-        global completed, dropped
         self.dropped = True
         self.completed = True
-        self.process.kill()
         print('Error:', data['message'])
-        exit(1)
 
     def onMessage(self, data):
         message = data['message']
@@ -214,8 +418,6 @@ class TaskContext():
 
     def onCompletion(self, data):
         self.completed = True
-        self.process.kill()
-        exit(0)
 
     def appKill(self, reason='Killed.'):
         self.connection.fire('appkill', {
@@ -231,27 +433,45 @@ class TaskContext():
         inputData = data['input']
         inputId = data['inputId']
         testNumber = data['testNumber']
-        allOutputs = data['allOutputs']
-        allOutputsPopularitySorted = sorted(
-            allOutputs, key=lambda k: len(allOutputs[k]), reverse=True)
+        topOutputs = data.get('topOutputs')
+        if topOutputs is None:
+            # Older servers send every output with all of its workers.
+            allOutputs = data['allOutputs']
+            topOutputs = [{
+                'output': poutput,
+                'count': len(allOutputs[poutput]),
+                'workerIds': allOutputs[poutput]
+            } for poutput in sorted(allOutputs, reverse=True,
+                                    key=lambda k: len(allOutputs[k]))]
         possibleOutputs = ''
         possibleOutputsWithoutColors = ''
-        for poutput in allOutputsPopularitySorted:
-            outputSimilarity = len(allOutputs[poutput])/total*100
-            numberOfOutputs = len(allOutputs[poutput])
+        for top in topOutputs:
+            poutput = top['output']
+            # Outputs may be grouped with similar ones, so match by cluster.
+            isYours = top['outputId'] == data['outputId'] \
+                if 'outputId' in top else output == poutput
+            numberOfOutputs = top['count']
+            outputSimilarity = numberOfOutputs/total*100
+            workers = ', '.join(top['workerIds'])
+            if numberOfOutputs > len(top['workerIds']):
+                workers += f' and {numberOfOutputs - len(top["workerIds"])} more'
             possibleOutputs += f'\n{colorama.Fore.YELLOW}{numberOfOutputs} of {total} ({str(outputSimilarity)}%) produced: {colorama.Fore.RESET}' + \
-                (f'{colorama.Fore.RED}[Your Output]{colorama.Fore.RESET} ' if output ==
-                 poutput else '') + \
-                f"{colorama.Style.DIM}({', '.join(allOutputs[poutput])}){colorama.Style.RESET_ALL}" + \
+                (f'{colorama.Fore.RED}[Your Output]{colorama.Fore.RESET} ' if
+                 isYours else '') + \
+                f"{colorama.Style.DIM}({workers}){colorama.Style.RESET_ALL}" + \
                 f'\n{poutput}\n'
             possibleOutputsWithoutColors += f'\n{numberOfOutputs} of {total} ({str(outputSimilarity)}%) produced: ' + \
-                (f'[Your Output] ' if output ==
-                 poutput else '') + \
-                f"({', '.join(allOutputs[poutput])})" + \
+                (f'[Your Output] ' if isYours else '') + \
+                f"({workers})" + \
                 f'\n{poutput}\n'
+        hiddenOutputs = data.get('distinctOutputs', len(topOutputs)) - \
+            len(topOutputs)
+        if hiddenOutputs > 0:
+            possibleOutputs += f'\n{colorama.Style.DIM}...and {hiddenOutputs} less common outputs.{colorama.Style.RESET_ALL}\n'
+            possibleOutputsWithoutColors += f'\n...and {hiddenOutputs} less common outputs.\n'
 
         if similarity <= 0.5:
-            print(f'''
+            self.run.output(f'''
 {colorama.Fore.RED}Your program failed test {str(testNumber)}.
 Execution was paused as your outputs were not similar enough
 with what we have in the system.
@@ -280,7 +500,7 @@ Or, if you're using the binary version:
 cloud-autotest "{self.taskId}" "{self.workerId}" "{self.file}" --host "{self.host}" --port "{self.port}"
 {colorama.Fore.RESET}
 ''')
-            writeLogs(f'''
+            self.run.log(testNumber, f'''
 Your program failed test {str(testNumber)}.
 Execution was paused as your outputs were not similar enough
 with what we have in the system.
@@ -308,13 +528,6 @@ Or, if you're using the binary version:
 cloud-autotest "{self.taskId}" "{self.workerId}" "{self.file}" --host "{self.host}" --port "{self.port}"
 ''')
             self.dropConnection('Outputs were not similar enough.')
-            try:
-                self.process.stdout.close()
-                self.process.stderr.close()
-                self.process.stdin.close()
-                self.process.kill()
-            except Exception:
-                pass
             self.dropped = True
             self.completed = True
         else:
@@ -331,39 +544,175 @@ cloud-autotest "{self.taskId}" "{self.workerId}" "{self.file}" --host "{self.hos
             else:
                 colour = colorama.Fore.RED
 
-            print(
+            self.run.output(
                 f'Test {str(testNumber)} ({inputId}) passed with a similarity index of {colour}{str(similarity*100)}% ({str(sameoutput)}/{str(total)}).{colorama.Fore.RESET}')
-            writeLogs(
+            self.run.log(
+                testNumber,
                 f'Test {str(testNumber)} ({inputId}) passed with a similarity index of {str(similarity*100)}% ({str(sameoutput)}/{str(total)}).')
 
-    def appTimeoutGuard(self):
-        while time.time()-self.started < 30:
-            time.sleep(0.5)
-        if self.process.poll() is None:
-            print(
-                f"{colorama.Fore.RED}Program was killed due to timeout.{colorama.Fore.RESET}")
-            self.process.kill()
-            self.appKill()
 
+class BatchContext(TaskContext):
+    '''
+    Asks the server for several tests at once, runs them back to back
+    locally, and uploads all of the outputs together. This saves a round
+    trip per test. The inputs arrive as scripts of the events that the
+    server would otherwise have sent while the program ran.
+    '''
+
+    def __init__(self, connection, taskId, workerId, file,
+                 host=None, port=None, run=None):
+        super().__init__(connection, taskId, workerId, file, host, port, run)
+        self.tests = None
+        self.test = None
+        self.testDone = False
+        self.results = []
+        self.outputChunks = []
+        self.killReason = None
+        self.connection.registerEventListener('batch', self.onBatch)
+        self.connection.registerEventListener('reports', self.onReports)
+
+    def start(self) -> bool:
+        'Returns whether every test of the batch was successful.'
+        self.onConnection()
+        self.pumpUntil(lambda: self.tests is not None)
+        for test in self.tests or []:
+            if self.completed:
+                break
+            self.runTest(test)
+            if self.killReason is not None:
+                # Same as a single test: a timeout ends the run.
+                self.dropped = True
+                break
+        if not self.completed:
+            self.connection.fire('results', {
+                'results': self.results
+            })
+            self.pumpUntil(lambda: False)
+        self.connection.close()
+        return not self.dropped
+
+    def pumpUntil(self, condition):
+        while not self.completed and not condition():
+            if not self.connection.connection.pump():
+                break
+
+    def runTest(self, test):
+        self.test = test
+        self.testDone = False
+        self.outputChunks = []
+        self.killReason = None
+        self.stdinPending = bytearray()
+        self.stdinEOF = False
+        self.process = subprocess.Popen(self.file.split(' '),
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT,
+                                        stdin=subprocess.PIPE)
+        self.started = time.monotonic()
+        self.supervise()
+        self.reap()
+        self.results.append({
+            'testNumber': test['testNumber'],
+            'inputId': test['inputId'],
+            'output': ''.join(self.outputChunks),
+            'killReason': self.killReason
+        })
+
+    def onSupervise(self):
+        # Replay what the server would have sent while the program ran.
+        handlers = {
+            'stdin': self.onStdin,
+            'eof': self.onEOF,
+            'message': self.onMessage,
+        }
+        for event in self.test['events']:
+            if event['type'] in handlers:
+                handlers[event['type']](event['data'])
+
+    def testFinished(self):
+        return self.completed or self.testDone
+
+    def onBatch(self, data):
+        self.tests = data['tests']
+
+    def onReports(self, data):
+        for report in data['reports']:
+            self.onReport(report)
+            if self.dropped:
+                break
+
+    def sendStdout(self, message):
+        self.outputChunks.append(message)
+
+    def appTerm(self, reason='Terminated.'):
+        self.testDone = True
 
-def main(taskId, workerId, file, host, port, maxTests=0):
+    def appKill(self, reason='Killed.'):
+        self.killReason = reason
+
+
+def main(taskId, workerId, file, host, port, maxTests=0, jobs=1,
+         prefetch=1):
     global logFile
-    s = socket.socket()
-    try:
-        s.connect((host, port))
-    except Exception:
-        print("Error: Failed to connect to the server.")
-        exit(1)
-
-    testsConducted = 0
-    ctx = TaskContext(s, taskId, workerId, file, host, port)
-    while ctx.start():
-        testsConducted += 1
-        if maxTests > 0 and testsConducted >= maxTests:
-            print("Reached maxTests - exiting.")
-            writeLogs("Reached maxTests - exiting.")
-            break
-        ctx = TaskContext(s, taskId, workerId, file, host, port)
+    sockets = []
+    for _ in range(max(1, jobs)):
+        s = socket.socket()
+        try:
+            s.connect((host, port))
+        except Exception:
+            print("Error: Failed to connect to the server.")
+            exit(1)
+        sockets.append(s)
+
+    run = TestRun(maxTests)
+
+    def worker(s):
+        # One Connection per socket for the whole run; tests run back to
+        # back as sessions on it, pumped by TaskContext itself. A server that
+        # is being replaced asks us to reconnect between tests.
+        connection = Connection(s)
+        reconnect = threading.Event()
+        connection.registerEventListener('reconnect',
+                                         lambda _: reconnect.set())
+        while True:
+            if reconnect.is_set():
+                connection.close()
+                try:
+                    s = socket.create_connection((host, port))
+                except Exception:
+                    print("Error: Failed to reconnect to the server.")
+                    break
+                connection = Connection(s)
+                reconnect.clear()
+                connection.registerEventListener('reconnect',
+                                                 lambda _: reconnect.set())
+            if prefetch > 1:
+                ctx = BatchContext(connection, taskId, workerId, file, host,
+                                   port, run)
+            else:
+                ctx = TaskContext(connection, taskId, workerId, file, host,
+                                  port, run)
+            claimed = run.claim(ctx, prefetch)
+            if not claimed:
+                break
+            if prefetch > 1:
+                ctx.prefetch = claimed
+            run.finished(ctx, ctx.start())
+        connection.close()
+
+    # Each job keeps its own connection and runs its tests back to back.
+    threads = []
+    for s in sockets[1:]:
+        thread = threading.Thread(target=worker, args=(s,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    worker(sockets[0])
+    for thread in threads:
+        thread.join()
+
+    if run.reachedMax() and not run.stopped:
+        print("Reached maxTests - exiting.")
+        writeLogs("Reached maxTests - exiting.")
 
 
 def interactive():
@@ -395,6 +744,9 @@ def interactive():
             maxTests = input(
                 '\nHow many tests do you want to run? [Default: 0 (unlimited)]: ')
             maxTests = int(maxTests) if maxTests.isdigit() else 0
+            jobs = input(
+                'How many tests do you want to run at once? [Default: 1]: ')
+            jobs = int(jobs) if jobs.isdigit() and int(jobs) > 0 else 1
             logFile = input(
                 'Log file: [Default: cloud-autotest-[timestamp].log]: ')
             if logFile == '':
@@ -402,7 +754,7 @@ def interactive():
             print('\nUsing log file:', logFile)
 
             print("Starting autotest...\n\n")
-            main(taskId, workerId, file, host, port, maxTests)
+            main(taskId, workerId, file, host, port, maxTests, jobs)
             return
         elif option == 'p':
             taskId = input('Task ID: ')
@@ -425,8 +777,7 @@ def interactive():
             progress = int(input('Progress: '))
             ctx = AdminContext(conn, taskId)
             ctx.setProgress(workerId, progress=progress)
-            while not ctx.completed:
-                time.sleep(0.1)
+            ctx.completed.wait()
         elif option == 'c':
             taskId = input('Task ID: ')
             workerId = input('Worker ID: ')
@@ -447,8 +798,7 @@ def interactive():
                 exit(1)
             ctx = AdminContext(conn, taskId)
             ctx.purgeData(workerId)
-            while not ctx.completed:
-                time.sleep(0.1)
+            ctx.completed.wait()
         elif option == 'q':
             exit(0)
         else:
@@ -471,6 +821,8 @@ colorama.init()
 
 DEFAULT_HOST = 'server.cloudtest.yyjlincoln.app'
 DEFAULT_PORT = 15000
+# Seconds a tested program may run before it is killed.
+APP_TIMEOUT = 30
 
 parser = argparse.ArgumentParser(
     description='Cloud-Autotest Worker.')
@@ -486,6 +838,11 @@ parser.add_argument('--port', type=int, nargs=1, default=[DEFAULT_PORT],
                     help="The port to connect to.")
 parser.add_argument('--max', type=int, nargs=1, default=[0],
                     help="Maximum number of tests before exiting.")
+parser.add_argument('--jobs', type=int, nargs=1, default=[1],
+                    help="Number of tests to run at the same time.")
+parser.add_argument('--prefetch', type=int, nargs=1, default=[1],
+                    help="Number of tests to fetch from the server at once. \
+They run back to back and their results are uploaded together.")
 parser.add_argument('--logFile', type=str, nargs=1, default=[None],
                     help="Maximum number of tests before exiting.")
 parser.add_argument('file', type=str, nargs=1,
@@ -511,9 +868,11 @@ taskId = args.taskId[0] if args.taskId else None
 workerId = args.workerId[0] if args.workerId else None
 logFile = args.logFile[0] if args.logFile else None
 maxTests = args.max[0]
+jobs = args.jobs[0]
+prefetch = args.prefetch[0]
 
 try:
-    main(taskId, workerId, file, host, port, maxTests)
+    main(taskId, workerId, file, host, port, maxTests, jobs, prefetch)
 except KeyboardInterrupt:
     print("\nExiting.")
     exit(0)
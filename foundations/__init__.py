@@ -1,2 +1,4 @@
 from .connection import Connection
+from .asyncconnection import AsyncConnection
 from .tasks import SimpleTask, SimpleTaskRunner, GenericTask, GenericTaskRunner
+from .tasks import ExactEngine, MinHashEngine
@@ -0,0 +1,191 @@
+import asyncio
+import collections
+import logging
+import threading
+from .codecs import MAX_FRAME
+from .connection import BaseConnection, Disconnected, ProtocolError, \
+    TimedOut
+
+
+class AsyncConnection(BaseConnection, asyncio.BufferedProtocol):
+    '''
+    A Connection driven by an asyncio event loop instead of a thread.
+
+    It exposes the same registerEventListener / fire API, so task runners
+    work unchanged. Without an executor, handlers run on the event loop, so
+    they must not block. With one, frames are still read on the loop but
+    their handlers run on the executor, one at a time and in order for each
+    connection, so handlers that wait on a lock, the disk or another process
+    only hold up their own connection. fire and close may then be called
+    from any thread. onConnect is called with the connection once the
+    transport is up.
+    '''
+
+    # Stop reading from a peer while this many frames wait for a handler.
+    MAX_QUEUED = 64
+
+    def __init__(self, onConnect=None, initialBuffer=b'', recvSize=65536,
+                 compressMinSize=32, maxFrame=MAX_FRAME,
+                 executor=None) -> None:
+        super().__init__(initialBuffer=initialBuffer, recvSize=recvSize,
+                         compressMinSize=compressMinSize, maxFrame=maxFrame)
+        self.onConnect = onConnect
+        self.transport = None
+        self.recvView = None
+        self.loop = None
+        self.loopThread = None
+        self.executor = executor
+        self.queue = collections.deque()
+        self.queueLock = threading.Lock()
+        self.dispatching = False
+        self.paused = False
+
+    def start(self):
+        'The event loop drives the connection; nothing to start.'
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.loop = asyncio.get_running_loop()
+        self.loopThread = threading.get_ident()
+        if self.onConnect is not None:
+            self.schedule(self.onConnect, self)
+
+    def get_buffer(self, sizehint):
+        self.reserveBuffer()
+        self.recvView = memoryview(self.buffer)[self.writeOffset:]
+        return self.recvView
+
+    def buffer_updated(self, nbytes):
+        # Release the export so that the buffer may grow again.
+        self.recvView.release()
+        self.recvView = None
+        self.writeOffset += nbytes
+        try:
+            self.handleBufferContent()
+        except ProtocolError as e:
+            # connection_lost follows and fires disconnect.
+            logging.warning(f'Closing the connection: {e}')
+            self.close()
+
+    def eof_received(self):
+        return False
+
+    def connection_lost(self, exc):
+        if self.recvView is not None:
+            self.recvView.release()
+            self.recvView = None
+        logging.debug('Connection closed.')
+        self.connected = False
+        self.schedule(self.localFire, 'disconnect', None)
+
+    def dispatchMessage(self, message, size=0):
+        self.schedule(super().dispatchMessage, message, size)
+
+    def schedule(self, handler, *args):
+        'Runs handler now, or after the frames before it on the executor.'
+        if self.executor is None:
+            handler(*args)
+            return
+        with self.queueLock:
+            self.queue.append((handler, args))
+            start = not self.dispatching
+            self.dispatching = True
+            if len(self.queue) >= self.MAX_QUEUED and not self.paused and \
+                    self.transport is not None:
+                self.paused = True
+                self.transport.pause_reading()
+        if start:
+            self.loop.run_in_executor(self.executor, self.runQueue)
+
+    def runQueue(self):
+        while True:
+            with self.queueLock:
+                if not self.queue:
+                    self.dispatching = False
+                    if self.paused:
+                        self.paused = False
+                        self.loop.call_soon_threadsafe(self.resumeReading)
+                    return
+                handler, args = self.queue.popleft()
+            try:
+                handler(*args)
+            except Exception:
+                logging.exception('An event listener failed; closing the \
+connection.')
+                self.close()
+
+    def resumeReading(self):
+        if not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def onLoop(self, callback, *args):
+        'Runs callback on the event loop, in order with earlier calls.'
+        if threading.get_ident() == self.loopThread:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def send(self, frame):
+        # Called with sendLock held, so frames keep the order they were
+        # encoded in, which the deflate stream depends on.
+        self.onLoop(self.transport.write, frame)
+
+    def close(self):
+        if self.transport is not None:
+            self.onLoop(self.transport.close)
+
+    def newWaiter(self, event, capture=True, requestId=None):
+        waiter = super().newWaiter(event, capture=capture,
+                                   requestId=requestId)
+        # Handlers on the executor may call this too, so the future belongs
+        # to the connection's loop rather than to whichever loop is running.
+        loop = self.loop or asyncio.get_running_loop()
+        waiter['future'] = loop.create_future()
+        if not self.connected:
+            self.settle(waiter['future'], Disconnected("Disconnected."))
+        return waiter
+
+    def settle(self, future, exception=None, data=None):
+        'Resolves future on the event loop, whichever thread calls this.'
+        def settleNow():
+            if future.done():
+                return
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(data)
+        if self.loop is None:
+            settleNow()
+        else:
+            self.onLoop(settleNow)
+
+    def resolveWaiter(self, waiter, data):
+        super().resolveWaiter(waiter, data)
+        self.settle(waiter['future'], data=data)
+
+    def failWaiters(self):
+        with self.waitCondition:
+            for waiters in self.waiters.values():
+                for waiter in waiters:
+                    self.settle(waiter['future'],
+                                Disconnected("Disconnected."))
+            self.waiters = {}
+
+    async def wait(self, event, waiter, timeout=None):
+        try:
+            return await asyncio.wait_for(waiter['future'], timeout)
+        except asyncio.TimeoutError:
+            self.removeWaiter(event, waiter)
+            raise TimedOut("Timed out.")
+
+    async def waitFor(self, event, capture=True, timeout=None,
+                      requestId=None):
+        "Awaited on the connection's loop, like wait and request."
+        waiter = self.newWaiter(event, capture=capture, requestId=requestId)
+        return await self.wait(event, waiter, timeout=timeout)
+
+    async def request(self, event, data, responseEvent, timeout=None):
+        data = self.newRequest(data)
+        waiter = self.newWaiter(responseEvent, requestId=data['requestId'])
+        self.fire(event, data)
+        return await self.wait(responseEvent, waiter, timeout=timeout)
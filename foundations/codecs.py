@@ -0,0 +1,102 @@
+import json
+import struct
+
+# Binary frames start with FRAME_MAGIC, which can never start a
+# newline-delimited JSON message, so both framings can share one stream:
+#   FRAME_MAGIC (1 byte) | flags (1 byte) | payload length (4 bytes) | payload
+# The low bits of flags hold the codecId, the high bits mark compression.
+FRAME_MAGIC = 0xCA
+FRAME_HEADER = struct.Struct('>BBI')
+FLAG_COMPRESSED = 0x80
+# Set on the first compressed frame of a new deflate stream.
+FLAG_NEW_STREAM = 0x40
+CODEC_MASK = 0x3F
+# Frames longer than this, in either framing, are refused and the connection
+# is closed, so that a peer cannot make us buffer gigabytes.
+MAX_FRAME = 64 << 20
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JsonCodec():
+    name = 'json'
+    codecId = 1
+
+    def encode(self, message):
+        return json.dumps(message).encode('utf-8')
+
+    def decode(self, payload):
+        return json.loads(bytes(payload))
+
+
+class OrjsonCodec():
+    name = 'orjson'
+    codecId = 2
+
+    def encode(self, message):
+        return orjson.dumps(message)
+
+    def decode(self, payload):
+        return orjson.loads(payload)
+
+
+class MsgpackCodec():
+    name = 'msgpack'
+    codecId = 3
+
+    def encode(self, message):
+        return msgpack.packb(message, use_bin_type=True)
+
+    def decode(self, payload):
+        return msgpack.unpackb(payload, raw=False)
+
+
+# In order of preference.
+CODECS = [JsonCodec()]
+if orjson is not None:
+    CODECS.insert(0, OrjsonCodec())
+if msgpack is not None:
+    CODECS.insert(0, MsgpackCodec())
+
+CODECS_BY_NAME = {codec.name: codec for codec in CODECS}
+CODECS_BY_ID = {codec.codecId: codec for codec in CODECS}
+
+
+def availableCodecs():
+    'Names of the codecs we can speak, most preferred first.'
+    return [codec.name for codec in CODECS]
+
+
+def negotiateCodec(offered):
+    'Picks our most preferred codec out of what the peer offered.'
+    if not isinstance(offered, list):
+        return None
+    for codec in CODECS:
+        if codec.name in offered:
+            return codec.name
+    return None
+
+
+COMPRESSIONS = ['zlib']
+
+
+def availableCompressions():
+    return list(COMPRESSIONS)
+
+
+def negotiateCompression(offered):
+    'Picks a stream compression out of what the peer offered.'
+    if not isinstance(offered, list):
+        return None
+    for compression in COMPRESSIONS:
+        if compression in offered:
+            return compression
+    return None
@@ -1,33 +1,44 @@
 import json
+import socket
 import threading
 import logging
 import secrets
-import time
-# Type of waitEvents:
-# "eventName" : {
-#   "id": <waiterId>,
+import zlib
+from . import metrics, tracing
+from .codecs import FRAME_MAGIC, FRAME_HEADER, CODECS_BY_NAME, CODECS_BY_ID, \
+    FLAG_COMPRESSED, FLAG_NEW_STREAM, CODEC_MASK, MAX_FRAME
+# Type of waiters:
+# "eventName" : [{
+#   "requestId": <requestId or None to match any>,
 #   "captured": bool,
-# }
+#   "done": bool,
+#   "data": <event data once done>,
+# }]
 
 
 class Disconnected(Exception):
     'Disconnected.'
 
 
-class Connection():
-    def __init__(self, conn, initialBuffer=b'') -> None:
-        self.conn = conn
-        self.buffer = initialBuffer
+class TimedOut(Exception):
+    'Timed out.'
+
+
+class ProtocolError(Exception):
+    'The peer sent something we refuse to buffer or decode.'
+
+
+class EventTarget():
+    'Event listeners and waiters, shared by connections and sessions.'
+
+    def __init__(self) -> None:
         self.eventHandlers = {}
         self.pastEvents = {}
-        self.waitEvents = {}
-        self.waiter = {}
+        self.waiters = {}
+        self.waitCondition = threading.Condition()
         self.connected = True
-
-    def start(self):
-        t = threading.Thread(target=self.recvLoop)
-        t.setDaemon(True)
-        t.start()
+        # (before, after) pairs, see addDispatchHook.
+        self.dispatchHooks = []
 
     def registerEventListener(self, event, listener):
         'Special keyword: disconnect. Fired when the connection is closed.'
@@ -47,102 +58,512 @@ class Connection():
             return
         self.eventHandlers[event].remove(listener)
 
+    def addDispatchHook(self, before=None, after=None):
+        '''
+        Like tracing.addDispatchHook, for the events of this connection and
+        its sessions only. Returns a handle for removeDispatchHook.
+        '''
+        hook = (before, after)
+        self.dispatchHooks.append(hook)
+        return hook
+
+    def removeDispatchHook(self, hook):
+        if hook in self.dispatchHooks:
+            self.dispatchHooks.remove(hook)
+
+    def localFire(self, event, data, size=0):
+        '''
+        Runs the listeners of event, or keeps data until one is registered.
+        size is that of the frame data came in, for dispatch hooks.
+        '''
+        if not self.preLocalFire(event, data):
+            return
+        if event in self.eventHandlers:
+            if tracing.hooks or self.dispatchHooks:
+                tracing.dispatch(self, event, data, size,
+                                 self.eventHandlers[event])
+                return
+            for handler in self.eventHandlers[event]:
+                handler(data)
+        else:
+            if event not in self.pastEvents:
+                self.pastEvents[event] = []
+            self.pastEvents[event].append(data)
+
+    def preLocalFire(self, event, data):
+        if event == 'disconnect':
+            self.failWaiters()
+        with self.waitCondition:
+            if event not in self.waiters:
+                return True
+            requestId = data.get('requestId') \
+                if isinstance(data, dict) else None
+            captured = False
+            pending = []
+            for waiter in self.waiters[event]:
+                # Responses without a requestId come from older peers and
+                # go to whoever is waiting.
+                if waiter['requestId'] is not None and \
+                        requestId is not None and \
+                        waiter['requestId'] != requestId:
+                    pending.append(waiter)
+                    continue
+                captured = captured or waiter['captured']
+                self.resolveWaiter(waiter, data)
+            if pending:
+                self.waiters[event] = pending
+            else:
+                del self.waiters[event]
+            self.waitCondition.notify_all()
+        return not captured
+
+    def newWaiter(self, event, capture=True, requestId=None):
+        '''
+        Registers interest in the next event (with a matching requestId if
+        given) before it can arrive. Pass the result to the wait method.
+        '''
+        waiter = {
+            'requestId': requestId,
+            'captured': capture,
+            'done': False,
+            'data': None,
+        }
+        with self.waitCondition:
+            self.waiters.setdefault(event, []).append(waiter)
+        return waiter
+
+    def removeWaiter(self, event, waiter):
+        with self.waitCondition:
+            if event in self.waiters and waiter in self.waiters[event]:
+                self.waiters[event].remove(waiter)
+                if not self.waiters[event]:
+                    del self.waiters[event]
+
+    def resolveWaiter(self, waiter, data):
+        'Called with waitCondition held.'
+        waiter['done'] = True
+        waiter['data'] = data
+
+    def failWaiters(self):
+        with self.waitCondition:
+            self.waitCondition.notify_all()
+
+    def newRequest(self, data=None):
+        'Tags request data with a fresh requestId that the response echoes.'
+        data = dict(data) if data else {}
+        data['requestId'] = secrets.token_hex(8)
+        return data
+
+    def wait(self, event, waiter, timeout=None):
+        with self.waitCondition:
+            self.waitCondition.wait_for(
+                lambda: waiter['done'] or not self.connected, timeout)
+        if waiter['done']:
+            return waiter['data']
+        self.removeWaiter(event, waiter)
+        if not self.connected:
+            raise Disconnected("Disconnected.")
+        raise TimedOut("Timed out.")
+
+    def waitFor(self, event, capture=True, timeout=None, requestId=None):
+        '''
+        Blocks until the event arrives and returns its data. Any number of
+        threads may wait for the same event. Raises Disconnected or TimedOut.
+        '''
+        waiter = self.newWaiter(event, capture=capture, requestId=requestId)
+        return self.wait(event, waiter, timeout=timeout)
+
+    def request(self, event, data, responseEvent, timeout=None):
+        'Fires event and waits for the responseEvent that echoes its id.'
+        data = self.newRequest(data)
+        waiter = self.newWaiter(responseEvent, requestId=data['requestId'])
+        self.fire(event, data)
+        return self.wait(responseEvent, waiter, timeout=timeout)
+
+
+class BaseConnection(EventTarget):
+    '''
+    Framing and encoding shared by every Connection flavour. Subclasses only
+    move bytes: they feed the receive buffer and implement send and close.
+    '''
+
+    def __init__(self, initialBuffer=b'', recvSize=65536,
+                 compressMinSize=32, maxFrame=MAX_FRAME) -> None:
+        super().__init__()
+        # The receive buffer only grows. Frames live between readOffset and
+        # writeOffset, and scanOffset is where the next newline search
+        # resumes so that a partial frame is never scanned twice.
+        self.recvSize = recvSize
+        self.buffer = bytearray(initialBuffer)
+        self.readOffset = 0
+        self.scanOffset = 0
+        self.writeOffset = len(self.buffer)
+        # Longer frames raise ProtocolError. None only for trusted peers.
+        self.maxFrame = maxFrame
+        # None means newline-delimited JSON, which every peer understands.
+        self.codec = None
+        # Outgoing frames share one deflate stream for the whole session so
+        # repeated output compresses against everything sent before it.
+        self.compression = None
+        self.compressor = None
+        self.compressorIsNew = False
+        self.compressMinSize = compressMinSize
+        self.decompressor = None
+        self.sendLock = threading.Lock()
+        self.sessions = {}  # sessionId -> Session
+        self.sessionListener = None
+
     def handleEventMessage(self, message):
+        size = len(message)
         try:
             message = json.loads(message)
-            assert 'type' in message
-            assert 'data' in message
         except json.JSONDecodeError:
             logging.debug(
                 f'Worker received invalid JSON: {message}; \
 ignoring.')
             return
+        self.dispatchMessage(message, size)
+
+    def dispatchMessage(self, message, size=0):
+        try:
+            assert isinstance(message, dict)
+            assert 'type' in message
+            assert 'data' in message
         except AssertionError:
             logging.debug(
-                f'Worker received invalid JSON: {message}; \
+                f'Worker received invalid message: {message}; \
 ignoring.')
             return
 
         eventType = message['type']
         data = message['data']
-        self.localFire(eventType, data)
+        sessionId = message.get('session')
+        if sessionId is None and self.sessionListener is None and \
+                eventType not in self.eventHandlers:
+            # A server from before sessions answers on the connection
+            # itself, which only ever runs one session with it.
+            sessions = list(self.sessions)
+            if len(sessions) == 1:
+                sessionId = sessions[0]
+        if sessionId is not None:
+            self.dispatchSession(sessionId, eventType, data, size)
+            return
+        self.localFire(eventType, data, size)
 
-    def handleBufferContent(self):
-        bufferSplit = self.buffer.split(b'\n')
-        if len(bufferSplit) > 1:
-            self.handleEventMessage(bufferSplit[0])
-            self.buffer = b'\n'.join(bufferSplit[1:])
-        else:
+    def dispatchSession(self, sessionId, event, data, size=0):
+        if event == 'session-close':
+            session = self.sessions.pop(sessionId, None)
+            if session is not None:
+                session.detach()
             return
-        self.handleBufferContent()
+        session = self.sessions.get(sessionId)
+        if session is None:
+            if self.sessionListener is None:
+                logging.debug(f'Worker received an event for unknown \
+session {sessionId}; ignoring.')
+                return
+            session = self.openSession(sessionId)
+            self.sessionListener(session)
+        session.localFire(event, data, size)
 
-    def localFire(self, event, data):
-        if not self.preLocalFire(event, data):
+    def openSession(self, sessionId=None):
+        'Opens a Session that is multiplexed over this connection.'
+        if sessionId is None:
+            sessionId = secrets.token_hex(8)
+        session = Session(self, sessionId)
+        self.sessions[sessionId] = session
+        return session
+
+    def onSession(self, listener):
+        'listener is called with every Session that the peer opens.'
+        self.sessionListener = listener
+
+    def closeSession(self, session):
+        if self.sessions.pop(session.sessionId, None) is None:
             return
-        if event in self.eventHandlers:
-            for handler in self.eventHandlers[event]:
-                handler(data)
-        else:
-            if event not in self.pastEvents:
-                self.pastEvents[event] = []
-            self.pastEvents[event].append(data)
+        self.fire('session-close', None, session=session.sessionId)
+        session.detach()
 
-    def recvLoop(self):
-        while True:
-            self.handleBufferContent()
+    def preLocalFire(self, event, data):
+        if event == 'disconnect':
+            sessions = self.sessions
+            self.sessions = {}
+            for session in sessions.values():
+                session.connected = False
+                session.localFire('disconnect', None)
+        return super().preLocalFire(event, data)
+
+    def handleBinaryFrame(self, flags, payload):
+        codec = CODECS_BY_ID.get(flags & CODEC_MASK)
+        if codec is None:
+            logging.debug(f'Worker received unknown codec {flags}; \
+ignoring.')
+            return
+        if flags & FLAG_COMPRESSED:
+            if flags & FLAG_NEW_STREAM:
+                self.decompressor = zlib.decompressobj()
+            if self.decompressor is None:
+                logging.debug('Worker received a compressed frame without \
+a stream; ignoring.')
+                return
             try:
-                data = self.conn.recv(2048)
-                if data == b'':
-                    logging.debug('Connection closed.')
-                    self.connected = False
-                    self.localFire('disconnect', None)
-                    return
-                self.buffer += data
-            except Exception:
-                logging.debug('Connection closed.')
-                self.connected = False
-                self.localFire('disconnect', None)
+                # No more than a frame may inflate to, or a little
+                # compressed data could take all our memory.
+                payload = self.decompressor.decompress(
+                    payload, self.maxFrame or 0)
+            except zlib.error:
+                logging.debug('Worker received a corrupted compressed \
+frame; ignoring.')
+                self.decompressor = None
                 return
+            if self.decompressor.unconsumed_tail:
+                raise ProtocolError(f'Received a frame that inflates to more '
+                                    f'than {self.maxFrame} bytes.')
+        try:
+            message = codec.decode(payload)
+        except Exception:
+            logging.debug(f'Worker received an undecodable {codec.name} \
+frame; ignoring.')
+            return
+        self.dispatchMessage(message, len(payload))
 
-    def fire(self, event, data=None):
+    def handleBufferContent(self):
+        view = memoryview(self.buffer)
+        try:
+            while True:
+                if self.readOffset < self.writeOffset and \
+                        self.buffer[self.readOffset] == FRAME_MAGIC:
+                    if not self.handleBinaryBufferContent(view):
+                        return
+                    continue
+                end = self.buffer.find(b'\n', self.scanOffset,
+                                       self.writeOffset)
+                if end == -1:
+                    self.scanOffset = self.writeOffset
+                    self.checkFrameLength(self.writeOffset - self.readOffset)
+                    return
+                message = bytes(view[self.readOffset:end])
+                self.readOffset = self.scanOffset = end + 1
+                self.handleEventMessage(message)
+        finally:
+            view.release()
+
+    def handleBinaryBufferContent(self, view):
+        'Handles one length-prefixed frame. Returns False if incomplete.'
+        available = self.writeOffset - self.readOffset
+        if available < FRAME_HEADER.size:
+            self.scanOffset = self.readOffset
+            return False
+        _, flags, length = FRAME_HEADER.unpack_from(self.buffer,
+                                                    self.readOffset)
+        self.checkFrameLength(length)
+        start = self.readOffset + FRAME_HEADER.size
+        if self.writeOffset - start < length:
+            self.scanOffset = self.readOffset
+            return False
+        self.readOffset = self.scanOffset = start + length
+        self.handleBinaryFrame(flags, view[start:start + length])
+        return True
+
+    def checkFrameLength(self, length):
+        if self.maxFrame is not None and length > self.maxFrame:
+            raise ProtocolError(f'Received a frame of {length} bytes, over '
+                                f'the limit of {self.maxFrame}.')
+
+    def reserveBuffer(self):
+        'Makes room for at least recvSize bytes after writeOffset.'
+        if len(self.buffer) - self.writeOffset >= self.recvSize:
+            return
+        if self.readOffset > 0:
+            # Move the unconsumed tail to the front.
+            pending = self.writeOffset - self.readOffset
+            self.buffer[:pending] = self.buffer[self.readOffset:
+                                                self.writeOffset]
+            self.scanOffset -= self.readOffset
+            self.readOffset = 0
+            self.writeOffset = pending
+        shortfall = self.recvSize - (len(self.buffer) - self.writeOffset)
+        if shortfall > 0:
+            self.buffer.extend(bytes(max(shortfall, len(self.buffer))))
+
+    def setCodec(self, name):
+        'Switches outgoing frames to a negotiated codec. None for JSON.'
+        self.codec = CODECS_BY_NAME[name] if name is not None else None
+
+    def setCompression(self, name, level=6):
+        '''
+        Starts a fresh deflate stream for outgoing binary frames. None turns
+        compression off. Only takes effect once a codec is set.
+        '''
+        with self.sendLock:
+            self.compression = name
+            if name == 'zlib':
+                self.compressor = zlib.compressobj(level)
+                self.compressorIsNew = True
+            else:
+                self.compressor = None
+
+    def encodeFrame(self, event, data=None, session=None):
+        'Must be called with sendLock held once compression is on.'
+        message = {'type': event, 'data': data}
+        if session is not None:
+            message['session'] = session
+        if self.codec is None:
+            return json.dumps(message).encode('utf-8') + b'\n'
+        payload = self.codec.encode(message)
+        flags = self.codec.codecId
+        if self.compressor is not None and \
+                len(payload) >= self.compressMinSize:
+            payload = self.compressor.compress(payload) + \
+                self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            flags |= FLAG_COMPRESSED
+            if self.compressorIsNew:
+                flags |= FLAG_NEW_STREAM
+                self.compressorIsNew = False
+        return FRAME_HEADER.pack(FRAME_MAGIC, flags, len(payload)) + payload
+
+    def fire(self, event, data=None, session=None):
         if not self.connected:
             return
-        message = json.dumps({'type': event, 'data': data})
         try:
-            self.conn.send(message.encode('utf-8') + b'\n')
+            with self.sendLock:
+                frame = self.encodeFrame(event, data, session=session)
+                self.send(frame)
+            if metrics.collector is not None:
+                metrics.collector.eventSent(event, len(frame))
         except Exception:
             pass
 
+    def send(self, frame):
+        'Override this'
+        raise NotImplementedError()
+
+    def close(self):
+        'Override this'
+        raise NotImplementedError()
+
+
+class Session(EventTarget):
+    '''
+    One conversation multiplexed over a Connection. Every frame carries the
+    sessionId, so many tests can share one socket and one receive loop. It
+    has the same event API as a Connection; close only ends the session.
+    '''
+
+    def __init__(self, connection, sessionId) -> None:
+        super().__init__()
+        self.connection = connection
+        self.sessionId = sessionId
+        # Hooks added to either apply to both.
+        self.dispatchHooks = connection.dispatchHooks
+
+    def start(self):
+        'The parent connection receives for us; nothing to start.'
+
+    def fire(self, event, data=None):
+        if not self.connected:
+            return
+        self.connection.fire(event, data, session=self.sessionId)
+
+    def setCodec(self, name):
+        self.connection.setCodec(name)
+
+    def setCompression(self, name):
+        # Keep the connection's deflate history across sessions.
+        if self.connection.compression != name:
+            self.connection.setCompression(name)
+
     def close(self):
+        self.connection.closeSession(self)
+
+    def detach(self):
+        'Drops every listener and waiter once the session has ended.'
+        self.connected = False
+        self.eventHandlers = {}
+        self.pastEvents = {}
+        self.failWaiters()
+
+
+class Connection(BaseConnection):
+    def __init__(self, conn, initialBuffer=b'', recvSize=65536,
+                 compressMinSize=32, maxFrame=MAX_FRAME) -> None:
+        super().__init__(initialBuffer=initialBuffer, recvSize=recvSize,
+                         compressMinSize=compressMinSize, maxFrame=maxFrame)
+        self.conn = conn
+        # Events are small and latency bound; do not let Nagle hold them
+        # back waiting for delayed ACKs.
         try:
-            self.conn.close()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         except Exception:
             pass
 
-    def preLocalFire(self, event, data):
-        if event in self.waitEvents:
-            captured = self.waitEvents[event]['captured']
-            waiterId = self.waitEvents[event]['id']
-            self.waiter[waiterId] = data
-            del self.waitEvents[event]
-            if captured:
-                return False
+    def start(self):
+        t = threading.Thread(target=self.recvLoop)
+        t.setDaemon(True)
+        t.start()
+
+    def receive(self):
+        'Receives once into the buffer. Returns False once disconnected.'
+        self.reserveBuffer()
+        try:
+            with memoryview(self.buffer) as view:
+                size = self.conn.recv_into(view[self.writeOffset:],
+                                           self.recvSize)
+        except OSError:
+            self.close()
+            return False
+        if size == 0:
+            return False
+        self.writeOffset += size
         return True
 
-    def waitFor(self, event, capture=True):
-        if event in self.waitEvents:
-            logging.warning('Already waiting for event:', event)
+    def dispatchReceived(self):
+        '''
+        Dispatches every complete frame received. A listener that raises
+        closes the connection, so the peer does not wait on it forever.
+        '''
+        try:
+            self.handleBufferContent()
+        except ProtocolError as e:
+            logging.warning(f'Closing the connection: {e}')
+            self.close()
+            self.disconnected()
+            return False
+        except Exception:
+            logging.exception('An event listener failed; closing the \
+connection.')
+            self.close()
+            self.disconnected()
+            return False
+        return True
+
+    def disconnected(self):
+        self.connected = False
+        self.localFire('disconnect', None)
+
+    def pump(self):
+        '''
+        Receives and dispatches once. Use this instead of start to drive the
+        connection from your own select loop. Returns False once
+        disconnected.
+        '''
+        if not self.receive():
+            logging.debug('Connection closed.')
+            self.disconnected()
+            return False
+        return self.dispatchReceived()
+
+    def recvLoop(self):
+        if not self.dispatchReceived():
             return
-        waiterId = secrets.token_hex(8)
-        self.waitEvents[event] = {
-            'id': waiterId,
-            'captured': capture
-        }
-        while waiterId not in self.waiter and self.connected:
-            time.sleep(0.05)
-        if waiterId not in self.waiter:
-            raise Disconnected("Disconnected.")
+        while self.pump():
+            pass
 
-        data = self.waiter[waiterId]
-        del self.waiter[waiterId]
-        return data
+    def send(self, frame):
+        self.conn.sendall(frame)
+
+    def close(self):
+        try:
+            self.conn.close()
+        except Exception:
+            pass
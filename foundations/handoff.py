@@ -0,0 +1,304 @@
+import concurrent.futures
+import functools
+import logging
+import os
+import socket
+import threading
+import time
+
+from .connection import Connection, Session
+from .tasks.shared import SHARED_METHODS, SharedTask
+
+# Threads the new server answers the old one's task calls on.
+CALL_THREADS = 16
+# Exceptions of task calls that are raised again on the calling side.
+CALL_ERRORS = {error.__name__: error for error in
+               (ValueError, KeyError, IndexError, LookupError)}
+
+
+class ConnectionTracker():
+    '''
+    Keeps the connections a server has open, so they can be drained. Only
+    clients that said so in their hello know to reconnect when asked.
+    '''
+
+    def __init__(self):
+        self.connections = set()
+        self.reconnecting = set()
+        self.condition = threading.Condition()
+
+    def add(self, connection):
+        with self.condition:
+            self.connections.add(connection)
+        connection.registerEventListener(
+            'disconnect', lambda _: self.discard(connection))
+
+    def canReconnect(self, target):
+        'target, a connection or one of its sessions, handles reconnect.'
+        connection = target.connection if isinstance(target, Session) \
+            else target
+        with self.condition:
+            if connection in self.connections:
+                self.reconnecting.add(connection)
+
+    def discard(self, connection):
+        with self.condition:
+            self.connections.discard(connection)
+            self.reconnecting.discard(connection)
+            self.condition.notify_all()
+
+    def drain(self, timeout):
+        '''
+        Asks every client to reconnect once its current test is done, and
+        waits up to timeout seconds for those that can to go. Older clients
+        keep their connection for the whole run, so they are waited for
+        until they close it, however long that takes. Returns how many of
+        the clients that can reconnect stayed.
+        '''
+        with self.condition:
+            connections = list(self.connections)
+        # From this thread: AsyncConnection passes sends from other threads
+        # to its event loop.
+        for connection in connections:
+            connection.fire('reconnect')
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.reconnecting and time.monotonic() < deadline:
+                self.condition.wait(deadline - time.monotonic())
+            stayed = len(self.reconnecting)
+            legacy = len(self.connections) - stayed
+        if legacy:
+            logging.info(f'Waiting for {legacy} connections of clients '
+                         f'that cannot reconnect to close.')
+        with self.condition:
+            while len(self.connections) > len(self.reconnecting):
+                self.condition.wait()
+        return stayed
+
+
+class RecordForwarder():
+    '''
+    Takes the place of the journal of a task once it has been handed over,
+    so the changes of the tests still running on the old server when it did
+    are replayed by the new one.
+    '''
+
+    def __init__(self, connection, taskId):
+        self.connection = connection
+        self.taskId = taskId
+
+    def append(self, record, task):
+        '''
+        Called with the locks of what record changes held, which keeps the
+        records about any one input or worker in order.
+        '''
+        self.connection.fire('record', {
+            'taskId': self.taskId,
+            'record': record
+        })
+
+    def sync(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SuccessorProxy():
+    '''
+    Calls the methods of a task on the server that took over. Once a task is
+    handed over, the old server serves it through a SharedTask of these, so
+    the new server alone makes inputs and hands out tests and neither order
+    can drift apart.
+    '''
+
+    def __init__(self, connection, taskId):
+        self.connection = connection
+        self.taskId = taskId
+        for name in SHARED_METHODS:
+            setattr(self, name, functools.partial(self.call, name))
+
+    def call(self, method, *args, **kwargs):
+        response = self.connection.request('task-call', {
+            'taskId': self.taskId,
+            'method': method,
+            'args': args,
+            'kwargs': kwargs
+        }, 'task-result')
+        if 'error' in response:
+            raise CALL_ERRORS.get(response['errorType'], RuntimeError)(
+                response['error'])
+        return response['result']
+
+
+class HandoffListener():
+    '''
+    Waits on a Unix socket at path for a newer server to take over. The
+    newer server is sent the listening socket, then the state of every task,
+    while this server stops accepting and drains its connections. From then
+    on the tests it still hands out are made by calls to the newer server,
+    and the changes of those that were running are forwarded to it. See
+    takeOver for the other end.
+
+    stopAccepting is called once the listening socket has been handed over.
+    '''
+
+    def __init__(self, path, listener, tasks, connections, stopAccepting,
+                 drainTimeout=300):
+        self.path = path
+        self.listener = listener
+        self.tasks = tasks
+        self.connections = connections
+        self.stopAccepting = stopAccepting
+        self.drainTimeout = drainTimeout
+        self.drained = threading.Event()
+        if os.path.exists(path):
+            os.unlink(path)
+        self.control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.control.bind(path)
+        self.control.listen(1)
+        thread = threading.Thread(target=self.acceptLoop, daemon=True,
+                                  name='Handoff')
+        thread.start()
+        logging.info(f'Waiting for a newer server at {path}.')
+
+    def acceptLoop(self):
+        while True:
+            successor, _ = self.control.accept()
+            try:
+                socket.send_fds(successor, [b'L'], [self.listener.fileno()])
+            except OSError:
+                logging.exception('Failed to hand over the listening socket.')
+                successor.close()
+                continue
+            break
+        # The newer server listens at path from now on.
+        self.control.close()
+        # Task states are sent whole, in frames of any size.
+        connection = Connection(successor, maxFrame=None)
+        # Not on the receive thread, which must keep reading the answers to
+        # the calls made while draining.
+        connection.registerEventListener(
+            'handoff', lambda _: threading.Thread(
+                target=self.handOver, args=(connection,), daemon=True,
+                name='Drain').start())
+        connection.start()
+
+    def handOver(self, connection):
+        startedAt = time.monotonic()
+        self.stopAccepting()
+        for taskId, task in list(self.tasks.items()):
+            if not hasattr(task, 'snapshotState'):
+                continue
+            proxy = SuccessorProxy(connection, taskId)
+            with task.writeLock:
+                if task.journal is not None:
+                    task.journal.close()
+                task.journal = RecordForwarder(connection, taskId)
+                connection.fire('task-state', {
+                    'taskId': taskId,
+                    'state': task.snapshotState()
+                })
+                # Runners that looked the task up just before still work on
+                # it here, but copy any input they need from the new server.
+                task.inputSource = proxy
+                self.tasks[taskId] = SharedTask(task, proxy)
+        connection.fire('ready')
+        logging.info(f'Handed over in {time.monotonic() - startedAt:.3f}s; '
+                     f'draining {len(self.connections.connections)} '
+                     f'connections.')
+        remaining = self.connections.drain(self.drainTimeout)
+        if remaining:
+            logging.warning(f'Gave up on {remaining} connections that did '
+                            f'not drain in {self.drainTimeout}s.')
+        connection.fire('drained')
+        self.drained.set()
+
+
+def applyHandedOverRecord(task, record):
+    '''
+    Replays a change made by the old server while it drained. Only tests
+    that were running there when it handed over change anything there, and
+    admin commands among them are applied as they are. A runner that looked
+    the task up just before may still hand out tests there, though, and this
+    server hands out tests too by then, so those only move progress forward.
+    '''
+    if record['op'] != 'progress' or not record.get('allocated'):
+        task.applyRecord(record)
+        return
+    with task.locks.workers:
+        if task.workerProgress.get(record['workerId'], 0) <= \
+                record['progress']:
+            task.applyRecord(record)
+
+
+def takeOver(path, tasks, onReady, timeout=60):
+    '''
+    Takes over from the server waiting at path: loads the state of its tasks,
+    calls onReady, and returns its listening socket. Changes the old server
+    makes while it drains keep being applied in the background.
+    '''
+    control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    control.connect(path)
+    _, fds, _, _ = socket.recv_fds(control, 1, 1)
+    if not fds:
+        raise RuntimeError('The old server did not send its socket.')
+    listener = socket.socket(fileno=fds[0])
+    ready = threading.Event()
+    handedOver = threading.Event()
+    calls = concurrent.futures.ThreadPoolExecutor(
+        CALL_THREADS, thread_name_prefix='Handoff')
+
+    def onTaskState(data):
+        if data['taskId'] in tasks:
+            tasks[data['taskId']].loadState(data['state'])
+        else:
+            logging.warning(f'Dropped the state of {data["taskId"]}, which '
+                            f'this server does not have.')
+
+    def onHandedOver(_):
+        onReady()
+        handedOver.set()
+        ready.set()
+
+    def onRecord(data):
+        if data['taskId'] in tasks:
+            applyHandedOverRecord(tasks[data['taskId']], data['record'])
+
+    def onTaskCall(data):
+        # Calls may wait, on an input say, so the records and calls that
+        # follow are not held up behind them.
+        calls.submit(callTask, data)
+
+    def callTask(data):
+        response = {'requestId': data.get('requestId')}
+        try:
+            if data['method'] not in SHARED_METHODS:
+                raise ValueError(f'{data["method"]} cannot be called.')
+            method = getattr(tasks[data['taskId']], data['method'])
+            response['result'] = method(*data['args'], **data['kwargs'])
+        except Exception as e:
+            response['error'] = str(e)
+            response['errorType'] = type(e).__name__
+        connection.fire('task-result', response)
+
+    def onDisconnect(_):
+        for task in tasks.values():
+            if hasattr(task, 'endReplay'):
+                task.endReplay()
+        calls.shutdown(wait=False)
+        ready.set()
+
+    connection = Connection(control, maxFrame=None)
+    connection.registerEventListener('task-state', onTaskState)
+    connection.registerEventListener('ready', onHandedOver)
+    connection.registerEventListener('record', onRecord)
+    connection.registerEventListener('task-call', onTaskCall)
+    connection.registerEventListener('drained', lambda _: logging.info(
+        'The old server has drained.'))
+    connection.registerEventListener('disconnect', onDisconnect)
+    connection.start()
+    connection.fire('handoff')
+    if not ready.wait(timeout) or not handedOver.is_set():
+        raise RuntimeError('The old server did not hand over its state.')
+    return listener
@@ -0,0 +1,213 @@
+import bisect
+import http.server
+import logging
+import threading
+
+from . import tracing
+
+# Upper bounds of the histogram buckets: seconds spent in event handlers,
+# and bytes of frames and outputs.
+LATENCY_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]
+SIZE_BUCKETS = [64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304]
+
+# The Metrics being collected, or None while metrics are off. The hooks in
+# Connection.fire and SimpleTaskRunner check this first, so they cost a
+# global lookup when metrics are off; received events are counted by a
+# dispatch hook, see tracing.
+collector = None
+
+
+def labelValue(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"') \
+        .replace('\n', r'\n')
+
+
+class Histogram():
+    'Observations in cumulative buckets, as Prometheus expects, per label.'
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.series = {}  # label -> [[count per bucket, +Inf last], sum]
+
+    def observe(self, label, value):
+        'Called with the lock of the Metrics held.'
+        series = self.series.get(label)
+        if series is None:
+            series = self.series[label] = [[0] * (len(self.bounds) + 1), 0]
+        series[0][bisect.bisect_left(self.bounds, value)] += 1
+        series[1] += value
+
+    def render(self, name, labelName, lines):
+        for label, (counts, total) in sorted(self.series.items()):
+            labels = f'{labelName}="{labelValue(label)}"'
+            cumulative = 0
+            for bound, count in zip(self.bounds + ['+Inf'], counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} '
+                             f'{cumulative}')
+            lines.append(f'{name}_sum{{{labels}}} {total}')
+            lines.append(f'{name}_count{{{labels}}} {cumulative}')
+
+
+class Metrics():
+    '''
+    Counts what the hooks report: events received (with the time their
+    handlers took) and sent (with the size of their frames), and tests
+    completed per task. Gauges are read from the server when scraped: active
+    connections and threads, and the input pool and estimated memory of
+    each task that keeps statistics.
+
+    tasks is the dict of taskId -> task the server serves, and connections
+    its ConnectionTracker, if any. Only the process that holds the state of
+    the tasks should reportTasks.
+    '''
+
+    def __init__(self, tasks=None, connections=None, reportTasks=True):
+        self.lock = threading.Lock()
+        self.tasks = tasks if tasks is not None else {}
+        self.connections = connections
+        self.reportTasks = reportTasks
+        self.received = {}  # event -> count
+        self.sent = {}  # event -> count
+        self.handlerSeconds = Histogram(LATENCY_BUCKETS)  # per event
+        self.frameBytes = Histogram(SIZE_BUCKETS)  # per event sent
+        self.tests = {}  # taskId -> count
+        self.outputBytes = Histogram(SIZE_BUCKETS)  # per taskId
+
+    def eventReceived(self, target, event, size, seconds):
+        'A dispatch hook.'
+        with self.lock:
+            self.received[event] = self.received.get(event, 0) + 1
+            self.handlerSeconds.observe(event, seconds)
+
+    def eventSent(self, event, size):
+        with self.lock:
+            self.sent[event] = self.sent.get(event, 0) + 1
+            self.frameBytes.observe(event, size)
+
+    def testCompleted(self, task, outputSize):
+        taskId = self.taskIdOf(task)
+        with self.lock:
+            self.tests[taskId] = self.tests.get(taskId, 0) + 1
+            self.outputBytes.observe(taskId, outputSize)
+
+    def taskIdOf(self, task):
+        for taskId, candidate in self.tasks.items():
+            if candidate is task:
+                return taskId
+        return 'unknown'
+
+    def render(self):
+        'Returns every metric in the Prometheus text format.'
+        lines = []
+
+        def metric(name, kind, description):
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        if self.connections is not None:
+            metric('autotest_connections_active', 'gauge',
+                   'Connections open to this process.')
+            lines.append(f'autotest_connections_active '
+                         f'{len(self.connections.connections)}')
+        metric('autotest_threads_active', 'gauge',
+               'Threads running in this process.')
+        lines.append(f'autotest_threads_active {threading.active_count()}')
+
+        with self.lock:
+            counters = [
+                ('autotest_events_received_total', 'event', self.received,
+                 'Events dispatched to listeners, by type.'),
+                ('autotest_events_sent_total', 'event', self.sent,
+                 'Events sent to peers, by type.'),
+                ('autotest_tests_total', 'task', self.tests,
+                 'Tests completed, by task.')
+            ]
+            for name, labelName, values, description in counters:
+                metric(name, 'counter', description)
+                for label, value in sorted(values.items()):
+                    lines.append(f'{name}{{{labelName}='
+                                 f'"{labelValue(label)}"}} {value}')
+            histograms = [
+                ('autotest_event_handler_seconds', 'event',
+                 self.handlerSeconds,
+                 'Time spent in the listeners of an event, by type.'),
+                ('autotest_event_frame_bytes', 'event', self.frameBytes,
+                 'Size of the frames sent, by event type. event="report" '
+                 'gives the size of reports.'),
+                ('autotest_test_output_bytes', 'task', self.outputBytes,
+                 'Length of the output of each completed test, by task.')
+            ]
+            for name, labelName, histogram, description in histograms:
+                metric(name, 'histogram', description)
+                histogram.render(name, labelName, lines)
+
+        if self.reportTasks:
+            self.renderTasks(lines, metric)
+        return '\n'.join(lines) + '\n'
+
+    def renderTasks(self, lines, metric):
+        aggregates = {}
+        for taskId, task in self.tasks.items():
+            if not hasattr(task, 'statisticsAggregate'):
+                continue
+            try:
+                aggregates[taskId] = task.statisticsAggregate(
+                    ['inputPool', 'memory'])
+            except Exception:
+                logging.exception(f'Failed to read metrics of {taskId}.')
+        metric('autotest_input_pool_ready', 'gauge',
+               'Inputs generated ahead of time and waiting, by task.')
+        for taskId, aggregate in aggregates.items():
+            lines.append(f'autotest_input_pool_ready{{task="{taskId}"}} '
+                         f'{aggregate["inputPool"]["ready"]}')
+        metric('autotest_input_pool_target', 'gauge',
+               'Inputs the input pool tries to keep ready, by task.')
+        for taskId, aggregate in aggregates.items():
+            lines.append(f'autotest_input_pool_target{{task="{taskId}"}} '
+                         f'{aggregate["inputPool"]["target"]}')
+        metric('autotest_task_memory_bytes', 'gauge',
+               'Estimated size of the state of a task, by part.')
+        for taskId, aggregate in aggregates.items():
+            for part, size in aggregate['memory'].items():
+                # Summing the parts gives the total.
+                if part == 'total':
+                    continue
+                lines.append(f'autotest_task_memory_bytes{{task="{taskId}",'
+                             f'part="{part}"}} {size}')
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics' or collector is None:
+            self.send_error(404)
+            return
+        body = collector.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type',
+                         'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('Metrics: ' + format % args)
+
+
+def enable(port, host='127.0.0.1', tasks=None, connections=None,
+           reportTasks=True):
+    '''
+    Starts collecting metrics and serves them at http://host:port/metrics
+    from a background thread. Returns the Metrics.
+    '''
+    global collector
+    metrics = Metrics(tasks, connections, reportTasks)
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True,
+                     name='Metrics').start()
+    collector = metrics
+    tracing.addDispatchHook(after=metrics.eventReceived)
+    logging.info(f'Serving metrics at http://{host}:{port}/metrics.')
+    return metrics
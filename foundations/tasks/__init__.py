@@ -1,2 +1,3 @@
 from .generics import GenericTask, GenericTaskRunner, GenericTaskApi
+from .similarity import ExactEngine, MinHashEngine
 from .simpletask import SimpleTask, SimpleTaskRunner, SimpleTaskApi
@@ -0,0 +1,53 @@
+import collections
+import sys
+import threading
+
+
+class InputCache():
+    '''
+    A least-recently-used cache of regenerated input text, bounded by the
+    bytes the text it holds takes in memory rather than by a number of
+    entries. That is as sys.getsizeof counts them, so text outside Latin-1
+    counts two or four bytes a character, as Python stores it.
+    '''
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.bytes = 0
+        self.entries = collections.OrderedDict()  # inputId -> text
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, inputId):
+        with self.lock:
+            text = self.entries.get(inputId)
+            if text is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(inputId)
+            self.hits += 1
+            return text
+
+    def peek(self, inputId):
+        'Like get, without counting or refreshing the entry.'
+        with self.lock:
+            return self.entries.get(inputId)
+
+    def put(self, inputId, text):
+        size = sys.getsizeof(text)
+        if size > self.maxBytes:
+            return
+        with self.lock:
+            if inputId in self.entries:
+                self.bytes -= sys.getsizeof(self.entries.pop(inputId))
+            self.entries[inputId] = text
+            self.bytes += size
+            while self.bytes > self.maxBytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= sys.getsizeof(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
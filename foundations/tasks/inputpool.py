@@ -0,0 +1,79 @@
+import collections
+import logging
+import threading
+
+
+class GenerationFailed():
+    'Stands in the queue for an input whose generation raised.'
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class InputPool():
+    '''
+    Keeps a bounded queue of inputs generated ahead of time by background
+    threads, so that handing a worker a new input only pops the queue.
+    generate(n) returns a list of n inputs; the queue is topped up with up
+    to batchSize of them at once.
+
+    The queue starts small and doubles (up to maxSize) whenever a taker
+    finds it empty, so a task that is rarely asked for new inputs does not
+    generate many that nobody uses.
+    '''
+
+    def __init__(self, generate, maxSize=32, workers=1, initialSize=2,
+                 batchSize=16):
+        self.generate = generate
+        self.batchSize = max(1, batchSize)
+        self.maxSize = max(1, maxSize)
+        self.target = max(1, min(initialSize, self.maxSize))
+        self.ready = collections.deque()
+        self.pending = 0
+        self.condition = threading.Condition()
+        self.threads = []
+        for i in range(max(1, workers)):
+            thread = threading.Thread(target=self.fillLoop, daemon=True,
+                                      name=f'InputPool-{i}')
+            thread.start()
+            self.threads.append(thread)
+
+    def fillLoop(self):
+        while True:
+            with self.condition:
+                while len(self.ready) + self.pending >= self.target:
+                    self.condition.wait()
+                count = min(self.batchSize,
+                            self.target - len(self.ready) - self.pending)
+                self.pending += count
+            try:
+                newInputs = self.generate(count)
+            except Exception as e:
+                logging.exception('Failed to generate inputs.')
+                newInputs = [GenerationFailed(e)]
+            with self.condition:
+                self.pending -= count
+                self.ready.extend(newInputs)
+                self.condition.notify_all()
+
+    def take(self):
+        'Returns a ready input, waiting for one if none is.'
+        with self.condition:
+            if not self.ready:
+                self.target = min(self.maxSize, self.target * 2)
+                logging.debug(f'Input pool ran dry; now keeping '
+                              f'{self.target} ready.')
+                self.condition.notify_all()
+                while not self.ready:
+                    self.condition.wait()
+            newInput = self.ready.popleft()
+            self.condition.notify_all()
+        if isinstance(newInput, GenerationFailed):
+            raise newInput.exception
+        return newInput
+
+    def putBack(self, newInput):
+        'Returns an input that was taken but not used.'
+        with self.condition:
+            self.ready.appendleft(newInput)
+            self.condition.notify_all()
@@ -0,0 +1,46 @@
+import threading
+
+
+class TaskLocks():
+    '''
+    The locks of a SimpleTask, so that results for different inputs can be
+    recorded at the same time.
+
+    workers guards progress and the counters; inputs guards the order of
+    inputs; each input's own results, clusters and ranking are guarded by
+    one of stripes, picked by hashing its inputId. Outputs, the similarity
+    engine and the journal have leaf locks of their own, which never wait
+    on another lock.
+
+    To rule out deadlocks, locks are always taken in this order: workers,
+    inputs, stripes in ascending order, then leaf locks. A thread holding a
+    stripe may only take leaf locks. Use the TaskLocks itself to take every
+    lock but the leaves, e.g. to copy or replace the whole state.
+    '''
+
+    def __init__(self, stripes=64):
+        self.workers = threading.RLock()
+        self.inputs = threading.RLock()
+        self.stripes = [threading.RLock() for _ in range(max(1, stripes))]
+
+    def forInput(self, inputId):
+        return self.stripes[hash(inputId) % len(self.stripes)]
+
+    def acquire(self):
+        self.workers.acquire()
+        self.inputs.acquire()
+        for stripe in self.stripes:
+            stripe.acquire()
+
+    def release(self):
+        for stripe in reversed(self.stripes):
+            stripe.release()
+        self.inputs.release()
+        self.workers.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
@@ -0,0 +1,234 @@
+import logging
+import os
+import re
+import threading
+import time
+
+from ..codecs import CODECS_BY_NAME
+
+# Journal records and snapshots are plain JSON, written with orjson when it
+# is installed.
+CODEC = CODECS_BY_NAME.get('orjson', CODECS_BY_NAME['json'])
+JOURNAL_PATTERN = re.compile(r'^journal\.(\d+)\.log$')
+
+
+class TaskJournal():
+    '''
+    Keeps the state of a task in directory as a snapshot plus a write-ahead
+    journal of the changes made since.
+
+    Every change is appended to journal.<generation>.log as one JSON line
+    before the change is acknowledged. Every snapshotEvery records the state
+    is copied, the journal moves on to the next generation and the copy is
+    written to snapshot.json in the background. The snapshot records the
+    first generation it does not cover, so older journals can be removed.
+
+    fsyncInterval bounds how many seconds of changes may be lost when the
+    machine (not just the server) goes down: 0 syncs every record before the
+    change is acknowledged, None leaves it to the operating system. With 0,
+    records appended at the same time share one fsync.
+    '''
+
+    def __init__(self, directory, snapshotEvery=10000, fsyncInterval=1.0):
+        self.directory = directory
+        self.snapshotEvery = snapshotEvery
+        self.fsyncInterval = fsyncInterval
+        self.generation = 0
+        self.records = 0
+        self.lastSync = time.monotonic()
+        self.file = None
+        self.snapshotThread = None
+        self.snapshotDue = False
+        # Records are appended from threads holding different locks of the
+        # task.
+        self.lock = threading.Lock()
+        # Taken before lock, by whoever is syncing on behalf of the others.
+        self.syncLock = threading.Lock()
+        self.written = 0
+        self.synced = 0
+        # The last record each thread appended and has yet to sync.
+        self.pending = threading.local()
+        os.makedirs(directory, exist_ok=True)
+
+    def journalPath(self, generation):
+        return os.path.join(self.directory, f'journal.{generation}.log')
+
+    def snapshotPath(self):
+        return os.path.join(self.directory, 'snapshot.json')
+
+    def journalGenerations(self):
+        generations = []
+        for name in os.listdir(self.directory):
+            match = JOURNAL_PATTERN.match(name)
+            if match:
+                generations.append(int(match.group(1)))
+        return sorted(generations)
+
+    def restore(self, task):
+        'Loads the snapshot and replays the journals after it into task.'
+        startedAt = time.monotonic()
+        generation = 0
+        if os.path.exists(self.snapshotPath()):
+            with open(self.snapshotPath(), 'rb') as file:
+                snapshot = CODEC.decode(file.read())
+            task.loadState(snapshot['state'])
+            generation = snapshot['generation']
+
+        replayed = 0
+        generations = [g for g in self.journalGenerations()
+                       if g >= generation]
+        for g in generations:
+            with open(self.journalPath(g), 'rb') as file:
+                lines = file.read().split(b'\n')
+            for i, line in enumerate(lines):
+                if not line:
+                    continue
+                try:
+                    record = CODEC.decode(line)
+                except ValueError:
+                    # Only the last record can be torn by a crash.
+                    if i < len(lines) - 1 and any(lines[i + 1:]):
+                        raise
+                    logging.warning(f'Dropped a torn record at the end of '
+                                    f'{self.journalPath(g)}.')
+                    break
+                task.applyRecord(record)
+                replayed += 1
+
+        # Start a fresh generation, so a torn tail is never appended to.
+        self.generation = max([generation] + generations) + 1
+        self.file = open(self.journalPath(self.generation), 'ab',
+                         buffering=0)
+        logging.info(f'Restored {self.directory} from generation '
+                     f'{generation} and {replayed} journal records in '
+                     f'{time.monotonic() - startedAt:.3f}s.')
+        if replayed > 0:
+            self.snapshot(task)
+
+    def adopt(self, task):
+        '''
+        Starts journaling task, whose state came from elsewhere, in place of
+        whatever directory holds. The state is snapshotted before returning.
+        '''
+        self.generation = max([0] + self.journalGenerations()) + 1
+        self.file = open(self.journalPath(self.generation), 'ab',
+                         buffering=0)
+        self.writeSnapshot(task.snapshotState(), self.generation)
+
+    def append(self, record, task):
+        '''
+        Called with the locks of what record changes held. With an
+        fsyncInterval of 0, call sync once they are released.
+        '''
+        line = CODEC.encode(record) + b'\n'
+        with self.lock:
+            self.file.write(line)
+            self.written += 1
+            position = self.written
+            if self.fsyncInterval:
+                now = time.monotonic()
+                if now - self.lastSync >= self.fsyncInterval:
+                    os.fsync(self.file.fileno())
+                    self.lastSync = now
+            self.records += 1
+            due = self.records >= self.snapshotEvery and \
+                not self.snapshotDue and (self.snapshotThread is None or
+                                          not self.snapshotThread.is_alive())
+            if due:
+                self.snapshotDue = True
+        if self.fsyncInterval == 0:
+            self.pending.position = position
+        if due:
+            # Copying the state takes every lock of the task, which only a
+            # thread holding none of them may do.
+            threading.Thread(target=self.snapshotLocked, args=(task,),
+                             daemon=True).start()
+
+    def sync(self):
+        'Waits until the records this thread appended are on disk.'
+        position = getattr(self.pending, 'position', 0)
+        if position:
+            self.pending.position = 0
+            self.syncTo(position)
+
+    def syncTo(self, position):
+        'Makes sure the first position records are on disk.'
+        with self.syncLock:
+            if self.synced >= position:
+                return
+            with self.lock:
+                # Closed meanwhile, which synced every record.
+                if self.file is None:
+                    return
+                target = self.written
+                fileno = self.file.fileno()
+            # Records written meanwhile wait for the next sync.
+            os.fsync(fileno)
+            self.synced = target
+
+    def snapshotLocked(self, task):
+        with task.writeLock:
+            # Unless the journal was closed meanwhile.
+            if self.file is not None:
+                self.snapshot(task)
+        self.snapshotDue = False
+
+    def snapshot(self, task):
+        '''
+        Copies the state of task and writes it in the background. Called with
+        the writeLock of task held, so no change slips between the copy and
+        the journal rotation.
+        '''
+        if self.snapshotThread is not None and \
+                self.snapshotThread.is_alive():
+            return
+        state = task.snapshotState()
+        self.rotate()
+        self.records = 0
+        self.snapshotThread = threading.Thread(
+            target=self.writeSnapshot, args=(state, self.generation),
+            daemon=True)
+        self.snapshotThread.start()
+
+    def rotate(self):
+        with self.syncLock, self.lock:
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.generation += 1
+            self.file = open(self.journalPath(self.generation), 'ab',
+                             buffering=0)
+            self.lastSync = time.monotonic()
+            self.synced = self.written
+
+    def writeSnapshot(self, state, generation):
+        startedAt = time.monotonic()
+        temporaryPath = self.snapshotPath() + '.tmp'
+        with open(temporaryPath, 'wb') as file:
+            file.write(CODEC.encode({
+                'generation': generation,
+                'state': state
+            }))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporaryPath, self.snapshotPath())
+        for g in self.journalGenerations():
+            if g < generation:
+                os.remove(self.journalPath(g))
+        logging.debug(f'Wrote snapshot of {self.directory} at generation '
+                      f'{generation} in {time.monotonic() - startedAt:.3f}s.')
+
+    def close(self):
+        '''
+        Syncs and closes the journal once the snapshot being written and any
+        sync under way are done. Later syncs return at once. A snapshot due
+        but not started yet takes the writeLock of the task first, so it
+        finds the journal closed.
+        '''
+        if self.snapshotThread is not None:
+            self.snapshotThread.join()
+        with self.syncLock, self.lock:
+            if self.file is not None:
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
+                self.synced = self.written
@@ -0,0 +1,78 @@
+import logging
+import time
+from multiprocessing.managers import BaseManager
+
+from .simpletask import SimpleTask
+
+# The SimpleTask methods that runners and APIs call. In multi-process mode
+# these are forwarded to the process that holds the state.
+SHARED_METHODS = [
+    'awaitInput', 'inputIdAt', 'inputCount', 'hasInput', 'getInput',
+    'allocateProgress', 'releaseProgress', 'setProgress', 'completeTest',
+    'outputCluster', 'statisticsAggregate', 'statisticsPage',
+    'legacyStatistics', 'purgeWorker', 'purgeAll'
+]
+
+
+class TaskStateManager(BaseManager):
+    '''
+    Serves the state of every task from one process over a Unix socket, one
+    thread per client connection. Register the tasks with serveTasks before
+    starting it.
+    '''
+
+
+def serveTasks(tasks):
+    'Makes tasks, a dict of taskId -> SimpleTask, available to clients.'
+    TaskStateManager.register('task', callable=lambda taskId: tasks[taskId],
+                              exposed=SHARED_METHODS)
+
+
+def connectTasks(address, authkey, taskIds, timeout=10):
+    '''
+    Connects to the state process at address and returns a dict of taskId ->
+    proxy. Waits up to timeout seconds for its socket to appear, then for as
+    long as it takes to restore its state before serving.
+    '''
+    TaskStateManager.register('task')
+    manager = TaskStateManager(address=address, authkey=authkey)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            manager.connect()
+            break
+        except (FileNotFoundError, ConnectionRefusedError):
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+    return {taskId: manager.task(taskId) for taskId in taskIds}
+
+
+class SharedTask():
+    '''
+    Stands in for a SimpleTask whose state lives in another process. Runners
+    are built here, against the methods of the proxy, so the connection work
+    stays in this process while every change to the state is made once, in
+    the state process.
+    '''
+
+    def __init__(self, task, proxy):
+        self.proxy = proxy
+        self.taskRunnerClass = task.taskRunnerClass
+        self.apiClass = task.apiClass
+        for name in SHARED_METHODS:
+            setattr(self, name, getattr(proxy, name))
+
+    newTaskRunner = SimpleTask.newTaskRunner
+    newBatchRunner = SimpleTask.newBatchRunner
+    newTaskApi = SimpleTask.newTaskApi
+
+
+def shareTasks(tasks, proxies):
+    'Replaces the SimpleTasks in tasks with SharedTasks, in place.'
+    for taskId, proxy in proxies.items():
+        tasks[taskId] = SharedTask(tasks[taskId], proxy)
+    for taskId, task in tasks.items():
+        if taskId not in proxies:
+            logging.warning(f'{taskId} is not a SimpleTask; each process '
+                            f'keeps its own state for it.')
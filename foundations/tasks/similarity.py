@@ -0,0 +1,119 @@
+import random
+import zlib
+
+# A Mersenne prime above any crc32, for the MinHash permutations.
+PRIME = (1 << 61) - 1
+
+
+class ExactEngine():
+    '''
+    Puts outputs in the same cluster only when they are identical. This is
+    what SimpleTask does unless it is given another engine.
+
+    An engine is told about every cluster that is created (addCluster) or
+    emptied (removeCluster), and is asked which existing cluster a new
+    output belongs to (assign), returning None to start a new one.
+    '''
+
+    def assign(self, inputId, output):
+        return None
+
+    def addCluster(self, inputId, clusterId, output):
+        pass
+
+    def removeCluster(self, inputId, clusterId):
+        pass
+
+    def reset(self):
+        pass
+
+
+class MinHashEngine():
+    '''
+    Puts an output in the most similar existing cluster of the same input,
+    provided their estimated Jaccard similarity is at least threshold.
+
+    Outputs are compared as sets of character shingles, after runs of
+    whitespace are collapsed, so a trailing space or a differently rounded
+    number only changes a few shingles. Each cluster is indexed by the
+    MinHash signature of its first output, split into bands for
+    locality-sensitive hashing: only clusters that share a band with the
+    new output are compared, rather than every output seen so far.
+    '''
+
+    def __init__(self, threshold=0.8, permutations=64, bands=16,
+                 shingleSize=3, seed=1):
+        if permutations % bands != 0:
+            raise ValueError('permutations must be a multiple of bands')
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = permutations // bands
+        self.shingleSize = shingleSize
+        # Fixed, so that replaying a journal rebuilds the same clusters.
+        rng = random.Random(seed)
+        self.permutations = [(rng.randrange(1, PRIME), rng.randrange(PRIME))
+                             for _ in range(permutations)]
+        self.reset()
+
+    def reset(self):
+        self.signatures = {}  # inputId -> clusterId -> signature
+        self.buckets = {}  # inputId -> (band, rows) -> {clusterId}
+        self.lastOutput = None
+        self.lastSignature = None
+
+    def shingles(self, output):
+        text = ' '.join(output.split())
+        if len(text) <= self.shingleSize:
+            return {zlib.crc32(text.encode('utf-8'))}
+        return {zlib.crc32(text[i:i + self.shingleSize].encode('utf-8'))
+                for i in range(len(text) - self.shingleSize + 1)}
+
+    def signature(self, output):
+        # A new cluster is added right after assign failed to place it.
+        if output is self.lastOutput:
+            return self.lastSignature
+        hashes = self.shingles(output)
+        self.lastOutput = output
+        self.lastSignature = tuple(min((a * h + b) % PRIME for h in hashes)
+                                   for a, b in self.permutations)
+        return self.lastSignature
+
+    def bandKeys(self, signature):
+        return [(band, signature[band * self.rows:(band + 1) * self.rows])
+                for band in range(self.bands)]
+
+    def assign(self, inputId, output):
+        buckets = self.buckets.get(inputId)
+        if not buckets:
+            return None
+        signature = self.signature(output)
+        candidates = set()
+        for key in self.bandKeys(signature):
+            candidates.update(buckets.get(key, ()))
+        bestClusterId = None
+        bestSimilarity = self.threshold
+        signatures = self.signatures[inputId]
+        for clusterId in sorted(candidates):
+            other = signatures[clusterId]
+            similarity = sum(1 for x, y in zip(signature, other)
+                             if x == y) / len(signature)
+            if similarity >= bestSimilarity:
+                bestClusterId = clusterId
+                bestSimilarity = similarity
+        return bestClusterId
+
+    def addCluster(self, inputId, clusterId, output):
+        signature = self.signature(output)
+        self.signatures.setdefault(inputId, {})[clusterId] = signature
+        buckets = self.buckets.setdefault(inputId, {})
+        for key in self.bandKeys(signature):
+            buckets.setdefault(key, set()).add(clusterId)
+
+    def removeCluster(self, inputId, clusterId):
+        signature = self.signatures[inputId].pop(clusterId)
+        buckets = self.buckets[inputId]
+        for key in self.bandKeys(signature):
+            bucket = buckets[key]
+            bucket.discard(clusterId)
+            if len(bucket) == 0:
+                del buckets[key]
@@ -1,46 +1,776 @@
 from . import GenericTask, GenericTaskRunner, GenericTaskApi
 import secrets
 from ..connection import Connection
+from .. import metrics, tracing
+import hashlib
+import itertools
+import sys
+import time
 from threading import Lock
+from .inputcache import InputCache
+from .inputpool import InputPool
+from .locks import TaskLocks
+from .persistence import TaskJournal
+from .similarity import ExactEngine
+from .statistics import TaskStatistics, MAX_PAGE
+from .vectorised import seededRng, tagSeed
 import logging
 
+# The most tests a client may prefetch in one batch.
+MAX_PREFETCH = 64
+# Reports name the most common outputs, with a few of the workers behind
+# each. The rest can be fetched with get-output-cluster.
+REPORT_TOP_OUTPUTS = 5
+REPORT_WORKER_SAMPLE = 10
+# The most entries get-output-cluster returns at once.
+MAX_CLUSTER_PAGE = 1000
+# Sent instead of a report, as a message so that clients carry on.
+DROPPED_RESULT = 'The input of this test was purged while it ran, so its \
+result was dropped.'
+
 
 class SimpleTask(GenericTask):
-    def __init__(self, taskRunnerClass, apiClass=None):
+    # How many inputs to keep generated ahead of demand, and by how many
+    # background threads. 0 generates each input when it is needed.
+    inputPoolSize = 32
+    inputPoolWorkers = 1
+    # Seeded tasks implement _generateNewInput(rng) using only rng, a
+    # random.Random. Only the seed of each input is kept; its text is
+    # regenerated when needed and cached up to inputCacheBytes.
+    seededInputs = False
+    # Seeded tasks that set this are handed a numpy.random.Generator instead
+    # when NumPy is installed.
+    vectorised = False
+    inputCacheBytes = 16 * 1024 * 1024
+    # How many locks the inputs are spread over, see TaskLocks.
+    inputLockStripes = 64
+
+    def __init__(self, taskRunnerClass, apiClass=None, similarityEngine=None):
         self.inputIdInOrder = []  # [inputId], in order
-        self.inputIdToInput = {}  # inputId -> input
-        self.inputIdToOutputToWorkerIds = {}  # inputId -> output -> [workerID]
-        self.workerIdToInputIdToOutput = {}  # workerId -> inputId -> output
+        self.inputIdToInput = {}  # inputId -> input, or its seed
+        # Outputs are stored once, keyed by their hash; the indexes below
+        # only hold the (interned) outputId.
+        self.outputIdToOutput = {}  # outputId -> output
+        self.outputIdRefs = {}  # outputId -> number of results using it
+        # Journals name outputs by outputId; the text of each is journaled
+        # once, when it is first stored. outputId -> output, for the records
+        # being replayed.
+        self.replayedOutputs = {}
+        # Results are grouped into clusters of similar outputs by the
+        # similarity engine. A cluster is named after its first outputId and
+        # holds a reference to it.
+        # inputId -> clusterId -> {workerID: None}, an ordered set
+        self.inputIdToOutputIdToWorkerIds = {}
+        # inputId -> outputId -> clusterId
+        self.inputIdToOutputIdToClusterId = {}
+        self.similarityEngine = similarityEngine \
+            if similarityEngine is not None else ExactEngine()
+        # workerId -> inputId -> outputId
+        self.workerIdToInputIdToOutputId = {}
+        # Kept in step with inputIdToOutputIdToWorkerIds, so reports do not
+        # have to walk every result.
+        self.inputIdToTotal = {}  # inputId -> number of results
+        # inputId -> [outputId], most common first
+        self.inputIdToRankedOutputIds = {}
+        self.inputIdToOutputIdToRank = {}  # inputId -> outputId -> index
+        # inputId -> (total, distinct outputs, count of the most common).
+        # Replaced rather than changed, so readers need no lock.
+        self.inputIdToSummary = {}
         self.workerProgress = {}  # workerId -> progress
+        self.workerIdInOrder = []  # [workerId], in the order they came
+        # workerId -> when it last asked for a test. Not persisted.
+        self.workerLastSeen = {}
+        # Counters to watch how chatty clients are.
+        self.stdoutFrames = 0
+        self.testsCompleted = 0
         self.taskRunnerClass = taskRunnerClass
-        self.writeLock = Lock()
+        # Changes go through the methods below so that they can be
+        # journaled, under the locks described in TaskLocks. writeLock takes
+        # them all.
+        self.locks = TaskLocks(self.inputLockStripes)
+        self.writeLock = self.locks
+        self.outputLock = Lock()
+        self.engineLock = Lock()
+        self.journal = None
         self.apiClass = apiClass
+        self.inputPool = None
+        self.inputPoolLock = Lock()
+        # Once the task is handed over to a newer server, inputs are no
+        # longer made here but copied, in order, from its task there.
+        self.inputSource = None
+        self.inputCache = InputCache(self.inputCacheBytes) \
+            if self.seededInputs else None
+        self.statistics = TaskStatistics(self)
+
+    def enablePersistence(self, directory, restore=True, **kwargs):
+        '''
+        Restores the state kept in directory, then journals every change.
+        With restore=False the current state replaces what directory holds.
+        '''
+        journal = TaskJournal(directory, **kwargs)
+        with self.writeLock:
+            if restore:
+                journal.restore(self)
+            else:
+                journal.adopt(self)
+            self.journal = journal
+            self.endReplay()
+
+    def journalRecord(self, record):
+        '''
+        Called with the locks of what record changes held. Call syncJournal
+        once they are released, so no lock is held while waiting on the disk.
+        '''
+        if self.journal is not None:
+            self.journal.append(record, self)
+
+    def syncJournal(self):
+        if self.journal is not None:
+            self.journal.sync()
 
     def awaitNewInput(self):
-        self.generateNewInput()
+        self.awaitInput(len(self.inputIdInOrder))
+
+    def awaitInput(self, progress):
+        '''
+        Makes sure that inputIdInOrder[progress] exists. Inputs come from the
+        pool, so this is cheap unless it has run dry.
+        '''
+        while True:
+            if len(self.inputIdInOrder) > progress:
+                return
+            if self.inputSource is not None:
+                self.copyInputs(progress)
+                return
+            newInput = self.takeInput()
+            with self.locks.inputs:
+                added = len(self.inputIdInOrder) <= progress
+                if added:
+                    self.addGeneratedInput(newInput)
+            if added:
+                self.syncJournal()
+                continue
+            # Another runner got there first.
+            self.returnInput(newInput)
+            return
+
+    def copyInputs(self, progress):
+        'Copies the inputs of inputSource up to progress, in its order.'
+        self.inputSource.awaitInput(progress)
+        while len(self.inputIdInOrder) <= progress:
+            # Runners copying at the same time add the same input, once.
+            inputId = self.inputSource.inputIdAt(len(self.inputIdInOrder))
+            self.addInput(inputId, self.inputSource.getInput(inputId))
+        self.syncJournal()
+
+    def takeInput(self):
+        if self.inputPoolSize <= 0:
+            return self.makeInput()
+        with self.inputPoolLock:
+            if self.inputPool is None:
+                self.inputPool = InputPool(self.makeInputs,
+                                           maxSize=self.inputPoolSize,
+                                           workers=self.inputPoolWorkers)
+        return self.inputPool.take()
+
+    def returnInput(self, newInput):
+        if self.inputPool is not None:
+            self.inputPool.putBack(newInput)
 
     def _generateNewInput(self):
-        'Override this'
+        'Override this. Seeded tasks take an rng argument.'
         raise NotImplementedError()
 
-    def generateNewInput(self):
-        newInput = self._generateNewInput()
+    def _generateNewInputs(self, n):
+        '''
+        Returns n new inputs. Unseeded tasks may override this to generate a
+        batch faster than one input at a time.
+        '''
+        return [self._generateNewInput() for _ in range(n)]
+
+    def newSeed(self):
+        seed = secrets.randbits(63)
+        return tagSeed(seed) if self.vectorised else seed
+
+    def regenerateInput(self, seed):
+        return self._generateNewInput(seededRng(seed))
+
+    def makeInputs(self, n):
+        'Returns [(what to store, input text)] for n new inputs.'
+        if self.seededInputs:
+            seeds = [self.newSeed() for _ in range(n)]
+            return [(seed, self.regenerateInput(seed)) for seed in seeds]
+        return [(newInput, newInput) for newInput in
+                self._generateNewInputs(n)]
+
+    def makeInput(self):
+        return self.makeInputs(1)[0]
+
+    def addGeneratedInput(self, newInput):
+        stored, text = newInput
         inputId = secrets.token_hex(16)
-        self.inputIdInOrder.append(inputId)
-        self.inputIdToInput[inputId] = newInput
-        self.inputIdToOutputToWorkerIds[inputId] = {}
+        self.addInput(inputId, stored)
+        if self.inputCache is not None:
+            self.inputCache.put(inputId, text)
+
+    def generateNewInput(self):
+        self.addGeneratedInput(self.makeInput())
+        self.syncJournal()
+
+    def getInput(self, inputId, cache=True):
+        '''
+        The text of an input, regenerated from its seed if need be. Pass
+        cache=False when reading many inputs once, such as for a listing, so
+        that they do not evict those tests are being run on.
+        '''
+        return self.inputText(inputId, self.inputIdToInput[inputId], cache)
+
+    def inputText(self, inputId, stored, cache=True):
+        'The text of an input stored as stored, see getInput.'
+        # Inputs stored before a task was seeded are kept as text.
+        if not self.seededInputs or isinstance(stored, str):
+            return stored
+        if not cache:
+            text = self.inputCache.peek(inputId)
+            return text if text is not None else self.regenerateInput(stored)
+        text = self.inputCache.get(inputId)
+        if text is None:
+            text = self.regenerateInput(stored)
+            self.inputCache.put(inputId, text)
+        return text
+
+    def inputIdAt(self, progress):
+        return self.inputIdInOrder[progress]
+
+    def inputCount(self):
+        return len(self.inputIdInOrder)
+
+    def hasInput(self, inputId):
+        return inputId in self.inputIdToInput
+
+    def addInput(self, inputId, newInput):
+        with self.locks.inputs, self.locks.forInput(inputId):
+            if inputId in self.inputIdToInput:
+                return
+            self.inputIdToInput[inputId] = newInput
+            self.inputIdToOutputIdToWorkerIds[inputId] = {}
+            self.inputIdToOutputIdToClusterId[inputId] = {}
+            self.inputIdToTotal[inputId] = 0
+            self.inputIdToRankedOutputIds[inputId] = []
+            self.inputIdToOutputIdToRank[inputId] = {}
+            self.inputIdToSummary[inputId] = (0, 0, 0)
+            # Last, so that whoever finds it in the order finds it complete.
+            self.inputIdInOrder.append(inputId)
+            self.journalRecord({
+                'op': 'input',
+                'inputId': inputId,
+                'input': newInput
+            })
+
+    def allocateProgress(self, workerId, count=1):
+        '''
+        Hands out the next count tests of a worker and returns the first.
+        Read and increment together, as one worker may run several tests at
+        the same time.
+        '''
+        with self.locks.workers:
+            currentProgress = self.workerProgress.get(workerId, 0)
+            self._setProgress(workerId, currentProgress + count,
+                              allocated=True)
+            self.workerLastSeen[workerId] = time.monotonic()
+        self.syncJournal()
+        return currentProgress
+
+    def releaseProgress(self, workerId, start, end):
+        '''
+        Takes back tests start to end of a worker, which were handed out but
+        never run, so they are handed out again. Unless more tests have been
+        handed out since, as those would then be handed out twice. Returns
+        whether they were taken back.
+        '''
+        with self.locks.workers:
+            if self.workerProgress.get(workerId, 0) != end:
+                return False
+            self.workerProgress[workerId] = start
+            self.journalRecord({
+                'op': 'release',
+                'workerId': workerId,
+                'start': start,
+                'end': end
+            })
+        self.syncJournal()
+        return True
 
-    def newTaskRunner(self, connection, workerId):
-        # Set the progress
+    def setProgress(self, workerId, progress):
+        with self.locks.workers:
+            self._setProgress(workerId, progress)
+        self.syncJournal()
+
+    def _setProgress(self, workerId, progress, allocated=False):
         if workerId not in self.workerProgress:
+            self.workerIdInOrder.append(workerId)
+        self.workerProgress[workerId] = progress
+        record = {
+            'op': 'progress',
+            'workerId': workerId,
+            'progress': progress
+        }
+        # Marks tests handed out, rather than progress set by an admin.
+        if allocated:
+            record['allocated'] = True
+        self.journalRecord(record)
+
+    def internOutput(self, output):
+        '''
+        Returns the outputId of output, storing output if it is new. A new
+        output is journaled here, under outputLock, so that its record comes
+        before any record naming it.
+        '''
+        outputId = sys.intern(hashlib.blake2b(
+            output.encode('utf-8'), digest_size=16).hexdigest())
+        with self.outputLock:
+            if outputId in self.outputIdRefs:
+                self.outputIdRefs[outputId] += 1
+            else:
+                self.outputIdToOutput[outputId] = output
+                self.outputIdRefs[outputId] = 1
+                self.journalRecord({
+                    'op': 'output',
+                    'outputId': outputId,
+                    'output': output
+                })
+        return outputId
+
+    def retainOutput(self, outputId):
+        with self.outputLock:
+            self.outputIdRefs[outputId] += 1
+
+    def releaseOutput(self, outputId):
+        with self.outputLock:
+            self.outputIdRefs[outputId] -= 1
+            if self.outputIdRefs[outputId] == 0:
+                del self.outputIdRefs[outputId]
+                del self.outputIdToOutput[outputId]
+
+    def getOutput(self, outputId):
+        return self.outputIdToOutput[outputId]
+
+    def getOutputs(self, inputId):
+        'The outputs recorded for inputId, as output -> [workerId].'
+        with self.locks.forInput(inputId):
+            return {
+                self.outputIdToOutput[outputId]: list(workerIds)
+                for outputId, workerIds in
+                self.inputIdToOutputIdToWorkerIds[inputId].items()
+            }
+
+    def getSummary(self, inputId, top=REPORT_TOP_OUTPUTS,
+                   sample=REPORT_WORKER_SAMPLE):
+        'The most common outputs for inputId, with a sample of their workers.'
+        with self.locks.forInput(inputId):
+            outputIdToWorkerIds = self.inputIdToOutputIdToWorkerIds[inputId]
+            ranked = self.inputIdToRankedOutputIds[inputId]
+            return {
+                'total': self.inputIdToTotal[inputId],
+                'distinctOutputs': len(ranked),
+                'topOutputs': [{
+                    'outputId': outputId,
+                    'output': self.outputIdToOutput[outputId],
+                    'count': len(outputIdToWorkerIds[outputId]),
+                    'workerIds': list(itertools.islice(
+                        outputIdToWorkerIds[outputId], sample))
+                } for outputId in ranked[:top]]
+            }
+
+    def completeTest(self, workerId, inputId, output, stdoutFrames,
+                     sample=REPORT_WORKER_SAMPLE):
+        '''
+        Records the output of a finished test of inputId, the input it was
+        handed out with, and returns what its report needs: the input, the
+        cluster the output joined and a summary with up to sample workers per
+        output (None for all of them). Returns None, recording nothing, if
+        the input was purged meanwhile.
+        '''
+        with self.locks.forInput(inputId):
+            stored = self.inputIdToInput.get(inputId)
+            if stored is None:
+                return None
+            clusterId = self.recordResult(workerId, inputId, output)
+            summary = self.getSummary(inputId, sample=sample)
+            summary['inputId'] = inputId
+            summary['outputId'] = clusterId
+            summary['sameOutput'] = len(
+                self.inputIdToOutputIdToWorkerIds[inputId][clusterId])
+        with self.locks.workers:
+            self.stdoutFrames += stdoutFrames
+            self.testsCompleted += 1
+        self.syncJournal()
+        summary['input'] = self.inputText(inputId, stored)
+        return summary
+
+    def outputCluster(self, inputId, outputId=None, offset=0,
+                      limit=MAX_CLUSTER_PAGE):
+        '''
+        A page of what was recorded for an input, or None if inputId or
+        outputId is unknown. Without an outputId, lists its outputs, most
+        common first; with one, lists the workers that produced it.
+        '''
+        if inputId not in self.inputIdToInput:
+            return None
+        with self.locks.forInput(inputId):
+            outputIdToWorkerIds = self.inputIdToOutputIdToWorkerIds.get(
+                inputId)
+            if outputIdToWorkerIds is None or (
+                    outputId is not None and
+                    outputId not in outputIdToWorkerIds):
+                return None
+            if outputId is None:
+                ranked = self.inputIdToRankedOutputIds[inputId]
+                return {
+                    'inputId': inputId,
+                    'total': len(ranked),
+                    'outputs': [{
+                        'outputId': rankedOutputId,
+                        'output': self.getOutput(rankedOutputId),
+                        'count': len(outputIdToWorkerIds[rankedOutputId])
+                    } for rankedOutputId in ranked[offset:offset + limit]]
+                }
+            workerIds = outputIdToWorkerIds[outputId]
+            return {
+                'inputId': inputId,
+                'outputId': outputId,
+                'output': self.getOutput(outputId),
+                'total': len(workerIds),
+                'workerIds': list(itertools.islice(
+                    workerIds, offset, offset + limit))
+            }
+
+    def statisticsAggregate(self, names, options=None):
+        return self.statistics.aggregate(names, options)
+
+    def statisticsPage(self, section, cursor=None, limit=MAX_PAGE,
+                       options=None):
+        return self.statistics.page(section, cursor, limit, options)
+
+    def legacyStatistics(self):
+        '''
+        Everything at once, for older admin clients, with outputs in full as
+        before they were interned. Each input is copied under its own lock,
+        so results keep being recorded meanwhile.
+        '''
+        inputIds = list(self.inputIdInOrder)
+        workerIdToInputIdToOutput = {}
+        for workerId, outputIds in \
+                list(self.workerIdToInputIdToOutputId.items()):
+            workerIdToInputIdToOutput[workerId] = {}
+            for inputId, outputId in list(outputIds.items()):
+                output = self.outputIdToOutput.get(outputId)
+                if output is not None:
+                    workerIdToInputIdToOutput[workerId][inputId] = output
+        return {
+            'workerProgress': dict(self.workerProgress),
+            'inputIdToInput': {
+                inputId: self.getInput(inputId, cache=False)
+                for inputId in inputIds
+            },
+            'inputIdToOutputToWorkerIds': {
+                inputId: self.getOutputs(inputId) for inputId in inputIds
+            },
+            'workerIdToInputIdToOutput': workerIdToInputIdToOutput,
+            'inputIdInOrder': inputIds,
+            'stdoutFrames': self.stdoutFrames,
+            'testsCompleted': self.testsCompleted
+        }
+
+    def rankOutput(self, inputId, outputId):
+        '''
+        Moves outputId to its place in the ranking of inputId after its count
+        changed by one. It only passes the outputs it overtakes, so this is
+        O(1) unless many outputs tie. Called with the lock of inputId held.
+        '''
+        ranked = self.inputIdToRankedOutputIds[inputId]
+        ranks = self.inputIdToOutputIdToRank[inputId]
+        outputIdToWorkerIds = self.inputIdToOutputIdToWorkerIds[inputId]
+        count = len(outputIdToWorkerIds.get(outputId, ()))
+        if outputId not in ranks:
+            ranks[outputId] = len(ranked)
+            ranked.append(outputId)
+        i = ranks[outputId]
+        # Outputs that are gone sink to the end and are dropped.
+        key = count if count > 0 else -1
+        while i > 0 and \
+                len(outputIdToWorkerIds.get(ranked[i - 1], ())) < key:
+            ranked[i], ranked[i - 1] = ranked[i - 1], ranked[i]
+            ranks[ranked[i]] = i
+            i -= 1
+        while i < len(ranked) - 1 and \
+                len(outputIdToWorkerIds.get(ranked[i + 1], ())) > key:
+            ranked[i], ranked[i + 1] = ranked[i + 1], ranked[i]
+            ranks[ranked[i]] = i
+            i += 1
+        ranks[outputId] = i
+        if count == 0:
+            ranked.pop()
+            del ranks[outputId]
+        self.inputIdToSummary[inputId] = (
+            self.inputIdToTotal[inputId], len(ranked),
+            len(outputIdToWorkerIds[ranked[0]]) if ranked else 0)
+
+    def clusterOf(self, inputId, outputId, output):
+        'Called with the lock of inputId held.'
+        outputIdToClusterId = self.inputIdToOutputIdToClusterId[inputId]
+        if outputId not in outputIdToClusterId:
+            with self.engineLock:
+                clusterId = self.similarityEngine.assign(inputId, output)
+                if clusterId is None:
+                    clusterId = outputId
+                    self.similarityEngine.addCluster(inputId, clusterId,
+                                                     output)
+            if clusterId == outputId:
+                self.retainOutput(clusterId)
+            outputIdToClusterId[outputId] = clusterId
+        return outputIdToClusterId[outputId]
+
+    def removeCluster(self, inputId, clusterId):
+        'Called with the lock of inputId held, once the cluster is empty.'
+        outputIdToClusterId = self.inputIdToOutputIdToClusterId[inputId]
+        for outputId in [outputId for outputId, c in
+                         outputIdToClusterId.items() if c == clusterId]:
+            del outputIdToClusterId[outputId]
+        with self.engineLock:
+            self.similarityEngine.removeCluster(inputId, clusterId)
+        self.releaseOutput(clusterId)
+
+    def forgetResult(self, workerId, inputId, outputId):
+        'Called with the lock of inputId held.'
+        outputIdToWorkerIds = self.inputIdToOutputIdToWorkerIds.get(inputId)
+        if outputIdToWorkerIds is not None:
+            clusterId = self.inputIdToOutputIdToClusterId[inputId][outputId]
+            workerIds = outputIdToWorkerIds[clusterId]
+            del workerIds[workerId]
+            self.inputIdToTotal[inputId] -= 1
+            if len(workerIds) == 0:
+                del outputIdToWorkerIds[clusterId]
+                self.removeCluster(inputId, clusterId)
+            self.rankOutput(inputId, clusterId)
+        self.releaseOutput(outputId)
+
+    def recordResult(self, workerId, inputId, output):
+        '''
+        Records the output of a worker for an input, replacing any earlier
+        one, and returns the id of the cluster it joined.
+        '''
+        with self.locks.forInput(inputId):
+            outputIds = self.workerIdToInputIdToOutputId.setdefault(
+                workerId, {})
+            outputIdToWorkerIds = self.inputIdToOutputIdToWorkerIds[inputId]
+            outputId = self.internOutput(output)
+            if inputId in outputIds:
+                if outputIds[inputId] == outputId:
+                    self.releaseOutput(outputId)
+                    return self.inputIdToOutputIdToClusterId[inputId][
+                        outputId]
+                self.forgetResult(workerId, inputId, outputIds[inputId])
+            clusterId = self.clusterOf(inputId, outputId, output)
+            if clusterId not in outputIdToWorkerIds:
+                outputIdToWorkerIds[clusterId] = {}
+            outputIdToWorkerIds[clusterId][workerId] = None
+            outputIds[inputId] = outputId
+            self.inputIdToTotal[inputId] += 1
+            self.rankOutput(inputId, clusterId)
+            self.journalRecord({
+                'op': 'result',
+                'workerId': workerId,
+                'inputId': inputId,
+                'outputId': outputId
+            })
+            return clusterId
+
+    def purgeWorker(self, workerId):
+        with self.writeLock:
+            if workerId not in self.workerProgress:
+                self.workerIdInOrder.append(workerId)
             self.workerProgress[workerId] = 0
-        currentProgress = self.workerProgress[workerId]
-        self.writeLock.acquire()
-        self.workerProgress[workerId] += 1
-        self.writeLock.release()
-        return self.taskRunnerClass(task=self, connection=connection,
-                                    workerId=workerId,
-                                    progress=currentProgress)
+            # Only visit the inputs this worker answered.
+            outputIds = self.workerIdToInputIdToOutputId.get(workerId, {})
+            for inputId, outputId in outputIds.items():
+                self.forgetResult(workerId, inputId, outputId)
+
+            if workerId in self.workerIdToInputIdToOutputId:
+                self.workerIdToInputIdToOutputId[workerId] = {}
+            self.journalRecord({
+                'op': 'purge-worker',
+                'workerId': workerId
+            })
+        self.syncJournal()
+
+    def purgeAll(self):
+        with self.writeLock:
+            self.workerProgress = {}
+            self.workerIdInOrder = []
+            self.workerLastSeen = {}
+            self.inputIdToInput = {}
+            if self.inputCache is not None:
+                self.inputCache.clear()
+            self.outputIdToOutput = {}
+            self.outputIdRefs = {}
+            self.inputIdToOutputIdToWorkerIds = {}
+            self.inputIdToOutputIdToClusterId = {}
+            self.similarityEngine.reset()
+            self.workerIdToInputIdToOutputId = {}
+            self.inputIdToTotal = {}
+            self.inputIdToRankedOutputIds = {}
+            self.inputIdToOutputIdToRank = {}
+            self.inputIdToSummary = {}
+            self.inputIdInOrder = []
+            self.journalRecord({
+                'op': 'purge-all'
+            })
+        self.syncJournal()
+
+    def applyRecord(self, record):
+        'Replays a journal record. Replaying one twice is harmless.'
+        op = record['op']
+        if op == 'input':
+            self.addInput(record['inputId'], record['input'])
+        elif op == 'progress':
+            self.setProgress(record['workerId'], record['progress'])
+        elif op == 'release':
+            self.releaseProgress(record['workerId'], record['start'],
+                                 record['end'])
+        elif op == 'output':
+            self.replayedOutputs[record['outputId']] = record['output']
+        elif op == 'result':
+            # Older journals hold the output itself.
+            output = record.get('output')
+            if output is None:
+                output = self.outputIdToOutput.get(
+                    record['outputId'],
+                    self.replayedOutputs.get(record['outputId']))
+            if output is None:
+                logging.warning(f'Dropped a result naming output '
+                                f'{record["outputId"]}, which was never '
+                                f'journaled.')
+                return
+            self.recordResult(record['workerId'], record['inputId'], output)
+        elif op == 'purge-worker':
+            self.purgeWorker(record['workerId'])
+        elif op == 'purge-all':
+            self.purgeAll()
+
+    def endReplay(self):
+        'Forgets the outputs kept for replaying records, see applyRecord.'
+        self.replayedOutputs = {}
+
+    def snapshotState(self):
+        'A copy of the state that is safe to serialise without the lock.'
+        with self.writeLock:
+            return {
+                'inputIdInOrder': list(self.inputIdInOrder),
+                'inputIdToInput': dict(self.inputIdToInput),
+                'outputIdToOutput': dict(self.outputIdToOutput),
+                'inputIdToOutputIdToWorkerIds': {
+                    inputId: {outputId: list(workerIds)
+                              for outputId, workerIds in outputIds.items()}
+                    for inputId, outputIds in
+                    self.inputIdToOutputIdToWorkerIds.items()
+                },
+                'inputIdToOutputIdToClusterId': {
+                    inputId: dict(clusterIds) for inputId, clusterIds in
+                    self.inputIdToOutputIdToClusterId.items()
+                },
+                'workerIdToInputIdToOutputId': {
+                    workerId: dict(outputIds) for workerId, outputIds in
+                    self.workerIdToInputIdToOutputId.items()
+                },
+                'workerProgress': dict(self.workerProgress),
+            }
+
+    def loadState(self, state):
+        with self.writeLock:
+            self.inputIdInOrder = state['inputIdInOrder']
+            self.inputIdToInput = state['inputIdToInput']
+            self.outputIdToOutput = {}
+            self.outputIdRefs = {}
+
+            def retain(outputId):
+                outputId = sys.intern(outputId)
+                if outputId not in self.outputIdRefs:
+                    self.outputIdToOutput[outputId] = \
+                        state['outputIdToOutput'][outputId]
+                    self.outputIdRefs[outputId] = 0
+                self.outputIdRefs[outputId] += 1
+                return outputId
+
+            self.workerIdToInputIdToOutputId = {
+                workerId: {inputId: retain(outputId)
+                           for inputId, outputId in outputIds.items()}
+                for workerId, outputIds in
+                state['workerIdToInputIdToOutputId'].items()
+            }
+            self.similarityEngine.reset()
+            self.inputIdToOutputIdToWorkerIds = {}
+            for inputId, clusterIds in \
+                    state['inputIdToOutputIdToWorkerIds'].items():
+                self.inputIdToOutputIdToWorkerIds[inputId] = {}
+                for clusterId, workerIds in clusterIds.items():
+                    clusterId = retain(clusterId)
+                    self.inputIdToOutputIdToWorkerIds[inputId][clusterId] = \
+                        dict.fromkeys(workerIds)
+                    self.similarityEngine.addCluster(
+                        inputId, clusterId, self.outputIdToOutput[clusterId])
+            self.inputIdToOutputIdToClusterId = {
+                inputId: {sys.intern(outputId): sys.intern(clusterId)
+                          for outputId, clusterId in clusterIds.items()}
+                for inputId, clusterIds in
+                state['inputIdToOutputIdToClusterId'].items()
+            }
+            self.inputIdToTotal = {}
+            self.inputIdToRankedOutputIds = {}
+            self.inputIdToOutputIdToRank = {}
+            self.inputIdToSummary = {}
+            for inputId, outputIdToWorkerIds in \
+                    self.inputIdToOutputIdToWorkerIds.items():
+                ranked = sorted(outputIdToWorkerIds, reverse=True,
+                                key=lambda o: len(outputIdToWorkerIds[o]))
+                total = sum(len(workerIds) for workerIds in
+                            outputIdToWorkerIds.values())
+                self.inputIdToTotal[inputId] = total
+                self.inputIdToRankedOutputIds[inputId] = ranked
+                self.inputIdToOutputIdToRank[inputId] = {
+                    outputId: i for i, outputId in enumerate(ranked)}
+                self.inputIdToSummary[inputId] = (
+                    total, len(ranked),
+                    len(outputIdToWorkerIds[ranked[0]]) if ranked else 0)
+            self.workerProgress = state['workerProgress']
+            self.workerIdInOrder = list(self.workerProgress)
+
+    def newTaskRunner(self, connection, workerId, summaries=False):
+        '''
+        summaries is whether the client said in its hello that it reads
+        topOutputs. Older clients are sent allOutputs instead.
+        '''
+        currentProgress = self.allocateProgress(workerId)
+        runner = self.taskRunnerClass(task=self, connection=connection,
+                                      workerId=workerId,
+                                      progress=currentProgress)
+        runner.summaries = summaries
+        return runner
+
+    def newBatchRunner(self, connection, workerId, count, summaries=False):
+        'Hands the next count tests of a worker out in one go.'
+        if not self.taskRunnerClass.prefetchable:
+            connection.fire('drop', {
+                'reason': 'This task does not support prefetching.'
+            })
+            connection.close()
+            return None
+        count = max(1, min(count, MAX_PREFETCH))
+        currentProgress = self.allocateProgress(workerId, count)
+        return SimpleTaskBatchRunner(task=self, connection=connection,
+                                     workerId=workerId,
+                                     progress=currentProgress, count=count,
+                                     summaries=summaries)
 
     def newTaskApi(self, connection, workerId):
         if self.apiClass is None:
@@ -52,18 +782,24 @@ class SimpleTask(GenericTask):
 
 
 class SimpleTaskRunner(GenericTaskRunner):
+    # Whether _run only sends stdin and eof without waiting on the program's
+    # stdout, so that the client may be handed the whole script up front.
+    # Set this to False for interactive runners.
+    prefetchable = True
+    # Whether reports carry topOutputs only, see SimpleTask.newTaskRunner.
+    summaries = False
+
     def __init__(self, task, connection: Connection, workerId, progress):
         self.task = task
         self.connection = connection
         self.workerId = workerId
         self.output = ''
+        self.outputChunks = []
+        self.stdoutFrames = 0
         self.killReason = None
         self.progress = progress
 
-        if len(task.inputIdInOrder) <= self.progress:
-            self.progress = len(task.inputIdInOrder)
-            # Generate a new input
-            self.task.awaitNewInput()
+        self.task.awaitInput(self.progress)
         self.connection.registerEventListener('stdout', self.onStdout)
         self.connection.registerEventListener('appkill', self.onAppKill)
         self.connection.registerEventListener('appterm', self.onAppTerm)
@@ -75,8 +811,10 @@ class SimpleTaskRunner(GenericTaskRunner):
         raise NotImplementedError()
 
     def run(self):
-        nextInputId = self.task.inputIdInOrder[self.progress]
-        nextInput = self.task.inputIdToInput[nextInputId]
+        nextInputId = self.task.inputIdAt(self.progress)
+        nextInput = self.task.getInput(nextInputId)
+        # The result goes to this input, whatever happens to the order.
+        self.inputId = nextInputId
         self._run(nextInputId=nextInputId, nextInput=nextInput)
 
     def onAppKill(self, data):
@@ -87,42 +825,87 @@ class SimpleTaskRunner(GenericTaskRunner):
         })
 
     def onAppTerm(self, data):
-        currentProgress = self.progress
-        inputId = self.task.inputIdInOrder[currentProgress]
-        if self.output not in self.task.inputIdToOutputToWorkerIds[inputId]:
-            self.task.inputIdToOutputToWorkerIds[inputId][self.output] = []
-        self.task.inputIdToOutputToWorkerIds[inputId][self.output].append(
-            self.workerId)
-        if self.workerId not in self.task.workerIdToInputIdToOutput:
-            self.task.workerIdToInputIdToOutput[self.workerId] = {}
-        self.task.workerIdToInputIdToOutput[self.workerId][inputId] = \
-            self.output
-
-        # Calculate total tests
-        totalTests = 0
-        for output, workerIds in self.task.\
-                inputIdToOutputToWorkerIds[inputId].items():
-            totalTests += len(workerIds)
-        sameOutput = len(
-            self.task.inputIdToOutputToWorkerIds[inputId][self.output])
-
-        self.connection.fire('report',
-                             {
-                                 'total': totalTests,
-                                 'sameoutput': sameOutput,
-                                 'similarity': sameOutput/totalTests,
-                                 'output': self.output,
-                                 'inputId': inputId,
-                                 'input': self.task.inputIdToInput[inputId],
-                                 'testNumber': currentProgress,
-                                 'allOutputs': self.task.
-                                 inputIdToOutputToWorkerIds[inputId]
-                             })
+        report = self.recordOutput()
+        if report is None:
+            self.connection.fire('message', {
+                'message': DROPPED_RESULT
+            })
+        else:
+            self.connection.fire('report', report)
         self.completed()
 
+    def recordOutput(self):
+        '''
+        Records the collected output and returns the report for it, or None
+        if its input was purged while the test ran.
+        '''
+        self.output = ''.join(self.outputChunks).replace('\r\n', '\n')
+        self.outputChunks = []
+        logging.debug(f'Test {self.progress} of {self.workerId} took '
+                      f'{self.stdoutFrames} stdout frames.')
+        currentProgress = self.progress
+        # Clients from before summaries count the workers behind each output
+        # themselves, so they are sent all of them.
+        summary = self.task.completeTest(
+            self.workerId, self.inputId, self.output, self.stdoutFrames,
+            REPORT_WORKER_SAMPLE if self.summaries else None)
+        if summary is None:
+            return None
+        if metrics.collector is not None:
+            metrics.collector.testCompleted(self.task, len(self.output))
+        sameOutput = summary['sameOutput']
+
+        report = {
+            'total': summary['total'],
+            'sameoutput': sameOutput,
+            'similarity': sameOutput/summary['total'],
+            'output': self.output,
+            'outputId': summary['outputId'],
+            'inputId': summary['inputId'],
+            'input': summary['input'],
+            'testNumber': currentProgress,
+            'distinctOutputs': summary['distinctOutputs']
+        }
+        if self.summaries:
+            report['topOutputs'] = summary['topOutputs']
+        else:
+            # Clients from before summaries read allOutputs, output ->
+            # workerIds: the top outputs, each with every worker behind it.
+            report['allOutputs'] = {
+                top['output']: top['workerIds']
+                for top in summary['topOutputs']
+            }
+        return report
+
+    def onStatistics(self, data):
+        '''
+        Answers a server-statistics command that asks for aggregates or for a
+        page of a section. Returns True if the admin may ask for another page.
+        '''
+        try:
+            if 'section' in data:
+                items, nextCursor = self.task.statisticsPage(
+                    data['section'], data.get('cursor'),
+                    data.get('limit', MAX_PAGE), data)
+                self.connection.fire('statistics', {
+                    'section': data['section'],
+                    'items': items,
+                    'nextCursor': nextCursor
+                })
+                return nextCursor is not None
+            self.connection.fire('statistics', {
+                'aggregates': self.task.statisticsAggregate(
+                    data['aggregates'], data)
+            })
+        except ValueError as e:
+            self.connection.fire('error', {
+                'message': str(e)
+            })
+        return False
+
     def onStdout(self, data):
-        message = data['message'].replace('\r\n', '\n')
-        self.output += message
+        self.outputChunks.append(data['message'])
+        self.stdoutFrames += 1
 
     def completed(self):
         self.connection.removeEventListener('stdout', self.onStdout)
@@ -150,13 +933,13 @@ class SimpleTaskRunner(GenericTaskRunner):
                 workerId = data['workerId']
 
             progress = data['progress']
-            if progress < 0 or progress > len(self.task.inputIdInOrder):
+            if progress < 0 or progress > self.task.inputCount():
                 self.connection.fire('error', {
                     'message': 'Progress out of bounds'
                 })
                 self.completed()
                 return
-            self.task.workerProgress[workerId] = progress
+            self.task.setProgress(workerId, progress)
             self.connection.fire('message', {
                 'message': f'Progress set to {progress}'
             })
@@ -165,41 +948,50 @@ class SimpleTaskRunner(GenericTaskRunner):
                 workerId = self.workerId
             else:
                 workerId = data['workerId']
-            self.task.workerProgress[workerId] = 0
-            for inputId, outputToWorkerIds in self.task.\
-                    inputIdToOutputToWorkerIds.items():
-                for output in list(outputToWorkerIds.keys()):
-                    workerIds = outputToWorkerIds[output]
-                    if workerId in workerIds:
-                        workerIds.remove(workerId)
-                    if len(workerIds) == 0:
-                        del outputToWorkerIds[output]
-
-            if workerId in self.task.workerIdToInputIdToOutput:
-                self.task.workerIdToInputIdToOutput[workerId] = {}
+            self.task.purgeWorker(workerId)
 
             self.connection.fire('message', {
                 'message': f'Data purged for {workerId}'
             })
         elif command == 'purge-all':
-            self.task.workerProgress = {}
-            self.task.inputIdToInput = {}
-            self.task.inputIdToOutputToWorkerIds = {}
-            self.task.workerIdToInputIdToOutput = {}
-            self.task.inputIdInOrder = []
+            self.task.purgeAll()
 
             self.connection.fire('message', {
                 'message': 'Purged all data.'
             })
         elif command == 'server-statistics':
-            self.connection.fire('statistics', {
-                'workerProgress': self.task.workerProgress,
-                'inputIdToInput': self.task.inputIdToInput,
-                'inputIdToOutputToWorkerIds': self.task.
-                inputIdToOutputToWorkerIds,
-                'workerIdToInputIdToOutput': self.task.
-                workerIdToInputIdToOutput,
-                'inputIdInOrder': self.task.inputIdInOrder
+            if 'aggregates' in data or 'section' in data:
+                if self.onStatistics(data):
+                    # More pages to come on this connection.
+                    return
+                self.completed()
+                return
+            self.connection.fire('statistics',
+                                 self.task.legacyStatistics())
+        elif command == 'profile-start':
+            try:
+                tracing.startProfiling(data.get('events'),
+                                       data.get('rate', 1.0),
+                                       data.get('engine', 'cprofile'),
+                                       data.get('workerId'))
+            except ValueError as e:
+                self.connection.fire('error', {
+                    'message': str(e)
+                })
+                self.completed()
+                return
+            self.connection.fire('message', {
+                'message': 'Started profiling.'
+            })
+        elif command == 'profile-stop':
+            tracing.stopProfiling()
+            self.connection.fire('message', {
+                'message': 'Stopped profiling.'
+            })
+        elif command == 'profile-dump':
+            self.connection.fire('profiles', {
+                'profiles': tracing.dumpProfiles(
+                    data.get('limit', tracing.DUMP_LIMIT))
             })
         else:
             self.connection.fire('error', {
@@ -208,29 +1000,150 @@ class SimpleTaskRunner(GenericTaskRunner):
         self.completed()
 
 
+class ScriptRecorder():
+    'Stands in for a Connection to capture what a runner would send.'
+
+    def __init__(self):
+        self.events = []
+
+    def registerEventListener(self, event, listener):
+        pass
+
+    def removeEventListener(self, event, listener):
+        pass
+
+    def localFire(self, event, data):
+        pass
+
+    def fire(self, event, data=None):
+        self.events.append({'type': event, 'data': data})
+
+
+class SimpleTaskBatchRunner():
+    '''
+    Sends a client several tests at once. Each test is prepared by the task's
+    own runner, recorded into a script of events that the client replays
+    locally. The client runs the tests back to back and uploads all of the
+    outputs in a single results event. Tests it did not get to, as the batch
+    ended early or the client went away, are taken back.
+    '''
+
+    def __init__(self, task, connection, workerId, progress, count,
+                 summaries=False):
+        self.task = task
+        self.connection = connection
+        self.workerId = workerId
+        self.runners = {}  # testNumber -> runner
+        self.end = progress + count
+        tests = []
+        for testProgress in range(progress, progress + count):
+            recorder = ScriptRecorder()
+            runner = task.taskRunnerClass(task=task, connection=recorder,
+                                          workerId=workerId,
+                                          progress=testProgress)
+            runner.summaries = summaries
+            self.runners[runner.progress] = runner
+            tests.append({
+                'testNumber': runner.progress,
+                'inputId': runner.inputId,
+                'events': recorder.events
+            })
+        self.progress = tests[0]['testNumber']
+        self.connection.registerEventListener('results', self.onResults)
+        self.connection.registerEventListener('disconnect',
+                                              self.releaseUnreported)
+        self.connection.fire('batch', {
+            'tests': tests
+        })
+
+    def onResults(self, data):
+        reports = []
+        for result in data.get('results', []):
+            runner = self.runners.pop(result.get('testNumber'), None)
+            if runner is None or result.get('inputId') != runner.inputId:
+                self.connection.fire('error', {
+                    'message': 'Result for a test that was not handed out.'
+                })
+                break
+            runner.killReason = result.get('killReason')
+            runner.outputChunks = [result.get('output', '')]
+            runner.stdoutFrames = 1
+            report = runner.recordOutput()
+            if report is None:
+                self.connection.fire('message', {
+                    'message': DROPPED_RESULT
+                })
+                continue
+            reports.append(report)
+        self.connection.removeEventListener('results', self.onResults)
+        self.releaseUnreported()
+        self.connection.fire('reports', {
+            'reports': reports
+        })
+        self.connection.fire('completed')
+
+    def releaseUnreported(self, _=None):
+        runners, self.runners = self.runners, {}
+        if runners:
+            self.task.releaseProgress(self.workerId, min(runners), self.end)
+
+
 class SimpleTaskApi(GenericTaskApi):
     def __init__(self, task, connection, workerId):
         super().__init__(task, connection, workerId)
         self.connection.registerEventListener(
             'get-input-by-id', self.getInputById)
+        self.connection.registerEventListener(
+            'get-output-cluster', self.getOutputCluster)
 
     def getInputById(self, data):
+        # Echo the requestId so that clients can match the response.
+        requestId = data.get('requestId')
         if 'inputId' not in data:
             self.connection.fire('input', {
-                'input': None
+                'input': None,
+                'requestId': requestId
             })
             self.connection.fire('error', {
-                'message': 'No inputId specified'
+                'message': 'No inputId specified',
+                'requestId': requestId
             })
             return
-        if data['inputId'] not in self.task.inputIdToInput:
+        if not self.task.hasInput(data['inputId']):
             self.connection.fire('input', {
-                'input': None
+                'input': None,
+                'requestId': requestId
             })
             self.connection.fire('error', {
-                'message': 'Unknown inputId'
+                'message': 'Unknown inputId',
+                'requestId': requestId
             })
             return
         self.connection.fire('input', {
-            'input': self.task.inputIdToInput[data['inputId']]
+            'input': self.task.getInput(data['inputId']),
+            'requestId': requestId
+        })
+
+    def getOutputCluster(self, data):
+        'Pages through what was recorded for an input.'
+        requestId = data.get('requestId')
+        inputId = data.get('inputId')
+        outputId = data.get('outputId')
+        offset = max(0, data.get('offset', 0))
+        limit = max(0, min(data.get('limit', MAX_CLUSTER_PAGE),
+                           MAX_CLUSTER_PAGE))
+        cluster = self.task.outputCluster(inputId, outputId, offset, limit)
+        if cluster is None:
+            self.connection.fire('output-cluster', {
+                'cluster': None,
+                'requestId': requestId
+            })
+            self.connection.fire('error', {
+                'message': 'Unknown inputId or outputId',
+                'requestId': requestId
+            })
+            return
+        self.connection.fire('output-cluster', {
+            'cluster': cluster,
+            'requestId': requestId
         })
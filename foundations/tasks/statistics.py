@@ -0,0 +1,264 @@
+import itertools
+import sys
+import time
+
+# Aggregates an admin can ask server-statistics for.
+AGGREGATES = ['summary', 'agreement', 'activeWorkers', 'distinctOutputs',
+              'progress', 'inputPool', 'memory']
+# Sections that can be paged through, and the most items per page.
+SECTIONS = ['inputs', 'workers', 'outputs']
+MAX_PAGE = 500
+# Workers that asked for a test this recently count as active.
+ACTIVE_WINDOW = 3600
+AGREEMENT_BUCKETS = 10
+# Entries of each dict that memory looks at; nested ones get a quarter.
+MEMORY_SAMPLES = 64
+
+
+def sampleOf(container, count):
+    'The first count items of a container other threads may be changing.'
+    for _ in range(3):
+        try:
+            items = container.items() if isinstance(container, dict) \
+                else container
+            return list(itertools.islice(items, count))
+        except RuntimeError:
+            # It changed size while we looked.
+            continue
+    return []
+
+
+def integerOption(options, name, default):
+    'options[name], as sent by an admin, checked to be an integer.'
+    value = options.get(name, default)
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise ValueError(f'{name} must be an integer')
+    return value
+
+
+def estimateSize(obj, samples=MEMORY_SAMPLES, strings=True):
+    '''
+    Estimates the size of obj and everything it holds, in bytes. Containers
+    are extrapolated from their first few items, so this stays cheap however
+    large they grow. Pass strings=False for indexes whose strings (ids) are
+    shared with, and counted in, another container.
+    '''
+    if isinstance(obj, str) and not strings:
+        return 0
+    size = sys.getsizeof(obj)
+    if not isinstance(obj, (dict, list, tuple, set)) or not obj:
+        return size
+    items = sampleOf(obj, samples)
+    if not items:
+        return size
+    nested = max(1, samples // 4)
+    if isinstance(obj, dict):
+        itemSize = sum(estimateSize(key, nested, strings) +
+                       estimateSize(value, nested, strings)
+                       for key, value in items)
+    else:
+        itemSize = sum(estimateSize(item, nested, strings) for item in items)
+    return size + itemSize * len(obj) // len(items)
+
+
+class TaskStatistics():
+    '''
+    Answers server-statistics for a SimpleTask without serialising its whole
+    state: aggregates are computed on the server, and the underlying records
+    are handed out a page at a time. Inputs and workers are paged by their
+    position in orders that only grow (until purge-all), so no page is
+    skipped or repeated while results keep arriving; outputs follow the
+    current ranking, which may shift between pages. Each page is sliced out
+    of its list under the lock guarding it, so it costs the same wherever it
+    starts.
+
+    Nothing here takes the locks of the whole task. Per-input figures come
+    from inputIdToSummary, whose entries are replaced rather than changed,
+    and other dicts are copied in one step before they are walked.
+    '''
+
+    def __init__(self, task):
+        self.task = task
+
+    def aggregate(self, names, options=None):
+        options = options or {}
+        if not isinstance(names, list):
+            raise ValueError('aggregates must be a list')
+        unknown = [name for name in names if name not in AGGREGATES]
+        if unknown:
+            raise ValueError(f'Unknown aggregates {", ".join(unknown)}')
+        return {name: getattr(self, name)(options) for name in names}
+
+    def summary(self, options):
+        task = self.task
+        return {
+            'inputs': len(task.inputIdInOrder),
+            'workers': len(task.workerProgress),
+            'results': sum(total for total, _, _ in
+                           list(task.inputIdToSummary.values())),
+            'outputs': len(task.outputIdToOutput),
+            'testsCompleted': task.testsCompleted,
+            'stdoutFrames': task.stdoutFrames
+        }
+
+    def agreement(self, options):
+        '''
+        How many inputs have their most common output shared by 0-10%,
+        10-20%, ... of their results. Inputs nobody answered are counted
+        separately.
+        '''
+        buckets = [0] * AGREEMENT_BUCKETS
+        unanswered = 0
+        for total, _, topCount in list(self.task.inputIdToSummary.values()):
+            if total == 0:
+                unanswered += 1
+                continue
+            share = topCount / total
+            buckets[min(int(share * AGREEMENT_BUCKETS),
+                        AGREEMENT_BUCKETS - 1)] += 1
+        return {
+            'buckets': [[i / AGREEMENT_BUCKETS, count]
+                        for i, count in enumerate(buckets)],
+            'unanswered': unanswered
+        }
+
+    def activeWorkers(self, options):
+        window = integerOption(options, 'activeWindow', ACTIVE_WINDOW)
+        since = time.monotonic() - window
+        return {
+            'window': window,
+            'active': sum(1 for seen in
+                          list(self.task.workerLastSeen.values())
+                          if seen >= since),
+            'known': len(self.task.workerProgress)
+        }
+
+    def distinctOutputs(self, options):
+        'How many inputs have 1, 2, 3, ... distinct outputs, as pairs.'
+        histogram = {}
+        for _, count, _ in list(self.task.inputIdToSummary.values()):
+            histogram[count] = histogram.get(count, 0) + 1
+        return sorted(histogram.items())
+
+    def progress(self, options):
+        'How many workers have progress in each bucket, as pairs.'
+        bucketSize = max(1, integerOption(options, 'bucketSize', 10))
+        histogram = {}
+        for progress in list(self.task.workerProgress.values()):
+            bucket = progress // bucketSize * bucketSize
+            histogram[bucket] = histogram.get(bucket, 0) + 1
+        return {
+            'bucketSize': bucketSize,
+            'buckets': sorted(histogram.items())
+        }
+
+    def inputPool(self, options):
+        'How many inputs are generated ahead of time, and how many may be.'
+        pool = self.task.inputPool
+        if pool is None:
+            return {'ready': 0, 'pending': 0, 'target': 0}
+        return {
+            'ready': len(pool.ready),
+            'pending': pool.pending,
+            'target': pool.target
+        }
+
+    def memory(self, options):
+        'Estimated bytes taken by each part of the state, and in total.'
+        task = self.task
+        samples = max(1, integerOption(options, 'memorySamples',
+                                       MEMORY_SAMPLES))
+
+        def owned(*objs):
+            return sum(estimateSize(obj, samples) for obj in objs)
+
+        def indexes(*objs):
+            'Their ids are counted in the dicts that own them.'
+            return sum(estimateSize(obj, samples, strings=False)
+                       for obj in objs)
+        parts = {
+            'inputs': owned(task.inputIdToInput) +
+            indexes(task.inputIdInOrder),
+            'inputCache': task.inputCache.bytes
+            if task.inputCache is not None else 0,
+            'outputs': owned(task.outputIdToOutput) +
+            indexes(task.outputIdRefs),
+            'results': indexes(task.inputIdToOutputIdToWorkerIds,
+                               task.inputIdToOutputIdToClusterId,
+                               task.workerIdToInputIdToOutputId),
+            'rankings': indexes(task.inputIdToTotal,
+                                task.inputIdToRankedOutputIds,
+                                task.inputIdToOutputIdToRank,
+                                task.inputIdToSummary),
+            'workers': owned(task.workerProgress) +
+            indexes(task.workerIdInOrder, task.workerLastSeen)
+        }
+        parts['total'] = sum(parts.values())
+        return parts
+
+    def page(self, section, cursor=None, limit=MAX_PAGE, options=None):
+        'Returns (items, nextCursor). nextCursor is None on the last page.'
+        options = options or {}
+        if section not in SECTIONS:
+            raise ValueError(f'Unknown section {section}')
+        try:
+            start = int(cursor) if cursor else 0
+        except (TypeError, ValueError):
+            start = -1
+        if start < 0:
+            raise ValueError(f'Invalid cursor {cursor!r}')
+        limit = integerOption({'limit': limit}, 'limit', MAX_PAGE)
+        limit = max(1, min(limit, MAX_PAGE))
+        items, more = getattr(self, section + 'Page')(start, limit, options)
+        return items, str(start + len(items)) if more else None
+
+    def pageOf(self, items, start, limit):
+        'Called with the lock guarding the list items held.'
+        items = items[start:start + limit + 1]
+        return items[:limit], len(items) > limit
+
+    def inputsPage(self, start, limit, options):
+        task = self.task
+        with task.locks.inputs:
+            inputIds, more = self.pageOf(task.inputIdInOrder, start, limit)
+        summaries = task.inputIdToSummary
+        items = []
+        for inputId in inputIds:
+            total, distinctOutputs, topCount = summaries.get(inputId,
+                                                             (0, 0, 0))
+            items.append({
+                'inputId': inputId,
+                'input': task.getInput(inputId, cache=False),
+                'total': total,
+                'distinctOutputs': distinctOutputs,
+                'agreement': topCount / total if total else None
+            })
+        return items, more
+
+    def workersPage(self, start, limit, options):
+        task = self.task
+        with task.locks.workers:
+            workerIds, more = self.pageOf(task.workerIdInOrder, start, limit)
+            progress = [task.workerProgress[workerId]
+                        for workerId in workerIds]
+        return [{
+            'workerId': workerId,
+            'progress': workerProgress,
+            'results': len(task.workerIdToInputIdToOutputId.get(workerId,
+                                                                 ()))
+        } for workerId, workerProgress in zip(workerIds, progress)], more
+
+    def outputsPage(self, start, limit, options):
+        task = self.task
+        inputId = options.get('inputId')
+        if inputId not in task.inputIdToRankedOutputIds:
+            raise ValueError('Unknown inputId')
+        with task.locks.forInput(inputId):
+            outputIdToWorkerIds = task.inputIdToOutputIdToWorkerIds[inputId]
+            outputIds, more = self.pageOf(
+                task.inputIdToRankedOutputIds[inputId], start, limit)
+            return [{
+                'outputId': outputId,
+                'output': task.getOutput(outputId),
+                'count': len(outputIdToWorkerIds[outputId])
+            } for outputId in outputIds], more
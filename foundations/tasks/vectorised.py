@@ -0,0 +1,44 @@
+import random
+
+# NumPy is optional. Tasks that use it keep a pure-Python path for when it
+# is not installed.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Seeds of inputs generated with NumPy carry this bit, so that they are
+# regenerated with NumPy too: the two generators give different streams
+# for the same seed.
+NUMPY_SEED = 1 << 63
+
+
+def numpyAvailable():
+    return numpy is not None
+
+
+def tagSeed(seed):
+    'Marks seed for NumPy when it is installed.'
+    return seed | NUMPY_SEED if numpy is not None else seed
+
+
+def seededRng(seed):
+    'A numpy.random.Generator or a random.Random, depending on the seed.'
+    if seed & NUMPY_SEED:
+        if numpy is None:
+            raise RuntimeError('This input was generated with NumPy, which '
+                               'is not installed.')
+        return numpy.random.default_rng(seed & ~NUMPY_SEED)
+    return random.Random(seed)
+
+
+def isNumpyRng(rng):
+    return numpy is not None and isinstance(rng, numpy.random.Generator)
+
+
+def formatInts(values, prefix=''):
+    'Formats an integer array as a list of strings in bulk.'
+    strings = values.astype(str)
+    if prefix:
+        strings = numpy.char.add(prefix, strings)
+    return strings.tolist()
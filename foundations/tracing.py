@@ -0,0 +1,260 @@
+import cProfile
+import io
+import logging
+import pstats
+import random
+import threading
+import time
+
+# yappi is optional. Unlike cProfile, it profiles every thread at once and
+# attributes wall time to the dispatch each thread is running.
+try:
+    import yappi
+except ImportError:
+    yappi = None
+
+ENGINES = ['cprofile', 'yappi']
+# Lines of each profile that dumps include by default.
+DUMP_LIMIT = 30
+
+# (before, after) pairs run around every dispatch on every connection. See
+# addDispatchHook. Replaced rather than changed, so dispatch need not lock.
+hooks = []
+# The DispatchProfiler of the profile-* admin commands, if one was started.
+profiler = None
+
+
+def addDispatchHook(before=None, after=None):
+    '''
+    Calls before(target, event, size) and after(target, event, size,
+    elapsed) around the listeners of every event dispatched on any
+    connection. target is the Connection or Session, size that of the frame
+    the event came in (0 for local events such as disconnect) and elapsed the
+    seconds the listeners took. Hooks run on the dispatching thread, so keep
+    them cheap. Returns a handle for removeDispatchHook.
+    '''
+    global hooks
+    hook = (before, after)
+    hooks = hooks + [hook]
+    return hook
+
+
+def removeDispatchHook(hook):
+    global hooks
+    hooks = [other for other in hooks if other is not hook]
+
+
+def dispatch(target, event, data, size, handlers):
+    'Runs the listeners of event with the hooks of target and of all around.'
+    active = hooks + target.dispatchHooks
+    for before, _ in active:
+        if before is not None:
+            runHook(before, target, event, size)
+    startedAt = time.perf_counter()
+    try:
+        for handler in handlers:
+            handler(data)
+    finally:
+        elapsed = time.perf_counter() - startedAt
+        # In reverse, so that a hook wraps those added after it.
+        for _, after in reversed(active):
+            if after is not None:
+                runHook(after, target, event, size, elapsed)
+
+
+def runHook(hook, *args):
+    # A broken hook must not take the connection down with it.
+    try:
+        hook(*args)
+    except Exception:
+        logging.exception('A dispatch hook failed.')
+
+
+class DispatchProfiler():
+    '''
+    Profiles a sample of event dispatches, merged per event type, to find
+    which listener is slow. events limits it to those event types, rate is
+    the fraction of their dispatches profiled, and engine is cprofile or
+    yappi. start it on every connection, on one, or on those of a worker.
+
+    With cProfile, one dispatch is profiled at a time, on its own thread;
+    dispatches nested in it count towards it. yappi runs on every thread
+    while started, which costs more, and keeps what sampled dispatches run.
+    '''
+
+    def __init__(self, events=None, rate=1.0, engine='cprofile'):
+        if engine not in ENGINES:
+            raise ValueError(f'Unknown engine {engine}')
+        if engine == 'yappi' and yappi is None:
+            raise ValueError('yappi is not installed.')
+        self.events = set(events) if events else None
+        self.rate = rate
+        self.engine = engine
+        self.workerId = None
+        self.running = False
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # Newer Pythons allow one cProfile at a time per process.
+        self.busy = threading.Lock()
+        self.stats = {}  # event -> pstats.Stats, with cProfile
+        self.tags = {}  # event -> yappi tag
+        self.samples = {}  # event -> dispatches profiled
+        self.hook = None
+        # id of a connection's dispatchHooks -> (dispatchHooks, hook). A
+        # Session shares the list of its connection.
+        self.attached = {}
+
+    def start(self, connection=None, workerId=None):
+        '''
+        Profiles every connection, only connection (and its sessions), or
+        only the connections that say hello as workerId from now on.
+        '''
+        if self.engine == 'yappi':
+            yappi.clear_stats()
+            yappi.set_clock_type('wall')
+            yappi.set_tag_callback(self.currentTag)
+            yappi.start()
+        self.running = True
+        self.workerId = workerId
+        if connection is not None:
+            self.attach(connection)
+        elif workerId is None:
+            self.hook = addDispatchHook(self.before, self.after)
+
+    def attach(self, target):
+        dispatchHooks = target.dispatchHooks
+        with self.lock:
+            if id(dispatchHooks) in self.attached:
+                return
+            hook = target.addDispatchHook(self.before, self.after)
+            self.attached[id(dispatchHooks)] = (dispatchHooks, hook)
+
+    def stop(self):
+        'Stops profiling. What was collected can still be dumped.'
+        if not self.running:
+            return
+        self.running = False
+        if self.hook is not None:
+            removeDispatchHook(self.hook)
+        with self.lock:
+            attached, self.attached = self.attached, {}
+        for dispatchHooks, hook in attached.values():
+            if hook in dispatchHooks:
+                dispatchHooks.remove(hook)
+        if self.engine == 'yappi':
+            yappi.stop()
+            yappi.set_tag_callback(None)
+
+    def currentTag(self):
+        return getattr(self.local, 'tag', 0)
+
+    def before(self, target, event, size):
+        local = self.local
+        if getattr(local, 'depth', 0):
+            local.depth += 1
+            return
+        if not self.running:
+            return
+        if self.events is not None and event not in self.events:
+            return
+        if self.rate < 1 and random.random() >= self.rate:
+            return
+        if self.engine == 'yappi':
+            with self.lock:
+                local.tag = self.tags.setdefault(event, len(self.tags) + 1)
+        else:
+            if not self.busy.acquire(blocking=False):
+                return
+            local.profile = cProfile.Profile()
+            local.profile.enable()
+        local.depth = 1
+
+    def after(self, target, event, size, elapsed):
+        local = self.local
+        depth = getattr(local, 'depth', 0)
+        if depth == 0:
+            return
+        local.depth = depth - 1
+        if depth > 1:
+            return
+        if self.engine == 'yappi':
+            local.tag = 0
+            with self.lock:
+                self.samples[event] = self.samples.get(event, 0) + 1
+            return
+        profile, local.profile = local.profile, None
+        profile.disable()
+        self.busy.release()
+        with self.lock:
+            self.samples[event] = self.samples.get(event, 0) + 1
+            if event in self.stats:
+                self.stats[event].add(profile)
+            else:
+                self.stats[event] = pstats.Stats(profile)
+
+    def dump(self, limit=DUMP_LIMIT):
+        '''
+        Returns event -> {samples, profile}, where profile is the text of the
+        limit functions that took longest, listeners included.
+        '''
+        profiles = {}
+        with self.lock:
+            for event, samples in self.samples.items():
+                profiles[event] = {
+                    'samples': samples,
+                    'profile': self.profileText(event, limit)
+                }
+        return profiles
+
+    def profileText(self, event, limit):
+        'Called with lock held.'
+        buffer = io.StringIO()
+        if self.engine == 'cprofile':
+            stats = self.stats[event]
+            stats.stream = buffer
+            stats.sort_stats('cumulative').print_stats(limit)
+            return buffer.getvalue()
+        stats = yappi.get_func_stats(filter={'tag': self.tags[event]})
+        stats.sort('ttot')
+        buffer.write(f'{"ncall":>8} {"ttot":>10} {"tsub":>10}  function\n')
+        # The hooks themselves run with the tag of the dispatch.
+        stats = [stat for stat in stats if stat.module != __file__]
+        for stat in stats[:limit]:
+            buffer.write(f'{stat.ncall:>8} {stat.ttot:10.6f} '
+                         f'{stat.tsub:10.6f}  {stat.full_name}\n')
+        return buffer.getvalue()
+
+
+def startProfiling(events=None, rate=1.0, engine='cprofile', workerId=None):
+    '''
+    Replaces the profiler of the admin commands with a new one, on every
+    connection or on those of workerId. Raises ValueError if the options
+    make no sense.
+    '''
+    global profiler
+    if not 0 < rate <= 1:
+        raise ValueError('The rate must be in (0, 1].')
+    newProfiler = DispatchProfiler(events, rate, engine)
+    stopProfiling()
+    newProfiler.start(workerId=workerId)
+    profiler = newProfiler
+    return newProfiler
+
+
+def stopProfiling():
+    if profiler is not None:
+        profiler.stop()
+
+
+def dumpProfiles(limit=DUMP_LIMIT):
+    if profiler is None:
+        return {}
+    return profiler.dump(limit)
+
+
+def workerConnected(target, workerId):
+    'Called once a connection says who it is, for per-worker profiling.'
+    current = profiler
+    if current is not None and current.running and \
+            current.workerId is not None and current.workerId == workerId:
+        current.attach(target)
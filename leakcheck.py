@@ -108,10 +108,9 @@ class ApiCtx:
         print('Dropped: ', data)
 
     def getInputById(self, inputId):
-        self.connection.fire('get-input-by-id', {
+        return self.connection.request('get-input-by-id', {
             'inputId': inputId
-        })
-        return self.connection.waitFor('input')['input']
+        }, 'input', timeout=30)['input']
 
 
 def main():
@@ -1,12 +1,27 @@
 # TODO: Refactor
 
+import asyncio
+import concurrent.futures
+import multiprocessing.connection
+import os
 import secrets
+import selectors
 import socket
+import sys
+import tempfile
+import threading
 
 import argparse
 import logging
 
+from foundations import metrics, tracing
 from foundations.connection import Connection
+from foundations.asyncconnection import AsyncConnection
+from foundations.codecs import negotiateCodec, negotiateCompression
+from foundations.handoff import ConnectionTracker, HandoffListener, takeOver
+from foundations.tasks.shared import TaskStateManager, serveTasks, \
+    connectTasks, shareTasks
+from foundations.tasks.simpletask import SimpleTask
 from tasks import GoingElectric, CSExplorer, CSAirline, CS2521_Lab1_1, CS2521_Lab1_2, CS1511_22T2_Asm0, CS2521_Lab2_1, CS2521_Lab2_2
 
 # zID WhiteList
@@ -24,24 +39,69 @@ parser.add_argument('--host', type=str, nargs=1, default=['0.0.0.0'],
 parser.add_argument('--port', type=int, nargs=1, default=[15000],
                     required=False,
                     help="The port to bind to.")
+parser.add_argument('--backlog', type=int, nargs=1, default=[128],
+                    required=False,
+                    help="The maximum number of pending connections.")
+parser.add_argument('--engine', type=str, nargs=1, default=['threaded'],
+                    choices=['threaded', 'asyncio'], required=False,
+                    help="threaded runs one thread per connection; asyncio \
+serves every connection from a single event loop.")
+parser.add_argument('--handler-threads', type=int, nargs=1, default=[32],
+                    required=False,
+                    help="With --engine asyncio, run event handlers on this \
+many threads, so that a handler waiting on inputs, the disk or the task state \
+process holds up its own connection only. 0 runs them on the event loop, \
+which only suits tasks whose handlers never block.")
+parser.add_argument('--data-dir', type=str, nargs=1, default=[None],
+                    required=False,
+                    help="Keep task state in this directory so it survives \
+restarts. Each task gets a subdirectory.")
+parser.add_argument('--processes', type=int, nargs=1, default=[1],
+                    required=False,
+                    help="Serve connections from this many processes sharing \
+the port (Linux only). Task state is kept by the parent process.")
+parser.add_argument('--handoff-socket', type=str, nargs=1, default=[None],
+                    required=False,
+                    help="Wait on this Unix socket for a newer server to take \
+over without dropping connections.")
+parser.add_argument('--take-over', action='store_true',
+                    help="Take the port, the task state and the handoff \
+socket over from the server waiting on --handoff-socket.")
+parser.add_argument('--drain-timeout', type=float, nargs=1, default=[300],
+                    required=False,
+                    help="How many seconds a server that was taken over waits \
+for clients to reconnect to the new one. Older clients cannot, so it waits \
+for their connections to close however long that takes.")
+parser.add_argument('--metrics-port', type=int, nargs=1, default=[None],
+                    required=False,
+                    help="Serve Prometheus metrics over HTTP on this port. \
+With --processes, each worker process uses the ports after it.")
+parser.add_argument('--metrics-host', type=str, nargs=1,
+                    default=['127.0.0.1'], required=False,
+                    help="The host to serve metrics on.")
 
 args = parser.parse_args()
 
 host = args.host[0]
 port = args.port[0]
-
-logging.info('Starting server...')
-server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-server.bind((host, port))
-server.listen(5)
-logging.info(f'Listening on {host}:{str(port)}.')
+backlog = args.backlog[0]
+engine = args.engine[0]
+handlerThreads = args.handler_threads[0]
+dataDir = args.data_dir[0]
+processes = args.processes[0]
+handoffSocket = args.handoff_socket[0]
+metricsPort = args.metrics_port[0]
+metricsHost = args.metrics_host[0]
+drainTimeout = args.drain_timeout[0]
+if args.take_over and handoffSocket is None:
+    parser.error('--take-over needs --handoff-socket.')
+if processes > 1 and handoffSocket is not None:
+    parser.error('--handoff-socket works with a single process only.')
 
 
 class ServerContext():
-    def __init__(self, socketConn) -> None:
-        self.connection = Connection(socketConn)
+    def __init__(self, connection) -> None:
+        self.connection = connection
         self.connection.start()
         self.connection.registerEventListener('hello', self.handleHello)
         self.taskId = None
@@ -68,20 +128,56 @@ class ServerContext():
             self.dropConnection('Failed to start autotest due to an error.')
             return
 
-        if workerType == 'tester':
+        # Old clients do not offer codecs and stay on newline-JSON. A hello
+        # on the connection itself starts a fresh compression stream, as such
+        # clients may set up a new Connection on the same socket; sessions
+        # keep the stream they share.
+        codec = negotiateCodec(data.get('codecs'))
+        compression = negotiateCompression(data.get('compression')) \
+            if codec is not None else None
+        self.connection.setCodec(codec)
+        self.connection.setCompression(compression)
+        prefetch = data.get('prefetch')
+        summaries = data.get('summaries') is True
+        if data.get('reconnect') is True:
+            connections.canReconnect(self.connection)
+        if workerType == 'tester' and isinstance(prefetch, int) and \
+                prefetch > 0:
+            if not hasattr(TASKS_AVAILABLE[taskId], 'newBatchRunner'):
+                self.dropConnection('This task does not support prefetching.')
+                return
+            self.workerId = workerId if workerId else secrets.token_hex(16)
+            self.task = TASKS_AVAILABLE[taskId].newBatchRunner(
+                connection=self.connection, workerId=self.workerId,
+                count=prefetch, summaries=summaries)
+            self.connection.fire('ack', {
+                'workerId': self.workerId,
+                'codec': codec,
+                'compression': compression,
+                'progress': getattr(self.task, 'progress', None)
+            })
+        elif workerType == 'tester':
             self.workerId = workerId if workerId else secrets.token_hex(16)
             self.task = TASKS_AVAILABLE[taskId].newTaskRunner(
-                connection=self.connection, workerId=self.workerId)
+                connection=self.connection, workerId=self.workerId,
+                summaries=summaries)
             self.connection.fire('ack', {
-                'workerId': self.workerId
+                'workerId': self.workerId,
+                'codec': codec,
+                'compression': compression,
+                'progress': getattr(self.task, 'progress', None)
             })
         elif workerType == 'api':
             self.workerId = workerId if workerId else secrets.token_hex(16)
             self.task = TASKS_AVAILABLE[taskId].newTaskApi(
                 connection=self.connection, workerId=self.workerId)
             self.connection.fire('ack', {
-                'workerId': self.workerId
+                'workerId': self.workerId,
+                'codec': codec,
+                'compression': compression
             })
+        # For the profile-start admin command, if it asked for this worker.
+        tracing.workerConnected(self.connection, self.workerId)
 
     def dropConnection(self, withReason='Dropped.'):
         self.connection.fire("drop", {
@@ -90,6 +186,24 @@ class ServerContext():
         self.connection.close()
 
 
+def onConnect(connection):
+    connections.add(connection)
+    # New clients run each test as a session of one connection; old clients
+    # say hello on the connection itself.
+    connection.onSession(ServerContext)
+    ServerContext(connection)
+
+
+connections = ConnectionTracker()
+# Written to once the listening socket has been handed over, to stop
+# accepting on it.
+stopReader, stopWriter = socket.socketpair()
+
+
+def stopAccepting():
+    stopWriter.send(b'\0')
+
+
 TASKS_AVAILABLE = {
     'going_electric': GoingElectric(),
     'cs2521_lab1_1': CS2521_Lab1_1(),
@@ -99,6 +213,162 @@ TASKS_AVAILABLE = {
 }
 
 
-while True:
-    sx, addr = server.accept()
-    ServerContext(sx)
+handoff = None
+
+
+def enablePersistence(restore=True):
+    if dataDir is None:
+        return
+    for taskId, task in TASKS_AVAILABLE.items():
+        if hasattr(task, 'enablePersistence'):
+            task.enablePersistence(os.path.join(dataDir, taskId),
+                                   restore=restore)
+
+
+def enableMetrics(port, connections=None, reportTasks=True):
+    if metricsPort is None:
+        return
+    metrics.enable(port, metricsHost, TASKS_AVAILABLE, connections,
+                   reportTasks)
+
+
+def listen(reusePort=False):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reusePort:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+    server.bind((host, port))
+    server.listen(backlog)
+    return server
+
+
+def serveThreaded(server):
+    'Accepts on server until stopAccepting is called.'
+    # The listening socket may be shared with a server taking over, which
+    # can take a connection between select and accept.
+    server.setblocking(False)
+    selector = selectors.DefaultSelector()
+    selector.register(server, selectors.EVENT_READ)
+    selector.register(stopReader, selectors.EVENT_READ)
+    logging.info(f'Listening on {host}:{str(port)}.')
+
+    while True:
+        for key, _ in selector.select():
+            if key.fileobj is stopReader:
+                selector.close()
+                return
+            try:
+                sx, addr = server.accept()
+            except BlockingIOError:
+                continue
+            sx.setblocking(True)
+            onConnect(Connection(sx))
+
+
+async def serveAsyncio(listener):
+    loop = asyncio.get_running_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(
+        handlerThreads, thread_name_prefix='Handlers') \
+        if handlerThreads > 0 else None
+    server = await loop.create_server(
+        lambda: AsyncConnection(onConnect=onConnect, executor=executor),
+        sock=listener, backlog=backlog)
+
+    def stop():
+        loop.remove_reader(stopReader)
+        server.close()
+
+    loop.add_reader(stopReader, stop)
+    logging.info(f'Listening on {host}:{str(port)} (asyncio).')
+    try:
+        await server.serve_forever()
+    except asyncio.CancelledError:
+        pass
+    # Connections keep running on this loop while they drain.
+    await loop.run_in_executor(None, handoff.drained.wait)
+
+
+def serve(listener):
+    if engine == 'asyncio':
+        asyncio.run(serveAsyncio(listener))
+    else:
+        serveThreaded(listener)
+
+
+def serveWorker(index, address, authkey, sharedTaskIds):
+    'Runs in each worker process: serves connections on the shared port.'
+    shareTasks(TASKS_AVAILABLE,
+               connectTasks(address, authkey, sharedTaskIds))
+    if metricsPort is not None:
+        # The state of the tasks is reported by the parent process.
+        enableMetrics(metricsPort + 1 + index, connections,
+                      reportTasks=False)
+    serve(listen(reusePort=True))
+
+
+def serveProcesses():
+    '''
+    Forks the worker processes, which each listen on the port with
+    SO_REUSEPORT so that the kernel spreads connections between them. This
+    process then keeps the state of every SimpleTask and serves it to them
+    over a Unix socket.
+    '''
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        sys.exit('--processes needs SO_REUSEPORT, which this platform lacks.')
+    address = os.path.join(tempfile.mkdtemp(prefix='autotest-'), 'state')
+    authkey = secrets.token_bytes(32)
+    sharedTaskIds = [taskId for taskId, task in TASKS_AVAILABLE.items()
+                     if isinstance(task, SimpleTask)]
+    # Fork before this process starts any threads.
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=serveWorker, daemon=True,
+                               name=f'worker-{i}',
+                               args=(i, address, authkey, sharedTaskIds))
+               for i in range(processes)]
+    for worker in workers:
+        worker.start()
+
+    # Bind the state socket before restoring the state, which may take a
+    # while: workers that connect meanwhile wait in the listen backlog until
+    # it is served, rather than give up on a socket that is not there yet.
+    serveTasks(TASKS_AVAILABLE)
+    stateServer = TaskStateManager(address=address,
+                                   authkey=authkey).get_server()
+    enablePersistence()
+    # Connections and tests are counted by the workers; this process only
+    # has the state of the tasks to report.
+    enableMetrics(metricsPort)
+    threading.Thread(target=stateServer.serve_forever, daemon=True,
+                     name='TaskState').start()
+    logging.info(f'Serving task state to {processes} processes at '
+                 f'{address}.')
+
+    # A worker only exits if something went badly wrong; let whatever
+    # supervises the server start it afresh.
+    multiprocessing.connection.wait([worker.sentinel for worker in workers])
+    for worker in workers:
+        if not worker.is_alive():
+            logging.error(f'{worker.name} exited with {worker.exitcode}.')
+    sys.exit(1)
+
+
+logging.info('Starting server...')
+if processes > 1:
+    serveProcesses()
+else:
+    if args.take_over:
+        listener = takeOver(handoffSocket, TASKS_AVAILABLE,
+                            onReady=lambda: enablePersistence(restore=False))
+        logging.info(f'Took over from the server at {handoffSocket}.')
+    else:
+        enablePersistence()
+        listener = listen()
+    enableMetrics(metricsPort, connections)
+    if handoffSocket is not None:
+        handoff = HandoffListener(handoffSocket, listener, TASKS_AVAILABLE,
+                                  connections, stopAccepting, drainTimeout)
+    serve(listener)
+    # Only reached once a newer server has taken over.
+    handoff.drained.wait()
+    logging.info('Drained; exiting.')
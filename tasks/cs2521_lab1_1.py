@@ -1,24 +1,36 @@
 from foundations import SimpleTask, SimpleTaskRunner
-import random
 
 from foundations.tasks.simpletask import SimpleTaskApi
+from foundations.tasks.vectorised import isNumpyRng, formatInts
 
 
 class CS2521_Lab1_1(SimpleTask):
     # Sorted Insert
+    seededInputs = True
+    vectorised = True
+
     def __init__(self):
         super().__init__(CS2521_Lab1_1_Runner, CS2521_Lab1_1_Api)
 
-    def _generateNewInput(self):
+    def _generateNewInput(self, rng):
+        if isNumpyRng(rng):
+            return self._generateNewInputNumpy(rng)
         commands = []
         # Setup
-        numOfNumbers = random.randint(0, 1000)
+        numOfNumbers = rng.randint(0, 1000)
         # Sorted Numbers
-        commands.append(' '.join([str(i) for i in sorted([random.randint(-1000, 1000)
+        commands.append(' '.join([str(i) for i in sorted([rng.randint(-1000, 1000)
                         for i in range(numOfNumbers)])]))
-        commands.append(str(random.randint(-1500, 1500)))
+        commands.append(str(rng.randint(-1500, 1500)))
         return '\n'.join(commands)
 
+    def _generateNewInputNumpy(self, rng):
+        numOfNumbers = rng.integers(0, 1001)
+        numbers = rng.integers(-1000, 1001, numOfNumbers)
+        numbers.sort()
+        return ' '.join(formatInts(numbers)) + '\n' + \
+            str(rng.integers(-1500, 1501))
+
 
 class CS2521_Lab1_1_Runner(SimpleTaskRunner):
     def _run(self, nextInputId, nextInput):
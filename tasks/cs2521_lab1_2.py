@@ -1,18 +1,24 @@
 from foundations import SimpleTask, SimpleTaskRunner
-import random
 
 from foundations.tasks.simpletask import SimpleTaskApi
+from foundations.tasks.vectorised import isNumpyRng, formatInts
 
 
 class CS2521_Lab1_2(SimpleTask):
     # Sorted Insert
+    seededInputs = True
+    vectorised = True
+
     def __init__(self):
         super().__init__(CS2521_Lab1_2_Runner, CS2521_Lab1_2_Api)
 
-    def _generateNewInput(self):
+    def _generateNewInput(self, rng):
+        if isNumpyRng(rng):
+            return ' '.join(formatInts(
+                rng.integers(-1000, 1001, rng.integers(0, 1001))))
         commands = []
-        numOfNumbers = random.randint(0, 1000)
-        commands.append(' '.join([str(random.randint(-1000, 1000))
+        numOfNumbers = rng.randint(0, 1000)
+        commands.append(' '.join([str(rng.randint(-1000, 1000))
                         for _ in range(numOfNumbers)]))
         return '\n'.join(commands)
 
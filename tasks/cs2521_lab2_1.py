@@ -1,26 +1,31 @@
 from foundations import SimpleTask, SimpleTaskRunner
-import random
 
 from foundations.tasks.simpletask import SimpleTaskApi
+from foundations.tasks.vectorised import isNumpyRng, formatInts, numpy
 
 
 class CS2521_Lab2_1(SimpleTask):
     # Sorted Insert
+    seededInputs = True
+    vectorised = True
+
     def __init__(self):
         super().__init__(CS2521_Lab2_1_Runner, CS2521_Lab2_1_Api)
 
-    def _generateNewInput(self):
+    def _generateNewInput(self, rng):
+        if isNumpyRng(rng):
+            return self._generateNewInputNumpy(rng)
         commands = []
         # Setup
-        numOfCommands = random.randint(5,100)
+        numOfCommands = rng.randint(5,100)
         for _ in range(numOfCommands):
-            cmdType = random.choice(['+','-','f','s'])
+            cmdType = rng.choice(['+','-','f','s'])
             if cmdType == '+':
-                for x in range(random.randint(1, 100)):
-                    numToEnqueue = random.randint(-1000,1000)
+                for x in range(rng.randint(1, 100)):
+                    numToEnqueue = rng.randint(-1000,1000)
                     commands.append(f'+ {numToEnqueue}')
             elif cmdType == '-':
-                for x in range(random.randint(1, 100)):
+                for x in range(rng.randint(1, 100)):
                     commands.append('-')
             elif cmdType == 'f':
                 commands.append('f')
@@ -29,6 +34,23 @@ class CS2521_Lab2_1(SimpleTask):
         commands.append('q')
         return '\n'.join(commands)
 
+    def _generateNewInputNumpy(self, rng):
+        # The same commands, with every number drawn in one call: each
+        # command expands to a run of lines, and only '+' lines need one.
+        numOfCommands = rng.integers(5, 101)
+        cmdTypes = rng.integers(0, 4, numOfCommands)
+        runs = rng.integers(1, 101, numOfCommands)
+        runs[cmdTypes >= 2] = 1
+        lineTypes = cmdTypes.repeat(runs)
+        enqueue = lineTypes == 0
+        commands = numpy.empty(len(lineTypes) + 1, dtype=object)
+        commands[:-1][enqueue] = formatInts(
+            rng.integers(-1000, 1001, enqueue.sum()), prefix='+ ')
+        commands[:-1][~enqueue] = numpy.array(['-', 'f', 's'], dtype=object)[
+            lineTypes[~enqueue] - 1]
+        commands[-1] = 'q'
+        return '\n'.join(commands.tolist())
+
 
 class CS2521_Lab2_1_Runner(SimpleTaskRunner):
     def _run(self, nextInputId, nextInput):
@@ -22,10 +22,17 @@ class ApiCtx:
         print('Dropped: ', data)
 
     def getInputById(self, inputId):
-        self.connection.fire('get-input-by-id', {
+        return self.connection.request('get-input-by-id', {
             'inputId': inputId
-        })
-        return self.connection.waitFor('input')['input']
+        }, 'input', timeout=30)['input']
+
+    def getOutputCluster(self, inputId, outputId=None, offset=0, limit=1000):
+        return self.connection.request('get-output-cluster', {
+            'inputId': inputId,
+            'outputId': outputId,
+            'offset': offset,
+            'limit': limit
+        }, 'output-cluster', timeout=30)['cluster']
 
 
 def main():